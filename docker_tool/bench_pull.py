@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import argparse
+from fake_registry import FakeRegistry
+
+# End to end benchmark of docker_pull.py against a local fake registry. Every scenario
+# pulls its image from scratch (empty cache, new archive) and reports wall time, MB/s,
+# peak RSS and bytes left on disk, so that two versions of the script can be compared:
+#   python bench_pull.py --json before.json
+#   python bench_pull.py --compare before.json -- --jobs 8
+
+MB = 1024 * 1024
+
+# name -> image and network conditions
+SCENARIOS = {
+    'small-layers': {
+        'help': 'many small layers, dominated by per-request overhead',
+        'image': {'layers': 200, 'layer_size': 64 * 1024},
+        'network': {'latency': 0.005},
+    },
+    'huge-layer': {
+        'help': 'one huge layer, dominated by hashing, decompression and disk throughput',
+        'image': {'layers': 1, 'layer_size': 512 * MB},
+        'network': {},
+    },
+    'flaky': {
+        'help': 'slow connections answering 503 and breaking in the middle of blobs',
+        'image': {'layers': 20, 'layer_size': 4 * MB},
+        'network': {'latency': 0.05, 'bandwidth': 20 * MB, 'error_rate': 0.05, 'drop_rate': 0.1},
+    },
+    'mirrors': {
+        'help': 'slow registry behind a failing, a fast and a corrupting mirror (passed as --mirror)',
+        'image': {'layers': 20, 'layer_size': 4 * MB},
+        'network': {'latency': 0.2, 'bandwidth': 5 * MB},
+        'mirrors': [
+            {'latency': 0.05, 'bandwidth': 20 * MB, 'error_rate': 0.3, 'drop_rate': 0.2},
+            {'latency': 0.01, 'bandwidth': 50 * MB},
+            {'latency': 0.005, 'corrupt_rate': 0.3},
+        ],
+    },
+}
+
+def disk_usage(folder):
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+# Pull the image once, in a fresh folder holding the archive and the blob cache
+def run_pull(script, image, work_dir, extra_args):
+    run_dir = tempfile.mkdtemp(dir=work_dir)
+    cmd = [sys.executable, script, '--image', image, '-o', os.path.join(run_dir, 'image.tar'),
+           '--cache-dir', os.path.join(run_dir, 'cache')] + extra_args
+    with open(os.path.join(run_dir, 'pull.log'), 'wb') as log:
+        start = time.time()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the rusage of this very child, not the max over all of them
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.time() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    result = {
+        'ok': proc.returncode == 0,
+        'wall': wall,
+        # ru_maxrss is in KB on Linux, bytes on macOS
+        'peak_rss': rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'cpu': rusage.ru_utime + rusage.ru_stime,
+        'disk_bytes': disk_usage(run_dir),
+    }
+    if result['ok']:
+        shutil.rmtree(run_dir)
+    else: # Kept with its pull.log
+        result['log'] = run_dir
+    return result
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def run_scenario(name, args, extra_args):
+    scenario = SCENARIOS[name]
+    image_args = dict(scenario['image'])
+    if name == 'huge-layer' and args.huge_size:
+        image_args['layer_size'] = args.huge_size
+    registry = FakeRegistry(args.data_dir, seed=args.seed, **scenario['network'])
+    print('[+] {}: preparing {} layers of {} bytes'.format(name, image_args['layers'], image_args['layer_size']))
+    blob_bytes = registry.add_image('bench/' + name, compressible=args.compressible,
+                                    compression=args.compression, seed=args.seed, **image_args)
+    port = registry.start()
+    image = 'localhost:{}/bench/{}:latest'.format(port, name)
+    # Mirrors serve the very same image (same layers, same digests)
+    mirrors = []
+    pull_args = list(extra_args)
+    for network in scenario.get('mirrors', []):
+        mirror = FakeRegistry(args.data_dir, seed=args.seed, **network)
+        mirror.add_image('bench/' + name, compressible=args.compressible,
+                         compression=args.compression, seed=args.seed, **image_args)
+        pull_args += ['--mirror', 'localhost:{}=localhost:{}'.format(port, mirror.start())]
+        mirrors.append(mirror)
+    runs = []
+    work_dir = tempfile.mkdtemp(prefix='docker_pull_bench-')
+    try:
+        for i in range(args.repeat):
+            result = run_pull(args.script, image, work_dir, pull_args)
+            runs.append(result)
+            print('    run {}: {} {:.2f}s'.format(i + 1, 'ok' if result['ok'] else 'FAILED', result['wall']))
+    finally:
+        registry.stop()
+        for mirror in mirrors:
+            mirror.stop()
+    ok = [r for r in runs if r['ok']]
+    if len(ok) == len(runs):
+        shutil.rmtree(work_dir, ignore_errors=True)
+    summary = {
+        'runs': len(runs),
+        'failures': len(runs) - len(ok),
+        'blob_bytes': blob_bytes,
+        'registry': registry.stats,
+    }
+    if mirrors:
+        summary['mirrors'] = [mirror.stats for mirror in mirrors]
+    if ok:
+        wall = median([r['wall'] for r in ok])
+        summary.update({
+            'wall': wall,
+            'mb_per_s': blob_bytes / MB / wall,
+            'peak_rss': max(r['peak_rss'] for r in ok),
+            'cpu': median([r['cpu'] for r in ok]),
+            'disk_bytes': median([r['disk_bytes'] for r in ok]),
+        })
+    for r in runs:
+        if not r['ok']:
+            print('[-] {}: failed run kept in {}'.format(name, r['log']))
+    return summary
+
+def print_table(results, baseline):
+    print('{:<14} {:>9} {:>9} {:>10} {:>9} {:>11} {:>6}'.format(
+        'scenario', 'wall (s)', 'MB/s', 'RSS (MB)', 'CPU (s)', 'disk (MB)', 'fails'))
+    for name, r in results.items():
+        if 'wall' not in r:
+            print('{:<14} {:>9}'.format(name, 'failed'))
+            continue
+        print('{:<14} {:>9.2f} {:>9.1f} {:>10.1f} {:>9.2f} {:>11.1f} {:>6}'.format(
+            name, r['wall'], r['mb_per_s'], r['peak_rss'] / MB, r['cpu'], r['disk_bytes'] / MB, r['failures']))
+        old = baseline.get(name)
+        if old and 'wall' in old:
+            print('{:<14} {:>+8.0f}% {:>+8.0f}% {:>+9.0f}% {:>+8.0f}% {:>+10.0f}%'.format(
+                '  vs baseline',
+                *[100.0 * (r[k] - old[k]) / old[k] if old[k] else 0.0
+                  for k in ('wall', 'mb_per_s', 'peak_rss', 'cpu', 'disk_bytes')]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark docker_pull.py against a local fake registry. '
+                    'Arguments after -- are passed to docker_pull.py',
+        epilog='scenarios: ' + ', '.join('{} ({})'.format(k, v['help']) for k, v in SCENARIOS.items()))
+    parser.add_argument("--scenario", type=str, action="append", choices=sorted(SCENARIOS), default=[],
+                        help="scenario to run, can be repeated (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="pulls per scenario, the median is reported")
+    parser.add_argument("--script", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docker_pull.py'),
+                        help="docker_pull.py to benchmark")
+    parser.add_argument("--data-dir", type=str, default=os.path.join(tempfile.gettempdir(), 'docker_pull_bench'),
+                        help="where generated layers are kept between runs")
+    parser.add_argument("--huge-size", type=int, default=0, help="uncompressed size of the huge-layer layer")
+    parser.add_argument("--compressible", type=float, default=0.5, help="share of each layer that compresses well")
+    parser.add_argument("--compression", type=str, choices=["gzip", "zstd"], default="gzip")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the layer content and injected failures")
+    parser.add_argument("--json", type=str, default=None, help="write the results to this file")
+    parser.add_argument("--compare", type=str, default=None, help="results of an earlier --json run to compare with")
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        extra_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['scenarios']
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        results[name] = run_scenario(name, args, extra_args)
+    print()
+    print_table(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'script': args.script, 'pull_args': extra_args, 'time': time.time(),
+                       'scenarios': results}, f, indent=2)
+        print('[+] Results written to', args.json)
+    if any(r['failures'] for r in results.values()):
+        exit(1)
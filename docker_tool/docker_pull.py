@@ -1,357 +1,1892 @@
 import os
 import sys
-import gzip
+import zlib
 from io import BytesIO
 import json
 import hashlib
+import time
+import re
+from datetime import datetime
+import tempfile
 import shutil
+try:
+    import fcntl
+except ImportError: # Windows, the cache lock becomes a no-op
+    fcntl = None
+try:
+    import zstandard
+except ImportError: # Only needed to decompress zstd layers (--format legacy)
+    zstandard = None
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import tarfile
 import urllib3
 import argparse
+import threading
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 urllib3.disable_warnings()
 
-def create_session():
+# Usable as a library: a RegistryClient keeps its connection pool, token cache and blob
+# cache between pulls, errors are raised as PullError subclasses
+#   client = RegistryClient(jobs=4)
+#   client.pull(['busybox', 'alpine:3.19'], output='images.tar')
+# or pull_image('busybox') with a client shared by all calls
+
+class PullError(Exception):
+    pass
+
+# Registry unreachable, the CLI prints troubleshooting tips
+class RegistryConnectionError(PullError):
+    pass
+
+class AuthenticationError(PullError):
+    pass
+
+class ManifestError(PullError):
+    pass
+
+# Blob missing or its download failed
+class BlobError(PullError):
+    pass
+
+# Blob (or base archive layer) not matching its digest
+class CorruptedBlobError(BlobError):
+    sources = () # Registries that sent the data, when the blob can be fetched again
+
+# --base archive missing, unreadable or not an image archive
+class BaseArchiveError(PullError):
+    pass
+
+def create_session(pool_size=10, retries=3):
     s = requests.Session()
     retry_strategy = Retry(
-        total=3,
+        total=retries,
         backoff_factor=1,
         status_forcelist=[429, 500, 502, 503, 504],
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    # pool_maxsize must cover the number of download workers, otherwise
+    # connections beyond it are opened and thrown away on every request
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size)
     s.mount("http://", adapter)
     s.mount("https://", adapter)
-    
+
     # Check if proxy environment variables are set
     http_proxy = os.environ.get('HTTP_PROXY') or os.environ.get('http_proxy')
     https_proxy = os.environ.get('HTTPS_PROXY') or os.environ.get('https_proxy')
-    
+
     if http_proxy or https_proxy:
         s.proxies = {
             'http': http_proxy,
             'https': https_proxy
         }
-        print('[+] Using proxy settings from environment')
-    
+
     return s
 
-# Create a session for all requests
-session = create_session()
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--platform",
-    type=str,
-    required=False,
-    default="linux/amd64",
-    help="specify architecture like linux/amd64"
-)
-parser.add_argument(
-    "--image",
-    type=str,
-    required=True,
-    help="specify image like hello-world"
-)
-
-args = parser.parse_args()
-image_os = args.platform.split("/")[0]
-image_arch = args.platform.split("/")[1]
-
-# Look for the Docker image to download
-repo = 'library'
-tag = 'latest'
-img_parts = args.image.split('/')
-try:
-    img, tag = img_parts[-1].split('@')
-except ValueError:
-    try:
-        img, tag = img_parts[-1].split(':')
-    except ValueError:
-        img = img_parts[-1]
-# Docker client doesn't seem to consider the first element as a potential registry unless there is a '.' or ':'
-if len(img_parts) > 1 and ('.' in img_parts[0] or ':' in img_parts[0]):
-    registry = img_parts[0]
-    repo = '/'.join(img_parts[1:-1])
-else:
-    registry = 'registry-1.docker.io'
-    if len(img_parts[:-1]) != 0:
-        repo = '/'.join(img_parts[:-1])
-    else:
-        repo = 'library'
-repository = '{}/{}'.format(repo, img)
+# Timings and byte counts of a pull, per phase and per layer, for --metrics-json and
+# the json progress events
+class Metrics(object):
+    # Phases of a layer, summed over its chunks
+    LAYER_PHASES = ('download', 'verify', 'decompress', 'cache', 'archive')
 
-# Get Docker authentication endpoint when it is required
-auth_url='https://auth.docker.io/token'
-reg_service='registry.docker.io'
+    def __init__(self, emit=None):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.emit = emit # RegistryClient.event
+        self.phases = {} # probe, auth, manifest, config, layers, finalize -> seconds
+        self.layers = [] # one record per layer job
 
-try:
-    print('[+] Connecting to registry: {}'.format(registry))
-    resp = session.get('https://{}/v2/'.format(registry), verify=False, timeout=30)
-    if resp.status_code == 401:
-        auth_url = resp.headers['WWW-Authenticate'].split('"')[1]
+    def event(self, name, **fields):
+        if self.emit:
+            self.emit(name, **fields)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    # Time a block of the run (summed when several workers run it, like auth)
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
         try:
-            reg_service = resp.headers['WWW-Authenticate'].split('"')[3]
-        except IndexError:
-            reg_service = ""
-except requests.exceptions.RequestException as e:
-    print('[-] Connection error:', str(e))
-    print('[*] Troubleshooting tips:')
-    print('    1. Check your internet connection')
-    print('    2. If you are behind a proxy, set HTTP_PROXY and HTTPS_PROXY environment variables')
-    print('    3. Try using a VPN if the registry is blocked')
-    print('    4. Verify if the registry {} is accessible from your network'.format(registry))
-    exit(1)
-
-# Get Docker token (this function is useless for unauthenticated registries like Microsoft)
-def get_auth_head(auth_type):
-    try:
-        response = session.get('{}?service={}&scope=repository:{}:pull'.format(auth_url, reg_service, repository),
-                           verify=False, timeout=30)
-        access_token = response.json()['token']
-        head = {'Authorization':'Bearer '+ access_token, 'Accept': auth_type}
-        return head
-    except requests.exceptions.RequestException as e:
-        print('[-] Authentication error:', str(e))
-        exit(1)
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def layer(self, image, layer):
+        record = {'image': image.name, 'digest': layer['digest'], 'size': layer.get('size'),
+                  'source': None, 'bytes': 0, 'written': 0, 'seconds': 0.0}
+        record.update(dict.fromkeys(self.LAYER_PHASES, 0.0))
+        with self.lock:
+            self.layers.append(record)
+        return record
+
+    def layer_done(self, record, start):
+        record['seconds'] = time.perf_counter() - start
+        if record['download'] and record['bytes']:
+            record['mb_per_s'] = record['bytes'] / record['download'] / (1024 * 1024)
+        for key in self.LAYER_PHASES + ('seconds', 'mb_per_s'):
+            if key in record:
+                record[key] = round(record[key], 4)
+        self.event('layer_done', **record)
+
+    def summary(self, ok):
+        wall = time.time() - self.start
+        downloaded = sum(r['bytes'] for r in self.layers if r['source'] == 'registry')
+        layers_wall = self.phases.get('layers') or wall
+        return {
+            'ok': ok,
+            'wall': round(wall, 4),
+            'phases': {k: round(v, 4) for k, v in self.phases.items()},
+            'layer_phases': {k: round(sum(r[k] for r in self.layers), 4) for k in self.LAYER_PHASES},
+            'bytes': {
+                'downloaded': downloaded,
+                'from_cache': sum(r['bytes'] for r in self.layers if r['source'] == 'cache'),
+                'from_base': sum(r['written'] for r in self.layers if r['source'] == 'base'),
+                'archive': sum(r['written'] for r in self.layers),
+            },
+            'download_mb_per_s': round(downloaded / layers_wall / (1024 * 1024), 3),
+            'layers': self.layers,
+        }
 
 # Docker style progress bar
-def progress_bar(ublob, nb_traits):
-    sys.stdout.write('\r' + ublob[7:19] + ': Downloading [')
-    for i in range(0, nb_traits):
-        if i == nb_traits - 1:
-            sys.stdout.write('>')
-        else:
-            sys.stdout.write('=')
-    for i in range(0, 49 - nb_traits):
-        sys.stdout.write(' ')
-    sys.stdout.write(']')
-    sys.stdout.flush()
-
-# Fetch manifest v2 and get image layer digests
-print('[+] Trying to fetch manifest for {}'.format(repository))
-auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json,application/vnd.docker.distribution.manifest.list.v2+json')
-try:
-    resp = session.get('https://{}/v2/{}/manifests/{}'.format(registry, repository, tag), headers=auth_head, verify=False, timeout=30)
-except requests.exceptions.RequestException as e:
-    print('[-] Manifest fetch error:', str(e))
-    exit(1)
-print('[+] Response status code:', resp.status_code)
-print('[+] Response headers:', resp.headers)
+def progress_bar(nb_traits):
+    bar = '=' * (nb_traits - 1) + '>' if nb_traits else ''
+    return 'Downloading [' + bar + ' ' * (49 - nb_traits) + ']'
 
-if resp.status_code != 200:
-    print('[-] Cannot fetch manifest for {} [HTTP {}]'.format(repository, resp.status_code))
-    print(resp.content)
-    exit(1)
+# Incremental gunzip, layers may be made of several concatenated gzip members
+class GunzipStream(object):
+    def __init__(self):
+        self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.started = False
 
-content_type = resp.headers.get('content-type', '')
-print('[+] Content type:', content_type)
+    def decompress(self, data):
+        out = []
+        while data:
+            self.started = True
+            out.append(self.d.decompress(data))
+            if self.d.eof:
+                data = self.d.unused_data
+                self.d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.started = False
+            else:
+                data = b''
+        return b''.join(out)
 
-try:
-    resp_json = resp.json()
-    print('[+] Response JSON structure:')
-    print(json.dumps(resp_json, indent=2))
-    
-    # Handle manifest list (multi-arch images)
-    if 'manifests' in resp_json:
-        print('[+] This is a multi-arch image. Available platforms:')
-        for m in resp_json['manifests']:
-            if 'platform' in m:
-                print('    - {}/{} ({})'.format(
-                    m['platform'].get('os', 'unknown'),
-                    m['platform'].get('architecture', 'unknown'),
-                    m['digest']
-                ))
-        
-        # Try to find linux/amd64 platform first, then fall back to windows/amd64
-        selected_manifest = None
-        for m in resp_json['manifests']:
-            platform = m.get('platform', {})
-            if platform.get('os') == image_os and platform.get('architecture') == image_arch:
-            # if platform.get('os') == 'linux' and platform.get('architecture') == 'arm64':
-                selected_manifest = m
-                break
-        
-        if not selected_manifest:
-            for m in resp_json['manifests']:
-                platform = m.get('platform', {})
-                if platform.get('os') == 'windows' and platform.get('architecture') == 'amd64':
-                    selected_manifest = m
+    def flush(self):
+        out = self.d.flush()
+        if self.started and not self.d.eof:
+            raise zlib.error('truncated gzip stream')
+        return out
+
+# Same as GunzipStream for zstd layers, which may also hold several frames
+class ZstdStream(object):
+    def __init__(self):
+        self.dctx = zstandard.ZstdDecompressor()
+        self.d = self.dctx.decompressobj()
+        self.started = False
+
+    def decompress(self, data):
+        out = []
+        while data:
+            self.started = True
+            out.append(self.d.decompress(data))
+            if self.d.eof:
+                data = self.d.unused_data
+                self.d = self.dctx.decompressobj()
+                self.started = False
+            else:
+                data = b''
+        return b''.join(out)
+
+    def flush(self):
+        if self.started:
+            raise zstandard.ZstdError('truncated zstd stream')
+        return b''
+
+# Layers that are not compressed at all
+class PlainStream(object):
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+DECOMPRESS_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard else ())
+
+def is_zstd(media_type):
+    return media_type.endswith('+zstd')
+
+# Decompressor of a layer according to its media type
+def layer_decompressor(media_type):
+    if is_zstd(media_type):
+        return ZstdStream()
+    if media_type.endswith('.tar'):
+        return PlainStream()
+    return GunzipStream() # tar.gzip, tar+gzip and the docker v1 defaults
+
+# Hasher matching the algorithm of a digest like sha256:abc...
+def blob_hasher(digest):
+    return hashlib.new(digest.split(':', 1)[0])
+
+# docker load compatible tar, written member by member straight to the output.
+# Unlike tarfile, a member can be started before its size is known (the header
+# is patched afterwards), which needs a seekable output.
+# Layout depends on format: 'docker' and 'legacy' hold one <layer id>/layer.tar per layer
+# (the blob as pulled, or uncompressed for 'legacy'), 'oci' is an OCI image layout
+# (blobs/<algo>/<hex>, index.json) with a manifest.json that docker load also reads
+class ImageArchive(object):
+    def __init__(self, fileobj, path=None, final_path=None, format='docker'):
+        self.f = fileobj
+        self.path = path # None for stdout
+        # Renamed to final_path once complete, which may well be a --base archive being read
+        self.final_path = final_path or path
+        self.format = format
+        try:
+            self.seekable = fileobj.seekable()
+        except (AttributeError, OSError):
+            self.seekable = False
+        # A layer's uncompressed size is only known once it has been fully decompressed, so
+        # a pipe gets the verified compressed blobs as layer.tar (docker load decompresses them)
+        self.keep_compressed = format != 'legacy' or not self.seekable
+        self.lock = threading.Lock()
+        self.mtime = int(time.time())
+        self.offset = 0
+        self.member = None
+        self.members = {} # name -> (data offset, size)
+        # manifest.json entries and repositories of the images stored in the archive
+        self.manifest = []
+        self.repositories = {}
+        self.index = [] # index.json manifests of the 'oci' format
+
+    def _write(self, data):
+        self.f.write(data)
+        self.offset += len(data)
+
+    def _header(self, name, size, type=tarfile.REGTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.size = size
+        info.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+        info.mtime = self.mtime
+        return info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+
+    def has(self, name):
+        return name in self.members
+
+    def add_dir(self, name):
+        if not self.has(name):
+            self._write(self._header(name, 0, tarfile.DIRTYPE))
+            self.members[name] = (self.offset, 0)
+
+    def add_file(self, name, data):
+        self.begin(name, len(data))
+        self.write(data)
+        self.end()
+
+    # Member name of a blob in the 'oci' format, creating its folders
+    def blob_member(self, digest):
+        algo, hexdigest = digest.split(':', 1)
+        self.add_dir('blobs')
+        self.add_dir('blobs/' + algo)
+        return 'blobs/{}/{}'.format(algo, hexdigest)
+
+    # Member to write a layer to, along with the files going with it
+    def layer_member(self, layer_id, digest):
+        if self.format == 'oci':
+            return self.blob_member(digest)
+        self.add_dir(layer_id)
+        if not self.has(layer_id + '/VERSION'):
+            self.add_file(layer_id + '/VERSION', b'1.0')
+        return layer_id + '/layer.tar'
+
+    def config_member(self, digest):
+        if self.format == 'oci':
+            return self.blob_member(digest)
+        return digest.split(':', 1)[1] + '.json'
+
+    def begin(self, name, size=None):
+        if size is None and not self.seekable:
+            raise ValueError('member size must be known on a non seekable output')
+        pos = self.offset
+        self._write(self._header(name, size or 0))
+        self.member = [name, size, pos, 0]
+
+    def write(self, data):
+        self._write(data)
+        self.member[3] += len(data)
+
+    def end(self):
+        name, size, pos, written = self.member
+        if size is not None and written != size:
+            raise ValueError('{} should hold {} bytes, got {}'.format(name, size, written))
+        self._write(b'\0' * (-written % tarfile.BLOCKSIZE))
+        if size is None:
+            self.f.seek(pos)
+            self.f.write(self._header(name, written))
+            self.f.seek(0, os.SEEK_END)
+        self.members[name] = (pos + tarfile.BLOCKSIZE, written)
+        self.member = None
+
+    # Drop the member being written, False when the output cannot seek back to its header
+    def rollback(self):
+        if self.member is None:
+            return True
+        if not self.seekable:
+            return False
+        pos = self.member[2]
+        self.f.seek(pos)
+        self.f.truncate()
+        self.offset = pos
+        self.member = None
+        return True
+
+    # Where a finished member's data lives in the archive file, for copy_member()
+    def region(self, name):
+        with self.lock:
+            self.f.flush()
+            return self.members[name]
+
+    # Copy data of another archive file (a region() of it) as a new member,
+    # so a layer shared by several images is neither downloaded nor decompressed again
+    def copy_member(self, path, region, name, hasher=None):
+        offset, size = region
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.begin(name, size)
+            while size:
+                chunk = f.read(min(size, 1024 * 1024))
+                if not chunk:
+                    raise ValueError('{} is truncated'.format(path))
+                if hasher:
+                    hasher.update(chunk)
+                self.write(chunk)
+                size -= len(chunk)
+            self.end()
+
+    def close(self):
+        if self.format == 'oci':
+            self.add_file('oci-layout', json.dumps({'imageLayoutVersion': '1.0.0'}).encode('utf-8'))
+            self.add_file('index.json', json.dumps({
+                'schemaVersion': 2,
+                'mediaType': 'application/vnd.oci.image.index.v1+json',
+                'manifests': self.index
+                }).encode('utf-8'))
+        self.add_file('manifest.json', json.dumps(self.manifest).encode('utf-8'))
+        if self.format != 'oci': # Only read by docker load for archives without manifest.json
+            self.add_file('repositories', json.dumps(self.repositories).encode('utf-8'))
+        self._write(b'\0' * (2 * tarfile.BLOCKSIZE))
+        self.f.flush()
+        if self.path:
+            self.f.close()
+            os.replace(self.path, self.final_path)
+
+    # Remove a partially written archive
+    def discard(self):
+        if self.path:
+            self.f.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+# Size like 512M or 20G to bytes
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# Persistent blob cache keyed by digest (<dir>/sha256/<hex>). Blobs are added with an
+# atomic rename and eviction runs under a file lock, so concurrent pulls can share it.
+# The mtime of a blob is its last use, which drives the LRU eviction
+class BlobCache(object):
+    def __init__(self, path, max_size, log=print):
+        self.path = path
+        self.max_size = max_size
+        self.log = log
+        self.stats_lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.hit_bytes = self.miss_bytes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def blob_path(self, digest):
+        algo, hexdigest = digest.split(':', 1)
+        return os.path.join(self.path, algo, hexdigest)
+
+    def count(self, hit, size):
+        with self.stats_lock:
+            if hit:
+                self.hits += 1
+                self.hit_bytes += size
+            else:
+                self.misses += 1
+                self.miss_bytes += size
+
+    # Open a cached blob after checking it still matches its digest, None on a miss
+    def get(self, digest):
+        path = self.blob_path(digest)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        hasher = blob_hasher(digest)
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+        if hasher.hexdigest() != digest.split(':', 1)[1]:
+            self.log('[-] Dropping corrupted cache entry', digest)
+            f.close()
+            self.discard(digest)
+            return None
+        f.seek(0)
+        try:
+            os.utime(path)
+        except OSError: # Evicted meanwhile, the open file is still readable
+            pass
+        return f
+
+    def discard(self, digest):
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError:
+            pass
+
+    # File to fill while downloading, then commit() or abort(). When resumable and no other
+    # pull holds it, this is <hex>.partial, whose content (if any) the next run resumes from
+    def writer(self, digest, resumable=True):
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if resumable and fcntl:
+            tmp = open(path + '.partial', 'a+b') # Appends always go to the end
+            try:
+                fcntl.flock(tmp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return tmp
+            except OSError:
+                tmp.close()
+        return tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp-', delete=False)
+
+    # Rename/remove before closing, so the .partial lock is held until it is gone
+    def commit(self, digest, tmp):
+        tmp.flush()
+        os.replace(tmp.name, self.blob_path(digest))
+        tmp.close()
+        self.evict()
+
+    def abort(self, tmp):
+        self.abort_path(tmp.name)
+        tmp.close()
+
+    def abort_path(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # Whole blob at once: a fresh temp file, a leftover .partial would get it appended
+    def put(self, digest, data):
+        tmp = self.writer(digest, resumable=False)
+        tmp.write(data)
+        self.commit(digest, tmp)
+
+    def evict(self):
+        with open(os.path.join(self.path, 'lock'), 'w') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            blobs = []
+            for algo in os.listdir(self.path):
+                folder = os.path.join(self.path, algo)
+                if not os.path.isdir(folder):
+                    continue
+                for name in os.listdir(folder):
+                    try:
+                        st = os.stat(os.path.join(folder, name))
+                    except OSError:
+                        continue
+                    if name.startswith('.tmp-') or name.endswith('.partial'):
+                        # Leftover of a killed pull, live downloads keep touching theirs
+                        if st.st_mtime < time.time() - 24 * 3600:
+                            self.abort_path(os.path.join(folder, name))
+                        continue
+                    blobs.append((st.st_mtime, st.st_size, os.path.join(folder, name)))
+            total = sum(b[1] for b in blobs)
+            for mtime, size, path in sorted(blobs):
+                if total <= self.max_size:
                     break
-        
-        if not selected_manifest:
-            # If no preferred platform found, use the first one
-            selected_manifest = resp_json['manifests'][0]
-        
-        print('[+] Selected platform: {}/{}'.format(
-            selected_manifest['platform'].get('os', 'unknown'),
-            selected_manifest['platform'].get('architecture', 'unknown')
-        ))
-        
-        # Fetch the specific manifest
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+# Layers of archives from previous pulls (--base) indexed by diff_id, the digest of
+# the uncompressed layer listed in the image config, so that unchanged layers can
+# be copied from there instead of being downloaded again. The blobs of OCI layouts
+# are also indexed by digest, for the 'oci' format which needs the blob as pulled
+class BaseArchives(object):
+    def __init__(self, paths, log=print):
+        self.layers = {} # diff_id -> (archive path, data offset, size)
+        self.blobs = {} # digest -> (archive path, data offset, size)
+        self.reused = 0
+        self.reused_bytes = 0
+        self.lock = threading.Lock()
+        for path in paths:
+            try:
+                self.load(path)
+            except KeyError as e:
+                raise BaseArchiveError('Base archive {} is not an image archive, {} is missing'.format(path, e))
+            except (tarfile.TarError, OSError, ValueError, TypeError, AttributeError) as e:
+                raise BaseArchiveError('Cannot read base archive {}: {}'.format(path, e))
+            log('[+] Base archive {}: {} layers'.format(path, len(self.layers)))
+
+    def load(self, path):
+        with tarfile.open(path) as tar:
+            members = {os.path.normpath(m.name).lstrip('/'): m for m in tar.getmembers()}
+            manifest = json.load(tar.extractfile(members['manifest.json']))
+            for entry in manifest:
+                config = json.load(tar.extractfile(members[os.path.normpath(entry['Config'])]))
+                rootfs = config.get('rootfs') or config.get('rootfS')
+                for diff_id, layer in zip(rootfs['diff_ids'], entry['Layers']):
+                    name = os.path.normpath(layer)
+                    member = members[name]
+                    if member.issym(): # docker save links layers it already stored
+                        member = members[os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))]
+                    location = (path, member.offset_data, member.size)
+                    self.layers.setdefault(diff_id, location)
+                    if name.startswith('blobs/') and name.count('/') == 2:
+                        self.blobs.setdefault(':'.join(name.split('/')[1:]), location)
+
+    def count(self, size):
+        with self.lock:
+            self.reused += 1
+            self.reused_bytes += size
+
+
+# Status of every layer, shown according to the client's progress mode:
+# - tty: one line per layer, redrawn in place at most every TTY_INTERVAL seconds
+# - plain: a line per status change, progress bars are skipped
+# - json: events on stderr, progress ones at most every JSON_INTERVAL seconds per layer
+# - none: nothing
+class ProgressBoard(object):
+    TTY_INTERVAL = 0.1
+    JSON_INTERVAL = 1.0
+
+    def __init__(self, client, blobs):
+        self.client = client
+        self.lock = threading.Lock()
+        self.blobs = list(blobs)
+        self.lines = [ublob[7:19] + ': Waiting' for ublob in self.blobs]
+        self.dirty = False
+        self.last_draw = 0.0
+        self.last_event = [0.0] * len(self.blobs)
+        mode = client.progress
+        if mode == 'auto':
+            # Lines scrolled out of the terminal cannot be redrawn, print status changes instead
+            mode = 'tty' if sys.stdout.isatty() and len(self.blobs) < shutil.get_terminal_size().lines else 'plain'
+        self.mode = 'none' if client.quiet else mode
+        if self.mode == 'tty':
+            sys.stdout.write(''.join(line + '\n' for line in self.lines))
+            sys.stdout.flush()
+
+    def update(self, idx, status, transient=False, **fields):
+        now = time.time()
+        with self.lock:
+            if self.mode == 'tty':
+                self.lines[idx] = '{}: {}'.format(self.blobs[idx][7:19], status)
+                self.dirty = True
+                if not transient or now - self.last_draw >= self.TTY_INTERVAL:
+                    self.draw(now)
+            elif self.mode == 'json':
+                if not transient or now - self.last_event[idx] >= self.JSON_INTERVAL:
+                    self.last_event[idx] = now
+                    self.client.event('layer', digest=self.blobs[idx], status=status, **fields)
+            elif self.mode == 'plain' and not transient: # Bars are only useful on a terminal
+                print('{}: {}'.format(self.blobs[idx][7:19], status))
+
+    # Rewrite the whole board: move up to its first line and come back down
+    def draw(self, now):
+        sys.stdout.write('\033[{}A\r'.format(len(self.lines)) + ''.join(line + '\033[K\n' for line in self.lines))
+        sys.stdout.flush()
+        self.last_draw = now
+        self.dirty = False
+
+    # Show the statuses skipped by the throttling
+    def close(self):
+        with self.lock:
+            if self.mode == 'tty' and self.dirty:
+                self.draw(time.time())
+
+# Bearer tokens cached per scope, a new one is only requested shortly before the
+# current one expires or when the registry rejects it
+class TokenManager(object):
+    # Refresh that many seconds before expiry (at most a quarter of the token lifetime)
+    REFRESH_MARGIN = 30
+
+    def __init__(self, session, auth_url, service):
+        self.session = session
+        self.auth_url = auth_url
+        self.service = service
+        self.lock = threading.Lock()
+        self.tokens = {} # scope -> (token, refresh_at)
+        self.requests = 0
+
+    # issued_at is RFC3339, possibly with nanoseconds ("2024-01-01T00:00:00.123456789Z")
+    @staticmethod
+    def parse_issued_at(text):
         try:
-            # Get fresh auth token for manifest
-            manifest_auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json')
-            manifest_resp = session.get(
-                'https://{}/v2/{}/manifests/{}'.format(registry, repository, selected_manifest['digest']),
-                headers=manifest_auth_head,  # 使用新的认证头
-                verify=False,
-                timeout=30
-            )
-            if manifest_resp.status_code != 200:
-                print('[-] Failed to fetch specific manifest:', manifest_resp.status_code)
-                print('[-] Response content:', manifest_resp.content)
-                exit(1)
-            resp_json = manifest_resp.json()
-            print('[+] Successfully fetched specific manifest')
-        except Exception as e:
-            print('[-] Error fetching specific manifest:', e)
-            exit(1)
-    
-    # Now we should have the actual manifest with layers
-    if 'layers' not in resp_json:
-        print('[-] Error: No layers found in manifest')
-        print('[-] Available keys:', list(resp_json.keys()))
-        exit(1)
-    
-    layers = resp_json['layers']
-    
-except KeyError as e:
-    print('[-] Error: Could not find required key in response:', e)
-    print('[-] Available keys:', list(resp_json.keys()))
-    exit(1)
-except Exception as e:
-    print('[-] Unexpected error:', e)
-    exit(1)
-
-# Create tmp directory if it doesn't exist
-img_dir = 'tmp'
-if not os.path.exists(img_dir):
-    print('[+] Creating temporary directory:', img_dir)
-    os.makedirs(img_dir)
-
-config = resp_json['config']['digest']
-try:
-    conf_resp = session.get('https://{}/v2/{}/blobs/{}'.format(registry, repository, config), headers=auth_head, verify=False, timeout=30)
-except requests.exceptions.RequestException as e:
-    print('[-] Config fetch error:', str(e))
-    exit(1)
-file = open('{}/{}.json'.format(img_dir, config[7:]), 'wb')
-file.write(conf_resp.content)
-file.close()
-
-content = [{
-    'Config': config[7:] + '.json',
-    'RepoTags': [ ],
-    'Layers': [ ]
-    }]
-if len(img_parts[:-1]) != 0:
-    content[0]['RepoTags'].append('/'.join(img_parts[:-1]) + '/' + img + ':' + tag)
-else:
-    content[0]['RepoTags'].append(img + ':' + tag)
+            text = re.sub(r'(\.\d+)', '', text).replace('Z', '+00:00')
+            return datetime.fromisoformat(text).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def token(self, scope, metrics=None):
+        with self.lock: # Workers needing a token at the same time wait for a single request
+            cached = self.tokens.get(scope)
+            if cached and time.time() < cached[1]:
+                return cached[0]
+            start = time.time()
+            response = self.session.get('{}?service={}&scope={}'.format(self.auth_url, self.service, scope),
+                                        verify=False, timeout=30)
+            if metrics:
+                metrics.add_phase('auth', time.time() - start)
+            self.requests += 1
+            data = response.json()
+            access_token = data.get('token') or data['access_token']
+            expires_in = int(data.get('expires_in') or 60) # Default lifetime of the token spec
+            expires_at = start + expires_in
+            issued_at = self.parse_issued_at(data.get('issued_at'))
+            if issued_at:
+                # Trust whichever clock expires first
+                expires_at = min(expires_at, issued_at + expires_in)
+            self.tokens[scope] = (access_token, expires_at - min(self.REFRESH_MARGIN, expires_in / 4))
+            return access_token
+
+    # Forget a token the registry answered 401 to, unless it was already replaced
+    def invalidate(self, scope, access_token):
+        with self.lock:
+            if scope in self.tokens and self.tokens[scope][0] == access_token:
+                del self.tokens[scope]
+
+# Docker registry endpoint: probed once, then shared by every image pulled from it
+class Registry(object):
+    # Weight of the last observation in the moving averages
+    HEALTH_ALPHA = 0.3
+    # Blobs are ranked by the time it would take to fetch that many bytes
+    COST_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, session, host):
+        self.session = session
+        self.host = host
+        # Health seen by the blob downloads, used to rank mirrors: moving averages of the
+        # time to the response headers and of the transfer rate, failures since the last success
+        self.health_lock = threading.Lock()
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.bytes = 0
+        # Get Docker authentication endpoint when it is required
+        auth_url = 'https://auth.docker.io/token'
+        reg_service = 'registry.docker.io'
+        try:
+            resp = session.get('https://{}/v2/'.format(host), verify=False, timeout=30)
+            if resp.status_code == 401:
+                auth_url = resp.headers['WWW-Authenticate'].split('"')[1]
+                try:
+                    reg_service = resp.headers['WWW-Authenticate'].split('"')[3]
+                except IndexError:
+                    reg_service = ""
+        except requests.exceptions.RequestException as e:
+            raise RegistryConnectionError('Connection error to {}: {}'.format(host, e))
+        self.tokens = TokenManager(session, auth_url, reg_service)
+
+    # Get Docker token (this function is useless for unauthenticated registries like Microsoft)
+    def get_auth_head(self, repository, auth_type, metrics=None):
+        try:
+            access_token = self.tokens.token('repository:{}:pull'.format(repository), metrics)
+            head = {'Authorization':'Bearer '+ access_token, 'Accept': auth_type}
+            return head
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            raise AuthenticationError('Authentication error: {}'.format(e))
+
+    # GET with the cached token, when it is rejected (revoked, clock skew) a new one is fetched once
+    def get(self, url, repository, auth_type, headers=None, metrics=None, **kwargs):
+        for attempt in range(2):
+            head = self.get_auth_head(repository, auth_type, metrics)
+            head.update(headers or {})
+            resp = self.session.get(url, headers=head, verify=False, timeout=30, **kwargs)
+            if resp.status_code != 401 or attempt:
+                return resp
+            self.tokens.invalidate('repository:{}:pull'.format(repository), head['Authorization'][7:])
+
+    def record(self, latency=None, nbytes=0, seconds=0.0):
+        alpha = self.HEALTH_ALPHA
+        with self.health_lock:
+            if latency is not None:
+                self.failures = 0
+                self.latency = latency if self.latency is None else alpha * latency + (1 - alpha) * self.latency
+            self.bytes += nbytes
+            # Short transfers say more about the latency than about the bandwidth
+            if nbytes >= 256 * 1024 and seconds > 0:
+                rate = nbytes / seconds
+                self.throughput = rate if self.throughput is None else alpha * rate + (1 - alpha) * self.throughput
+
+    def record_failure(self):
+        with self.health_lock:
+            self.failures += 1
+
+    # Expected seconds to fetch COST_SIZE bytes, doubled by every recent failure.
+    # Registries not tried yet cost nothing so that they get measured
+    def cost(self):
+        with self.health_lock:
+            if self.latency is None:
+                cost = 1.0 if self.failures else 0.0
+            else:
+                cost = self.latency + (self.COST_SIZE / self.throughput if self.throughput else 0.0)
+            return (cost + 0.01) * 2 ** min(self.failures, 10)
+
+    def health(self):
+        with self.health_lock:
+            return {'latency': self.latency, 'throughput': self.throughput, 'failures': self.failures,
+                    'bytes': self.bytes}
+
+# One image to pull: its name parts, then its manifest, config and layers once resolved
+class Image(object):
+    def __init__(self, name):
+        # Look for the Docker image to download
+        self.name = name
+        repo = 'library'
+        tag = 'latest'
+        img_parts = name.split('/')
+        try:
+            img, tag = img_parts[-1].split('@')
+        except ValueError:
+            try:
+                img, tag = img_parts[-1].split(':')
+            except ValueError:
+                img = img_parts[-1]
+        # Docker client doesn't seem to consider the first element as a potential registry unless there is a '.' or ':'
+        if len(img_parts) > 1 and ('.' in img_parts[0] or ':' in img_parts[0]):
+            registry = img_parts[0]
+            repo = '/'.join(img_parts[1:-1])
+        else:
+            registry = 'registry-1.docker.io'
+            if len(img_parts[:-1]) != 0:
+                repo = '/'.join(img_parts[:-1])
+            else:
+                repo = 'library'
+        self.img_parts = img_parts
+        self.img = img
+        self.tag = tag
+        self.repo = repo
+        self.registry_host = registry
+        self.repository = '{}/{}'.format(repo, img)
+        self.registry = None # None when only its mirrors answered
+        self.sources = [] # mirrors then the registry itself, the reachable ones
+        self.metrics = None
+        self.archive = None
+        self.layers = []
+        self.layer_ids = []
+        self.layer_paths = [] # archive member holding each layer
+        self.config = None
+        self.config_blob = None
+        self.diff_ids = []
+        # Image manifest as served by the registry, stored as is by the 'oci' format
+        self.manifest_blob = None
+        self.manifest_type = None
+
+    def get(self, registry, url, auth_type, headers=None, **kwargs):
+        return registry.get(url, self.repository, auth_type, headers, self.metrics, **kwargs)
+
+    def default_tar(self):
+        return self.repo.replace('/', '_') + '_' + self.img + '.tar'
+
+    # Name used in RepoTags and repositories
+    def repo_name(self):
+        if len(self.img_parts[:-1]) != 0:
+            return '/'.join(self.img_parts[:-1]) + '/' + self.img
+        return self.img
+
+    # Fully qualified name of the index.json annotations, like docker.io/library/busybox:latest
+    def full_name(self):
+        host = 'docker.io' if self.registry_host == 'registry-1.docker.io' else self.registry_host
+        separator = '@' if ':' in self.tag else ':'
+        return '{}/{}{}{}'.format(host, self.repository, separator, self.tag)
+
+# Image manifests and the manifest lists (indexes) pointing to one per platform,
+# in their docker v2 and OCI flavours
+MANIFEST_TYPES = 'application/vnd.oci.image.manifest.v1+json,application/vnd.docker.distribution.manifest.v2+json'
+INDEX_TYPES = 'application/vnd.oci.image.index.v1+json,application/vnd.docker.distribution.manifest.list.v2+json'
+
+# Index entries that are not images (build attestations of buildkit)
+def is_attestation(m):
+    return (m.get('annotations', {}).get('vnd.docker.reference.type') == 'attestation-manifest'
+            or m.get('platform', {}).get('os') == 'unknown')
 
 empty_json = '{"created":"1970-01-01T00:00:00Z","container_config":{"Hostname":"","Domainname":"","User":"","AttachStdin":false, \
     "AttachStdout":false,"AttachStderr":false,"Tty":false,"OpenStdin":false, "StdinOnce":false,"Env":null,"Cmd":null,"Image":"", \
     "Volumes":null,"WorkingDir":"","Entrypoint":null,"OnBuild":null,"Labels":null}}'
 
-# Build layer folders
-parent_id=''
-for layer in layers:
-    ublob = layer['digest']
-    # FIXME: Creating fake layer ID. Don't know how Docker generates it
-    fake_layer_id = hashlib.sha256((parent_id+'\n'+ublob+'\n').encode('utf-8')).hexdigest()
-    layer_dir = img_dir + '/' + fake_layer_id
-    os.mkdir(layer_dir)
-
-    # Creating VERSION file
-    file = open(layer_dir + '/VERSION', 'w')
-    file.write('1.0')
-    file.close()
-
-    # Creating layer.tar file
-    sys.stdout.write(ublob[7:19] + ': Downloading...')
-    sys.stdout.flush()
-    auth_head = get_auth_head('application/vnd.docker.distribution.manifest.v2+json') # refreshing token to avoid its expiration
-    try:
-        b_resp = session.get('https://{}/v2/{}/blobs/{}'.format(registry, repository, ublob), headers=auth_head, stream=True, verify=False, timeout=30)
-    except requests.exceptions.RequestException as e:
-        print('[-] Layer fetch error:', str(e))
-        exit(1)
-    if b_resp.status_code != 200: # When the layer is located at a custom URL
+# Layers finishing while another one is being written wait in memory, then on disk
+SPOOL_MAX_MEMORY = 64 * 1024 * 1024
+# Broken connections are resumed with a Range request this many times per blob
+MAX_RESUMES = 5
+# Segmented downloads only kick in for blobs holding at least two segments of that size
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'docker_pull')
+# Manifests are requested from that many sources at once
+MANIFEST_RACE = 3
+# An unreachable registry is not probed again before that many seconds
+UNREACHABLE_DELAY = 60
+
+# Mirrors like [REGISTRY=]HOST (REGISTRY defaults to Docker Hub) to {registry: [hosts]}
+def parse_mirrors(mirrors):
+    parsed = {}
+    for mirror in mirrors:
+        registry, _, host = mirror.rpartition('=')
+        if registry in ('', 'docker.io', 'index.docker.io'):
+            registry = 'registry-1.docker.io'
+        parsed.setdefault(registry, []).append(host.rstrip('/'))
+    return parsed
+
+# Long lived puller: the HTTP connection pool, the probed registries with their tokens
+# and the blob cache are kept from one pull() to the next, and may be shared by threads
+class RegistryClient(object):
+    def __init__(self, jobs=1, segments=1, platform='linux/amd64', cache_dir=DEFAULT_CACHE_DIR,
+                 cache_size='20G', no_cache=False, progress='none', quiet=True, mirrors=()):
+        if jobs < 1 or segments < 1:
+            raise ValueError('jobs and segments must be at least 1')
+        self.jobs = jobs
+        self.segments = segments
+        parts = platform.split('/')
+        self.os = parts[0]
+        self.arch = parts[1]
+        self.variant = parts[2] if len(parts) > 2 else None
+        self.progress = progress # auto, tty, plain, json or none
+        self.quiet = quiet
+        self.events_lock = threading.Lock()
+        self.events_start = time.time()
+        # Mirrors tried before each registry, in order of preference
+        self.mirrors = parse_mirrors(mirrors)
+        # Create a session for all requests (shared by the download workers). With mirrors, a
+        # failing host is left for the next one instead of being retried
+        self.session = create_session(max(10, jobs * segments), 1 if self.mirrors else 3)
+        if self.session.proxies:
+            self.log('[+] Using proxy settings from environment')
+        self.registries = {}
+        self.unreachable = {} # host -> (time of the failed probe, error)
+        self.registries_lock = threading.Lock()
+        # Runs the manifest requests raced between sources
+        self.race_pool = ThreadPoolExecutor(max_workers=MANIFEST_RACE * max(4, jobs)) if self.mirrors else None
+        self.cache = None
+        if not no_cache:
+            if isinstance(cache_size, str):
+                cache_size = parse_size(cache_size)
+            self.cache = BlobCache(cache_dir, cache_size, self.log)
+
+    # JSON lines on stderr for the json progress mode
+    def event(self, name, **fields):
+        if self.progress == 'json':
+            fields = dict(event=name, time=round(time.time() - self.events_start, 3), **fields)
+            with self.events_lock:
+                sys.stderr.write(json.dumps(fields) + '\n')
+                sys.stderr.flush()
+
+    # Informational messages, silenced by quiet and turned into events by the json mode
+    def log(self, *values):
+        if self.quiet:
+            return
+        if self.progress == 'json':
+            self.event('log', message=' '.join(str(v) for v in values))
+        else:
+            print(*values)
+
+    def registry(self, host, metrics=None):
+        with self.registries_lock:
+            if host not in self.registries:
+                failed = self.unreachable.get(host)
+                if failed and time.time() - failed[0] < UNREACHABLE_DELAY:
+                    raise failed[1]
+                self.log('[+] Connecting to registry: {}'.format(host))
+                start = time.time()
+                try:
+                    self.registries[host] = Registry(self.session, host)
+                except RegistryConnectionError as e:
+                    self.unreachable[host] = (time.time(), e)
+                    raise
+                finally:
+                    if metrics:
+                        metrics.add_phase('probe', time.time() - start)
+            return self.registries[host]
+
+    # Reachable mirrors of a registry followed by the registry itself
+    def sources(self, host, metrics=None):
+        sources = []
+        error = None
+        for source in self.mirrors.get(host, []) + [host]:
+            try:
+                sources.append(self.registry(source, metrics))
+            except RegistryConnectionError as e:
+                if host in self.mirrors:
+                    self.log('[*] Skipping {}: {}'.format(source, e))
+                error = e
+        if not sources:
+            raise error
+        return sources
+
+    # Sources from the healthiest to the least healthy one, leaving out those to avoid
+    @staticmethod
+    def rank(sources, avoid=()):
+        return sorted((r for r in sources if r not in avoid), key=lambda r: r.cost())
+
+    # Pull images (names or a single name) into docker load archives and return the metrics
+    # summary, with the 'archives' written. output is a path holding every image, a binary
+    # file object (like sys.stdout.buffer), or None for one <repo>_<image>.tar per image.
+    # format is 'docker', 'oci' or 'legacy', base lists archives of previous pulls
+    def pull(self, names, output=None, format='docker', base=(), metrics_json=None):
+        if isinstance(names, str):
+            names = [names]
+        return PullRun(self, names, output, format, base, metrics_json).run()
+
+    def close(self):
+        if self.race_pool:
+            self.race_pool.shutdown(wait=False)
+        self.session.close()
+
+# State of one pull() call
+class PullRun(object):
+    def __init__(self, client, names, output, format, base, metrics_json):
+        self.client = client
+        self.cache = client.cache
+        self.log = client.log
+        self.format = format
+        self.metrics_json = metrics_json
+        self.metrics = Metrics(client.event)
+        self.images = [Image(name) for name in names]
+        for image in self.images:
+            image.metrics = self.metrics
+        self.output = output
+        self.base_paths = list(base)
+        self.base = None
+        self.archives = []
+        self.jobs = [] # (image, layer index) of every layer to fetch
+        self.progress = None
+        # Blobs shared by several images (or repeated in one) are only fetched once: the first job
+        # asking for a digest pulls it, the others wait for it and reuse its archive member
+        self.pulled_layers = {} # digest -> (archive, member name)
+        self.pulling = {} # digest -> threading.Event set once the pull is over
+        self.pulled_lock = threading.Lock()
+        self.auth_requests = 0
+
+    # Open the output archives, nothing is staged on disk: one per image, or a single one
+    # holding every image when output is given. Files are written as <name>.part and
+    # only renamed when complete
+    def open_archives(self):
+        output = self.output
+        if output is not None and not isinstance(output, str):
+            self.archives.append(ImageArchive(output, format=self.format))
+        elif output:
+            self.archives.append(ImageArchive(open(output + '.part', 'wb'), output + '.part', output, self.format))
+        if self.archives:
+            for image in self.images:
+                image.archive = self.archives[0]
+        else:
+            tar_names = set()
+            for image in self.images:
+                docker_tar = image.default_tar()
+                if docker_tar in tar_names: # Same repository, another tag
+                    docker_tar = docker_tar[:-4] + '_' + re.sub(r'[^\w.-]', '_', image.tag) + '.tar'
+                tar_names.add(docker_tar)
+                image.archive = ImageArchive(open(docker_tar + '.part', 'wb'), docker_tar + '.part', docker_tar,
+                                             self.format)
+                self.archives.append(image.archive)
+        if self.format == 'legacy' and self.archives[0].keep_compressed:
+            self.log('[+] Output is not seekable, layers are stored compressed')
+
+    def run(self):
+        client = self.client
+        # The client counters cover every pull, the run reports its own share
+        auth_before = sum(r.tokens.requests for r in client.registries.values())
+        self.cache_before = self.cache_counts()
         try:
-            b_resp = session.get(layer['urls'][0], headers=auth_head, stream=True, verify=False, timeout=30)
-        except requests.exceptions.RequestException as e:
-            print('[-] Layer fetch error:', str(e))
-            exit(1)
-        if b_resp.status_code != 200:
-            print('\rERROR: Cannot download layer {} [HTTP {}]'.format(ublob[7:19], b_resp.status_code, b_resp.headers['Content-Length']))
-            print(b_resp.content)
-            exit(1)
-    # Stream download and follow the progress
-    b_resp.raise_for_status()
-    unit = int(b_resp.headers['Content-Length']) / 50
-    acc = 0
-    nb_traits = 0
-    progress_bar(ublob, nb_traits)
-    with open(layer_dir + '/layer_gzip.tar', "wb") as file:
-        for chunk in b_resp.iter_content(chunk_size=8192):
-            if chunk:
-                file.write(chunk)
-                acc = acc + 8192
-                if acc > unit:
-                    nb_traits = nb_traits + 1
-                    progress_bar(ublob, nb_traits)
-                    acc = 0
-    sys.stdout.write("\r{}: Extracting...{}".format(ublob[7:19], " "*50)) # Ugly but works everywhere
-    sys.stdout.flush()
-    with open(layer_dir + '/layer.tar', "wb") as file: # Decompress gzip response
-        unzLayer = gzip.open(layer_dir + '/layer_gzip.tar','rb')
-        shutil.copyfileobj(unzLayer, file)
-        unzLayer.close()
-    os.remove(layer_dir + '/layer_gzip.tar')
-    print("\r{}: Pull complete [{}]".format(ublob[7:19], b_resp.headers['Content-Length']))
-    content[0]['Layers'].append(fake_layer_id + '/layer.tar')
-
-    # Creating json file
-    file = open(layer_dir + '/json', 'w')
-    # last layer = config manifest - history - rootfs
-    if layers[-1]['digest'] == layer['digest']:
-        # FIXME: json.loads() automatically converts to unicode, thus decoding values whereas Docker doesn't
-        json_obj = json.loads(conf_resp.content)
-        del json_obj['history']
+            if self.base_paths:
+                self.base = BaseArchives(self.base_paths, self.log)
+            self.open_archives()
+            # A single pool serves the whole run: first every image is resolved, then all
+            # their layers are scheduled, shared blobs being fetched once
+            with ThreadPoolExecutor(max_workers=client.jobs) as pool:
+                # list() re-raises the first failure of a worker in the calling thread
+                list(pool.map(self.prepare_image, self.images))
+                self.jobs = [(image, idx) for image in self.images for idx in range(len(image.layers))]
+                self.progress = ProgressBoard(client, [image.layers[idx]['digest'] for image, idx in self.jobs])
+                with self.metrics.phase('layers'):
+                    list(pool.map(self.fetch_layer, range(len(self.jobs))))
+                self.progress.close()
+        except BaseException:
+            if self.progress:
+                self.progress.close()
+            # Do not leave truncated archives behind
+            for archive in self.archives:
+                archive.discard()
+            self.auth_requests = sum(r.tokens.requests for r in client.registries.values()) - auth_before
+            self.report(False)
+            raise
+
+        self.log('[+] Creating archive...')
+        with self.metrics.phase('finalize'):
+            for image in self.images:
+                self.write_image_metadata(image)
+            for archive in self.archives:
+                archive.close()
+            if self.cache:
+                self.cache.evict() # Also applies a cache size lowered since the blobs were added
+        self.auth_requests = sum(r.tokens.requests for r in client.registries.values()) - auth_before
+        return self.report(True)
+
+    def cache_counts(self):
+        cache = self.cache
+        if not cache:
+            return {}
+        return {'hits': cache.hits, 'hit_bytes': cache.hit_bytes, 'misses': cache.misses, 'miss_bytes': cache.miss_bytes}
+
+    # Summary of the run for metrics_json, the final json event and the caller
+    def report(self, ok):
+        summary = self.metrics.summary(ok)
+        summary['images'] = [image.name for image in self.images]
+        summary['archives'] = [{'path': archive.final_path,
+                                'images': [entry['RepoTags'][0] for entry in archive.manifest]}
+                               for archive in self.archives]
+        summary['auth_requests'] = self.auth_requests
+        if self.client.mirrors:
+            summary['sources'] = {registry.host: registry.health()
+                                  for image in self.images for registry in image.sources}
+        if self.base:
+            summary['base'] = {'reused': self.base.reused, 'reused_bytes': self.base.reused_bytes}
+        if self.cache:
+            summary['cache'] = {k: v - self.cache_before[k] for k, v in self.cache_counts().items()}
+        self.client.event('summary', **summary)
+        if self.metrics_json:
+            with open(self.metrics_json, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
+
+    # GET a manifest from one source, checking it against its digest when the reference is one
+    def get_manifest(self, image, registry, reference, accept):
+        resp = image.get(registry, 'https://{}/v2/{}/manifests/{}'.format(registry.host, image.repository, reference),
+                         accept)
+        if resp.status_code != 200:
+            raise ManifestError('Cannot fetch manifest for {} from {} [HTTP {}]: {}'.format(
+                image.repository, registry.host, resp.status_code, resp.content[:1024]))
+        if ':' in reference:
+            hasher = blob_hasher(reference)
+            hasher.update(resp.content)
+            if hasher.hexdigest() != reference.split(':', 1)[1]:
+                raise CorruptedBlobError('Manifest digest mismatch for {} from {}'.format(reference, registry.host))
+        if not isinstance(resp.json(), dict):
+            raise ValueError('manifest is not a JSON object')
+        return resp
+
+    # Request a manifest from the first MANIFEST_RACE sources at once, the first valid
+    # answer wins (the others are dropped when they come)
+    def race_manifest(self, image, reference, accept):
+        sources = image.sources[:MANIFEST_RACE]
+        if len(sources) == 1:
+            try:
+                return self.get_manifest(image, sources[0], reference, accept)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                raise ManifestError('Manifest fetch error for {}: {}'.format(image.repository, e))
+        futures = {self.client.race_pool.submit(self.get_manifest, image, registry, reference, accept): registry
+                   for registry in sources}
+        errors = []
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except (requests.exceptions.RequestException, ValueError, PullError) as e:
+                futures[future].record_failure()
+                errors.append('{}: {}'.format(futures[future].host, e))
+        raise ManifestError('No source answered a valid manifest for {}: {}'.format(image.repository, '; '.join(errors)))
+
+    # Fetch manifest v2 and get image layer digests
+    def fetch_manifest(self, image):
+        client = self.client
+        repository = image.repository
+        self.log('[+] Trying to fetch manifest for {}'.format(repository))
+        resp = self.race_manifest(image, image.tag, MANIFEST_TYPES + ',' + INDEX_TYPES)
+
+        content_type = resp.headers.get('content-type', '')
+        image.manifest_blob = resp.content
+        image.manifest_type = content_type.split(';')[0].strip()
+
+        try:
+            resp_json = resp.json()
+
+            # Handle manifest list / OCI index (multi-arch images)
+            if 'manifests' in resp_json:
+                candidates = [m for m in resp_json['manifests'] if not is_attestation(m)] or resp_json['manifests']
+                self.log('[+] Multi-arch image, platforms: {}'.format(', '.join(
+                    '{}/{}{}'.format(m['platform'].get('os', 'unknown'), m['platform'].get('architecture', 'unknown'),
+                                     '/' + m['platform']['variant'] if m['platform'].get('variant') else '')
+                    for m in candidates if 'platform' in m)))
+
+                # Try to find the requested platform first, then fall back to windows/amd64
+                selected_manifest = None
+                for m in candidates:
+                    platform = m.get('platform', {})
+                    if platform.get('os') == client.os and platform.get('architecture') == client.arch \
+                            and client.variant in (None, platform.get('variant')):
+                        selected_manifest = m
+                        break
+
+                if not selected_manifest:
+                    for m in candidates:
+                        platform = m.get('platform', {})
+                        if platform.get('os') == 'windows' and platform.get('architecture') == 'amd64':
+                            selected_manifest = m
+                            break
+
+                if not selected_manifest:
+                    # If no preferred platform found, use the first one
+                    selected_manifest = candidates[0]
+
+                self.log('[+] Selected platform: {}/{}'.format(
+                    selected_manifest.get('platform', {}).get('os', 'unknown'),
+                    selected_manifest.get('platform', {}).get('architecture', 'unknown')
+                ))
+
+                # Fetch the specific manifest
+                manifest_resp = self.race_manifest(image, selected_manifest['digest'],
+                                                   selected_manifest.get('mediaType') or MANIFEST_TYPES)
+                resp_json = manifest_resp.json()
+                image.manifest_blob = manifest_resp.content
+                image.manifest_type = selected_manifest.get('mediaType') or \
+                    manifest_resp.headers.get('content-type', '').split(';')[0].strip()
+
+            # Now we should have the actual manifest with layers
+            if 'layers' not in resp_json:
+                raise ManifestError('No layers found in manifest, available keys: {}'.format(list(resp_json.keys())))
+            if not image.manifest_type or image.manifest_type not in MANIFEST_TYPES.split(','):
+                image.manifest_type = resp_json.get('mediaType') or 'application/vnd.oci.image.manifest.v1+json'
+
+            return resp_json
+
+        except (KeyError, IndexError, ValueError) as e:
+            raise ManifestError('Unexpected manifest for {}: {!r}'.format(repository, e))
+
+    # Get the image config blob, from the cache when it holds it
+    def fetch_config(self, image):
+        cache = self.cache
+        config = image.config
+        cached = cache.get(config) if cache else None
+        if cached:
+            config_blob = cached.read()
+            cached.close()
+            cache.count(True, len(config_blob))
+            return config_blob
+        # Downloaded like layers (resumed after a broken connection, from the healthiest source),
+        # fetched again from the other sources when the bytes do not match the digest
+        avoid = set()
+        while True:
+            served = set()
+            try:
+                config_blob = b''.join(self.blob_chunks(image, {'digest': config}, avoid=avoid, served=served))
+            except requests.exceptions.RequestException as e:
+                raise BlobError('Config fetch error: {}'.format(e))
+            hasher = blob_hasher(config)
+            hasher.update(config_blob)
+            if hasher.hexdigest() == config.split(':', 1)[1]:
+                break
+            for registry in served:
+                registry.record_failure()
+            avoid |= served
+            if not served or not self.client.rank(image.sources, avoid):
+                raise CorruptedBlobError('Config digest mismatch for {} from {}'.format(
+                    config, ', '.join(sorted(registry.host for registry in served))))
+        if cache:
+            cache.count(False, len(config_blob))
+            cache.put(config, config_blob)
+        return config_blob
+
+    # Resolve an image down to its layers and add its config to the archive
+    def prepare_image(self, image):
+        image.sources = self.client.sources(image.registry_host, self.metrics)
+        if image.sources[-1].host == image.registry_host:
+            image.registry = image.sources[-1]
+        with self.metrics.phase('manifest'):
+            resp_json = self.fetch_manifest(image)
+        image.layers = resp_json['layers']
+        image.config = resp_json['config']['digest']
+        with self.metrics.phase('config'):
+            image.config_blob = self.fetch_config(image)
+        config_json = json.loads(image.config_blob)
+        image.diff_ids = (config_json.get('rootfs') or config_json.get('rootfS') or {}).get('diff_ids', [])
+        archive = image.archive
+        if not archive.keep_compressed and not zstandard:
+            for layer in image.layers:
+                if is_zstd(layer.get('mediaType', '')):
+                    raise PullError('Layer {} is zstd compressed: install the zstandard module, '
+                                    'or use the docker/oci format which keep it compressed'.format(layer['digest'][7:19]))
+        with archive.lock:
+            name = archive.config_member(image.config)
+            if not archive.has(name):
+                archive.add_file(name, image.config_blob)
+            if archive.format == 'oci':
+                name = archive.blob_member('sha256:' + hashlib.sha256(image.manifest_blob).hexdigest())
+                if not archive.has(name):
+                    archive.add_file(name, image.manifest_blob)
+
+        # Fake layer IDs only depend on the parent chain, so they can be computed before downloading
+        # FIXME: Creating fake layer ID. Don't know how Docker generates it
+        parent_id = ''
+        for layer in image.layers:
+            parent_id = hashlib.sha256((parent_id+'\n'+layer['digest']+'\n').encode('utf-8')).hexdigest()
+            image.layer_ids.append(parent_id)
+        image.layer_paths = [None] * len(image.layers)
+
+    # GET a blob (or the bytes start..stop-1 of it) from the healthiest source answering it,
+    # or from the custom URLs of foreign layers. The response's source is added to served
+    def request_blob(self, image, layer, start=0, stop=None, avoid=(), served=None):
+        headers = {}
+        if start or stop is not None:
+            headers['Range'] = 'bytes={}-{}'.format(start, '' if stop is None else stop - 1)
+        attempts = [(registry, 'https://{}/v2/{}/blobs/{}'.format(registry.host, image.repository, layer['digest']))
+                    for registry in self.client.rank(image.sources, avoid)]
+        attempts += [(image.registry or image.sources[-1], url) for url in layer.get('urls', [])]
+        b_resp = None
+        error = None
+        for registry, url in attempts:
+            start_time = time.time()
+            try:
+                b_resp = image.get(registry, url, 'application/vnd.docker.distribution.manifest.v2+json', headers, stream=True)
+            except requests.exceptions.RequestException as e:
+                registry.record_failure()
+                error = e
+                continue
+            if b_resp.status_code in (200, 206):
+                registry.record(latency=time.time() - start_time)
+                b_resp.source = registry
+                if served is not None:
+                    served.add(registry)
+                return b_resp
+            registry.record_failure()
+        if b_resp is None:
+            if error is None:
+                raise BlobError('Layer {} is not available from any source'.format(layer['digest'][7:19]))
+            raise error # Every source is unreachable, blob_chunks() tries again later
+        raise BlobError('Cannot download layer {} [HTTP {}]: {}'.format(
+            layer['digest'][7:19], b_resp.status_code, b_resp.content[:1024]))
+
+    # Yield the bytes start..stop-1 of a blob (to the end when stop is None). When the
+    # connection breaks, the download goes on from the last byte received with a Range
+    # request, to the healthiest source by then
+    def blob_chunks(self, image, layer, start=0, stop=None, b_resp=None, avoid=(), served=None):
+        pos = start
+        resumes = 0
+        while True:
+            source = None
+            try:
+                if b_resp is None:
+                    b_resp = self.request_blob(image, layer, pos, stop, avoid, served)
+                source = b_resp.source
+                source_start = (time.time(), pos)
+                # A server ignoring Range sends the whole blob again, skip what we already have
+                skip = pos if b_resp.status_code == 200 else 0
+                if b_resp.status_code == 206 and not b_resp.headers.get('Content-Range', '').startswith('bytes {}-'.format(pos)):
+                    raise requests.exceptions.ContentDecodingError('unexpected Content-Range ' + b_resp.headers.get('Content-Range', ''))
+                for chunk in b_resp.iter_content(chunk_size=65536):
+                    if skip:
+                        cut = min(skip, len(chunk))
+                        chunk = chunk[cut:]
+                        skip -= cut
+                    if stop is not None:
+                        chunk = chunk[:stop - pos]
+                    if chunk:
+                        pos += len(chunk)
+                        yield chunk
+                    if stop is not None and pos >= stop:
+                        b_resp.close()
+                        break
+                if stop is None or pos >= stop:
+                    source.record(nbytes=pos - source_start[1], seconds=time.time() - source_start[0])
+                    return
+                raise requests.exceptions.ChunkedEncodingError('connection closed at byte {}'.format(pos))
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                if source:
+                    source.record(nbytes=pos - source_start[1])
+                    source.record_failure()
+                resumes += 1
+                if resumes > MAX_RESUMES:
+                    raise
+                self.log('[*] Layer {}: {}{}, resuming at byte {}'.format(
+                    layer['digest'][7:19], e.__class__.__name__, ' from ' + source.host if source else '', pos))
+                b_resp = None
+                time.sleep(min(0.5 * 2 ** resumes, 10))
+
+    # Byte length of each segment of a blob
+    def segment_step(self, size):
+        return -(-size // min(self.client.segments, size // SEGMENT_MIN_SIZE))
+
+    # Download a blob as parallel byte ranges into file, then yield it back in order.
+    # b_resp is the already opened response for the first range. Nothing is fetched before
+    # the first chunk is asked for, so download errors surface where the chunks are read
+    def segmented_chunks(self, job, image, layer, size, file, b_resp, avoid=(), served=None):
+        step = self.segment_step(size)
+        ranges = [(start, min(start + step, size)) for start in range(0, size, step)]
+        file.truncate(size)
+        fd = file.fileno()
+        lock = threading.Lock()
+        done = [0, 0]
+
+        def fetch_segment(i):
+            pos, stop = ranges[i]
+            for chunk in self.blob_chunks(image, layer, pos, stop, b_resp if i == 0 else None, avoid, served):
+                os.pwrite(fd, chunk, pos)
+                pos += len(chunk)
+                with lock:
+                    done[0] += len(chunk)
+                    nb_traits = int(50 * done[0] / size)
+                    if nb_traits > done[1]:
+                        done[1] = nb_traits
+                        self.progress.update(job, progress_bar(nb_traits), transient=True, bytes=done[0], size=size)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            list(pool.map(fetch_segment, range(len(ranges))))
+        file.seek(0)
+        yield from iter(lambda: file.read(65536), b'')
+
+    def fetch_layer(self, job):
+        image, idx = self.jobs[job]
+        ublob = image.layers[idx]['digest']
+        record = self.metrics.layer(image, image.layers[idx])
+        start = time.perf_counter()
+        with self.pulled_lock:
+            owner = ublob not in self.pulling
+            if owner:
+                self.pulling[ublob] = threading.Event()
+            event = self.pulling[ublob]
+        if owner:
+            try:
+                if not self.copy_base_layer(job, record):
+                    self.pull_from_sources(job, record)
+            finally:
+                event.set()
+            self.metrics.layer_done(record, start)
+            return
+        record['source'] = 'dedup'
+        self.progress.update(job, 'Waiting for another image...', transient=True)
+        event.wait()
+        if ublob not in self.pulled_layers:
+            # The job that owned it failed and raised why
+            raise BlobError('Layer {} could not be pulled'.format(ublob[7:19]))
+        archive = image.archive
+        src, name = self.pulled_layers[ublob]
+        if src is archive: # Same archive, the image just points to the existing member
+            image.layer_paths[idx] = name
+        else:
+            region = src.region(name)
+            copy_start = time.perf_counter()
+            with archive.lock:
+                member = archive.layer_member(image.layer_ids[idx], ublob)
+                archive.copy_member(src.path, region, member)
+            record['archive'] = time.perf_counter() - copy_start
+            record['written'] = region[1]
+            image.layer_paths[idx] = member
+        self.progress.update(job, 'Already exists')
+        self.metrics.layer_done(record, start)
+
+    # Copy a layer the base archives already hold, False when they do not have it
+    def copy_base_layer(self, job, record):
+        image, idx = self.jobs[job]
+        base = self.base
+        if not base:
+            return False
+        archive = image.archive
+        ublob = image.layers[idx]['digest']
+        if archive.format == 'oci':
+            # Blobs must stay byte for byte what the manifest points to
+            if ublob not in base.blobs:
+                return False
+            digest = ublob
+            path, offset, size = base.blobs[ublob]
+        else:
+            if idx >= len(image.diff_ids) or image.diff_ids[idx] not in base.layers:
+                return False
+            digest = image.diff_ids[idx]
+            path, offset, size = base.layers[digest]
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                # Layers stored compressed cannot be checked against the diff_id without
+                # decompressing them, they were verified when pulled
+                magic = f.read(4)
+                if magic[:2] == b'\x1f\x8b' or magic == b'\x28\xb5\x2f\xfd': # gzip, zstd
+                    digest = None
+        hasher = blob_hasher(digest) if digest else None
+        self.progress.update(job, 'Copying from base archive...', transient=True)
+        copy_start = time.perf_counter()
+        with archive.lock:
+            member = archive.layer_member(image.layer_ids[idx], ublob)
+            archive.copy_member(path, (offset, size), member, hasher)
+        record.update(source='base', archive=time.perf_counter() - copy_start, written=size)
+        if hasher and hasher.hexdigest() != digest.split(':', 1)[1]:
+            raise CorruptedBlobError('Layer {} of base archive {} is corrupted'.format(digest[7:19], path))
+        base.count(size)
+        image.layer_paths[idx] = member
+        self.pulled_layers[ublob] = (archive, member)
+        self.progress.update(job, 'Copied from base archive [{}]'.format(size))
+        return True
+
+    # Pull a layer, fetching it again from the other sources when the one(s) it came
+    # from sent bad data
+    def pull_from_sources(self, job, record):
+        image, idx = self.jobs[job]
+        avoid = set()
+        while True:
+            served = set()
+            try:
+                self.pull_layer(job, record, avoid, served)
+                break
+            except CorruptedBlobError as e:
+                avoid |= set(e.sources)
+                if not e.sources or not self.client.rank(image.sources, avoid):
+                    raise
+                for registry in e.sources:
+                    registry.record_failure()
+                self.log('[*] {}, fetching it again from another source'.format(e))
+                record['written'] = 0
+        if served:
+            record['hosts'] = sorted(registry.host for registry in served)
+
+    # Download and extract one layer into the archive. Sources in avoid are not asked,
+    # those sending data are added to served
+    def pull_layer(self, job, record, avoid=(), served=None):
+        image, idx = self.jobs[job]
+        cache = self.cache
+        progress = self.progress
+        archive = image.archive
+        layer = image.layers[idx]
+        ublob = layer['digest']
+        layer_id = image.layer_ids[idx]
+        # Time since the previous lap goes to one of Metrics.LAYER_PHASES
+        mark = [time.perf_counter()]
+        def lap(phase):
+            now = time.perf_counter()
+            record[phase] += now - mark[0]
+            mark[0] = now
+
+        # Creating layer file, from the cache when it holds the blob
+        cached = cache.get(ublob) if cache else None
+        lap('verify') # Cached blobs are hashed before use
+        record['source'] = 'cache' if cached else 'registry'
+        cache_tmp = None
+        resumed = 0
+        tee_from = None
+        if cached:
+            size = os.fstat(cached.fileno()).st_size
+            chunks = iter(lambda: cached.read(65536), b'')
+            cache.count(True, size)
+        else:
+            progress.update(job, 'Downloading...')
+            size = layer.get('size') or 0
+            segmented = self.client.segments > 1 and size >= 2 * SEGMENT_MIN_SIZE
+            if cache:
+                # Segments are written out of order, such a file cannot be resumed from
+                cache_tmp = cache.writer(ublob, resumable=not segmented)
+                cache_tmp.seek(0, os.SEEK_END)
+                resumed = cache_tmp.tell()
+                if resumed and (segmented or not size or resumed > size):
+                    cache_tmp.truncate(0)
+                    resumed = 0
+            try:
+                if resumed == size and size:
+                    b_resp = None
+                elif segmented:
+                    b_resp = self.request_blob(image, layer, 0, self.segment_step(size), avoid, served)
+                    if b_resp.status_code != 206:
+                        segmented = False # Range is not supported, a plain download it is
+                else:
+                    b_resp = self.request_blob(image, layer, resumed, None, avoid, served)
+            except requests.exceptions.RequestException as e:
+                if cache_tmp:
+                    cache_tmp.close() # Kept for the next pull to resume from
+                raise BlobError('Layer {} fetch error: {}'.format(ublob[7:19], e))
+            except BlobError:
+                if cache_tmp:
+                    cache_tmp.close()
+                raise
+            if b_resp is not None:
+                size = blob_size(b_resp) or size
+            if segmented:
+                tee_from = None # The segments already land in the cache file
+                chunks = self.segmented_chunks(job, image, layer, size, cache_tmp or tempfile.TemporaryFile(), b_resp,
+                                               avoid, served)
+            else:
+                tee_from = resumed
+                chunks = self.blob_chunks(image, layer, resumed, None, b_resp, avoid, served) if b_resp is not None else iter([])
+                if tee_from:
+                    progress.update(job, 'Resuming at byte {}...'.format(tee_from))
+                    cache_tmp.seek(0)
+                    chunks = itertools.chain(iter(lambda: cache_tmp.read(min(65536, tee_from - cache_tmp.tell())), b''), chunks)
+            if cache:
+                cache.count(False, size - (tee_from or 0))
+            lap('download')
+        # Stream the blob and follow the progress: every chunk is hashed, decompressed (legacy
+        # format only) and written to the archive as it arrives (and copied to the cache on a miss)
+        if size and 'size' in layer and size != layer['size']:
+            if cached:
+                cached.close()
+            if cache_tmp:
+                cache.abort(cache_tmp)
+            e = CorruptedBlobError('Layer {} has {} bytes, manifest says {}'.format(ublob[7:19], size, layer['size']))
+            e.sources = served or ()
+            raise e
+        keep_compressed = archive.keep_compressed
+        unit = size / 50 if size else float('inf')
+        acc = 0
+        nb_traits = 0
+        received = 0
+        verified = False
+        hasher = blob_hasher(ublob)
+        decoder = None if keep_compressed else layer_decompressor(layer.get('mediaType', ''))
+        # Only one layer at a time can be streamed into the archive, the others are spooled
+        direct = (archive.seekable or size > 0) and archive.lock.acquire(blocking=False)
+        try:
+            if direct:
+                member = archive.layer_member(layer_id, ublob)
+                archive.begin(member, (size or None) if keep_compressed else None)
+                sink = archive
+            else:
+                sink = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+            progress.update(job, progress_bar(nb_traits), transient=True, bytes=0, size=size)
+            lap('archive')
+            try:
+                for chunk in chunks:
+                    lap('download')
+                    if chunk:
+                        received += len(chunk)
+                        if size and received > size:
+                            raise ValueError('more data than announced ({} bytes)'.format(size))
+                        hasher.update(chunk)
+                        lap('verify')
+                        if cache_tmp and tee_from is not None and received > tee_from:
+                            cache_tmp.write(chunk)
+                            lap('cache')
+                        data = chunk
+                        if not keep_compressed:
+                            data = decoder.decompress(chunk)
+                            lap('decompress')
+                        sink.write(data)
+                        record['written'] += len(data)
+                        acc = acc + len(chunk)
+                        if acc > unit:
+                            nb_traits = min(nb_traits + int(acc / unit), 50)
+                            progress.update(job, progress_bar(nb_traits), transient=True, bytes=received, size=size)
+                            acc = 0
+                        lap('archive')
+                if not keep_compressed:
+                    data = decoder.flush()
+                    lap('decompress')
+                    sink.write(data)
+                    record['written'] += len(data)
+                record['bytes'] = received
+                if hasher.hexdigest() != ublob.split(':', 1)[1]:
+                    raise ValueError('digest mismatch, got {}:{}'.format(hasher.name, hasher.hexdigest()))
+                verified = True
+            except (requests.exceptions.RequestException, BlobError) as e:
+                if cache_tmp and tee_from is not None:
+                    self.log('[*] Partial download kept, the next pull resumes from it')
+                    cache_tmp.close()
+                    cache_tmp = None
+                raise BlobError('Layer {} fetch error: {}'.format(ublob[7:19], e))
+            except (ValueError,) + DECOMPRESS_ERRORS as e:
+                raise CorruptedBlobError('Layer {} is corrupted: {}'.format(ublob[7:19], e))
+            finally:
+                if cached:
+                    cached.close()
+                elif cache_tmp and not verified:
+                    cache.abort(cache_tmp)
+                    cache_tmp = None
+            lap('archive')
+            if cache_tmp:
+                cache.commit(ublob, cache_tmp)
+                lap('cache')
+            if direct:
+                archive.end()
+            else:
+                progress.update(job, 'Waiting for archive...', transient=True)
+                with archive.lock:
+                    member = archive.layer_member(layer_id, ublob)
+                    sink.seek(0, os.SEEK_END)
+                    archive.begin(member, sink.tell())
+                    sink.seek(0)
+                    for chunk in iter(lambda: sink.read(1024 * 1024), b''):
+                        archive.write(chunk)
+                    archive.end()
+                sink.close()
+            lap('archive')
+        except CorruptedBlobError as e:
+            # Nothing is left of the layer in the archive, it can be fetched from another source
+            if not direct or archive.rollback():
+                e.sources = served or ()
+            raise
+        finally:
+            if direct:
+                archive.lock.release()
+        image.layer_paths[idx] = member
+        self.pulled_layers[ublob] = (archive, member)
+        progress.update(job, '{} [{}]'.format('Already cached' if cached else 'Pull complete', size))
+
+    # Layer order and parent chain do not depend on download order
+    def write_image_metadata(self, image):
+        archive = image.archive
+        layers = image.layers
+        content = {
+            'Config': archive.config_member(image.config),
+            'RepoTags': [image.repo_name() + ':' + image.tag],
+            'Layers': list(image.layer_paths)
+            }
+        if archive.format == 'oci':
+            # Everything else is in the blobs, the image only needs its index.json entry
+            annotations = {'io.containerd.image.name': image.full_name()}
+            if ':' not in image.tag:
+                annotations['org.opencontainers.image.ref.name'] = image.tag
+            archive.index.append({
+                'mediaType': image.manifest_type,
+                'digest': 'sha256:' + hashlib.sha256(image.manifest_blob).hexdigest(),
+                'size': len(image.manifest_blob),
+                'annotations': annotations
+                })
+            archive.manifest.append(content)
+            return
+        parent_id=''
+        for idx, layer in enumerate(layers):
+            fake_layer_id = image.layer_ids[idx]
+            # Layers reused from another member of the archive have no folder of their own yet
+            archive.add_dir(fake_layer_id)
+            if not archive.has(fake_layer_id + '/VERSION'):
+                archive.add_file(fake_layer_id + '/VERSION', b'1.0')
+
+            # Creating json file
+            # last layer = config manifest - history - rootfs
+            if layers[-1]['digest'] == layer['digest']:
+                # FIXME: json.loads() automatically converts to unicode, thus decoding values whereas Docker doesn't
+                json_obj = json.loads(image.config_blob)
+                del json_obj['history']
+                try:
+                    del json_obj['rootfs']
+                except: # Because Microsoft loves case in-sensitiveness
+                    del json_obj['rootfS']
+            else: # other layers json are empty
+                json_obj = json.loads(empty_json)
+            json_obj['id'] = fake_layer_id
+            if parent_id:
+                json_obj['parent'] = parent_id
+            parent_id = json_obj['id']
+            if not archive.has(fake_layer_id + '/json'):
+                archive.add_file(fake_layer_id + '/json', json.dumps(json_obj).encode('utf-8'))
+
+        archive.manifest.append(content)
+        archive.repositories.setdefault(image.repo_name(), {})[image.tag] = fake_layer_id
+
+# Total size of a blob from a (possibly partial) response
+def blob_size(b_resp):
+    if b_resp.status_code == 206:
+        return int(b_resp.headers['Content-Range'].rsplit('/', 1)[1])
+    return int(b_resp.headers.get('Content-Length') or 0)
+
+default_client = None
+default_client_lock = threading.Lock()
+
+# Pull with a client shared by every call of the process (see RegistryClient.pull)
+def pull_image(names, output=None, format='docker', base=(), metrics_json=None):
+    global default_client
+    with default_client_lock:
+        if default_client is None:
+            default_client = RegistryClient()
+    return default_client.pull(names, output, format, base, metrics_json)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--platform",
+        type=str,
+        required=False,
+        default="linux/amd64",
+        help="specify architecture like linux/amd64"
+    )
+    parser.add_argument(
+        "--image",
+        type=str,
+        action="append",
+        required=False,
+        default=[],
+        help="specify image like hello-world, can be repeated to pull several images"
+    )
+    parser.add_argument(
+        "--image-list",
+        type=str,
+        required=False,
+        default=None,
+        help="file listing images to pull, one per line ('#' starts a comment)"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        required=False,
+        default=1,
+        help="number of layers to download and extract in parallel"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=False,
+        default=None,
+        help="archive to write, '-' for stdout (default: <repo>_<image>.tar). "
+             "With several images, they all go to this single archive"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=["docker", "oci", "legacy"],
+        required=False,
+        default="docker",
+        help="docker: docker load archive keeping the layers compressed as pulled, "
+             "oci: OCI image layout (also loadable by docker load), "
+             "legacy: docker load archive with uncompressed layers"
+    )
+    parser.add_argument(
+        "--base",
+        type=str,
+        action="append",
+        required=False,
+        default=[],
+        help="archive of a previous pull, layers it already holds are copied from it instead of downloaded"
+    )
+    parser.add_argument(
+        "--mirror",
+        type=str,
+        action="append",
+        required=False,
+        default=[],
+        help="[REGISTRY=]HOST mirror or pull-through cache tried before REGISTRY (default: Docker Hub), "
+             "can be repeated, in order of preference"
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        required=False,
+        default=1,
+        help="split large blobs into N byte ranges downloaded over parallel connections"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        required=False,
+        default=DEFAULT_CACHE_DIR,
+        help="content addressable blob cache shared between pulls"
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=str,
+        required=False,
+        default="20G",
+        help="size cap of the blob cache, least recently used blobs are evicted (like 500M, 20G)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="do not read nor fill the blob cache"
+    )
+    parser.add_argument(
+        "--progress",
+        type=str,
+        choices=["auto", "tty", "plain", "json"],
+        required=False,
+        default="auto",
+        help="tty: one live line per layer, plain: status changes only, "
+             "json: JSON lines events on stderr (auto: tty on a terminal, plain otherwise)"
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="only print errors"
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        required=False,
+        default=None,
+        help="write timings per phase and per layer, byte counts and throughput to this file"
+    )
+
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.segments < 1:
+        parser.error("--segments must be at least 1")
+
+    image_names = list(args.image)
+    if args.image_list:
+        with open(args.image_list) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    image_names.append(line)
+    if not image_names:
+        parser.error("at least one --image or an --image-list is required")
+
+    # When the archive goes to stdout, every message goes to stderr instead
+    output = args.output
+    stdout = sys.stdout
+    if args.output == '-':
+        if sys.stdout.isatty():
+            parser.error("refusing to write the image archive to a terminal")
+        output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    client = RegistryClient(jobs=args.jobs, segments=args.segments, platform=args.platform,
+                            cache_dir=args.cache_dir, cache_size=args.cache_size, no_cache=args.no_cache,
+                            progress=args.progress, quiet=args.quiet, mirrors=args.mirror)
+    # The summary is logged before stdout is restored, it must not end up in the archive
+    try:
         try:
-            del json_obj['rootfs']
-        except: # Because Microsoft loves case in-sensitiveness
-            del json_obj['rootfS']
-    else: # other layers json are empty
-        json_obj = json.loads(empty_json)
-    json_obj['id'] = fake_layer_id
-    if parent_id:
-        json_obj['parent'] = parent_id
-    parent_id = json_obj['id']
-    file.write(json.dumps(json_obj))
-    file.close()
-
-file = open(img_dir + '/manifest.json', 'w')
-file.write(json.dumps(content))
-file.close()
-
-if len(img_parts[:-1]) != 0:
-    content = { '/'.join(img_parts[:-1]) + '/' + img : { tag : fake_layer_id } }
-else: # when pulling only an img (without repo and registry)
-    content = { img : { tag : fake_layer_id } }
-file = open(img_dir + '/repositories', 'w')
-file.write(json.dumps(content))
-file.close()
-
-# Create image tar and clean tmp folder
-docker_tar = repo.replace('/', '_') + '_' + img + '.tar'
-sys.stdout.write("Creating archive...")
-sys.stdout.flush()
-tar = tarfile.open(docker_tar, "w")
-tar.add(img_dir, arcname=os.path.sep)
-tar.close()
-shutil.rmtree(img_dir)
-print('\rDocker image pulled: ' + docker_tar)
+            summary = client.pull(image_names, output, args.format, args.base, args.metrics_json)
+        except PullError as e:
+            if args.progress == 'json':
+                client.event('error', message=str(e), type=e.__class__.__name__)
+            else:
+                print('[-]', e)
+                if isinstance(e, RegistryConnectionError):
+                    print('[*] Troubleshooting tips:')
+                    print('    1. Check your internet connection')
+                    print('    2. If you are behind a proxy, set HTTP_PROXY and HTTPS_PROXY environment variables')
+                    print('    3. Try using a VPN if the registry is blocked')
+                    print('    4. Verify if the registry is accessible from your network')
+            return 1
+        finally:
+            client.close()
+
+        log = client.log
+        log('[+] Auth token requests: {}'.format(summary['auth_requests']))
+        if 'base' in summary:
+            log('[+] Base archives: {} layers reused ({} bytes)'.format(summary['base']['reused'], summary['base']['reused_bytes']))
+        if 'cache' in summary:
+            log('[+] Blob cache: {} hits ({} bytes), {} misses ({} bytes)'.format(
+                summary['cache']['hits'], summary['cache']['hit_bytes'], summary['cache']['misses'], summary['cache']['miss_bytes']))
+        for host, health in summary.get('sources', {}).items():
+            log('[+] Source {}: {} bytes, latency {}, {} recent failures'.format(
+                host, health['bytes'], '{:.3f}s'.format(health['latency']) if health['latency'] is not None else '-',
+                health['failures']))
+        log('[+] Timings: {}'.format(', '.join('{} {:.2f}s'.format(k, v) for k, v in summary['phases'].items())))
+        for archive in summary['archives']:
+            log('Docker image pulled: {} ({})'.format(archive['path'] or '<stdout>', ', '.join(archive['images'])))
+        return 0
+    finally:
+        sys.stdout = stdout
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,370 @@
+import os
+import sys
+import zlib
+import json
+import hashlib
+import time
+import random
+import tarfile
+import tempfile
+import subprocess
+import argparse
+import threading
+import ssl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+    import zstandard
+except ImportError: # Only needed for zstd layers
+    zstandard = None
+
+# Local stand-in for a Docker registry serving synthetic images, to measure docker_pull.py
+# without the network: /v2/ probe, bearer token endpoint, manifest lists, manifests and
+# blobs (with Range), plus injected latency, bandwidth cap, 5xx errors, cut connections and
+# corrupted blobs. Several of them serving the same image stand in for registry mirrors
+
+MANIFEST_LIST_V2 = 'application/vnd.docker.distribution.manifest.list.v2+json'
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+CONFIG_V1 = 'application/vnd.docker.container.image.v1+json'
+LAYER_TYPES = {
+    'gzip': 'application/vnd.docker.image.rootfs.diff.tar.gzip',
+    'zstd': 'application/vnd.oci.image.layer.v1.tar+zstd',
+}
+BLOCK = 64 * 1024
+
+# Deterministic layer content: blocks of random bytes mixed with runs of text, so that
+# compression has real work to do and a given ratio of the layer is compressible
+class LayerData(object):
+    def __init__(self, seed, size, compressible):
+        self.rng = random.Random(seed)
+        self.left = size
+        self.compressible = compressible
+        self.text = (b'docker_pull benchmark layer %d\n' % seed) * (BLOCK // 24)
+
+    def read(self, n=-1):
+        if n < 0:
+            n = self.left
+        n = min(n, self.left, BLOCK)
+        self.left -= n
+        if self.rng.random() < self.compressible:
+            return self.text[:n]
+        return self.rng.randbytes(n)
+
+# Writes the compressed tar stream to a file, computing the diff_id and the blob digest
+class LayerWriter(object):
+    def __init__(self, f, compression):
+        self.f = f
+        self.diff_id = hashlib.sha256()
+        self.digest = hashlib.sha256()
+        self.size = 0
+        if compression == 'zstd':
+            if not zstandard:
+                raise RuntimeError('zstd layers need the zstandard module')
+            self.c = zstandard.ZstdCompressor(level=1).compressobj()
+        else:
+            self.c = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _out(self, data):
+        self.f.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def write(self, data):
+        self.diff_id.update(data)
+        self._out(self.c.compress(data))
+        return len(data)
+
+    def close(self):
+        self._out(self.c.flush())
+
+# Generate a layer into data_dir, or reuse the one an earlier run left there
+def make_layer(data_dir, seed, size, compressible, compression):
+    key = hashlib.sha256(json.dumps([seed, size, compressible, compression]).encode('utf-8')).hexdigest()[:24]
+    path = os.path.join(data_dir, key + '.blob')
+    meta_path = path + '.json'
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            return json.load(f)
+    with tempfile.NamedTemporaryFile(dir=data_dir, delete=False) as f:
+        writer = LayerWriter(f, compression)
+        with tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT) as tar:
+            info = tarfile.TarInfo('data/layer-{}.bin'.format(seed))
+            info.size = size
+            info.mtime = 0
+            tar.addfile(info, LayerData(seed, size, compressible))
+        writer.close()
+    os.replace(f.name, path)
+    meta = {
+        'path': path,
+        'size': writer.size,
+        'digest': 'sha256:' + writer.digest.hexdigest(),
+        'diff_id': 'sha256:' + writer.diff_id.hexdigest(),
+        'mediaType': LAYER_TYPES[compression],
+    }
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+# Self signed certificate, docker_pull.py only speaks https (without verifying it)
+def make_certificate(folder):
+    cert = os.path.join(folder, 'cert.pem')
+    key = os.path.join(folder, 'key.pem')
+    if not os.path.exists(cert):
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30',
+                               '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+class FakeRegistry(object):
+    def __init__(self, data_dir, port=0, latency=0.0, bandwidth=0, error_rate=0.0, drop_rate=0.0,
+                 token_ttl=300, seed=0, corrupt_rate=0.0):
+        self.data_dir = data_dir
+        self.port = port
+        self.latency = latency # Seconds added to every request
+        self.bandwidth = bandwidth # Bytes per second per connection, 0 for unlimited
+        self.error_rate = error_rate # Share of requests answered 503
+        self.drop_rate = drop_rate # Share of blob responses cut halfway
+        self.corrupt_rate = corrupt_rate # Share of blob responses with a wrong byte
+        self.token_ttl = token_ttl
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.blobs = {} # digest -> bytes or layer file metadata
+        self.repos = {} # repository -> {tag or digest: (media type, digest)}
+        self.tokens = {} # token -> expiry
+        self.stats = dict.fromkeys(['requests', 'tokens', 'manifests', 'blobs', 'ranges', 'errors',
+                                    'drops', 'corrupted', 'bytes_sent'], 0)
+        self.server = None
+        os.makedirs(data_dir, exist_ok=True)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def chance(self, rate):
+        with self.lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def add_blob(self, data):
+        digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+        self.blobs[digest] = data
+        return digest
+
+    # Add repository:tag made of `layers` synthetic layers of layer_size uncompressed bytes,
+    # served through a manifest list like multi-arch images. Returns the total blob size
+    def add_image(self, repository, tag='latest', layers=1, layer_size=1 << 20, compressible=0.5,
+                  compression='gzip', seed=0):
+        metas = [make_layer(self.data_dir, seed * 100003 + i, layer_size, compressible, compression)
+                 for i in range(layers)]
+        for meta in metas:
+            self.blobs[meta['digest']] = meta
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'config': {'Cmd': ['/bin/sh']},
+            'rootfs': {'type': 'layers', 'diff_ids': [m['diff_id'] for m in metas]},
+            'history': [{'created_by': 'fake_registry layer {}'.format(i)} for i in range(layers)],
+        }).encode('utf-8')
+        manifest = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_V2,
+            'config': {'mediaType': CONFIG_V1, 'size': len(config), 'digest': self.add_blob(config)},
+            'layers': [{'mediaType': m['mediaType'], 'size': m['size'], 'digest': m['digest']} for m in metas],
+        }).encode('utf-8')
+        manifest_digest = self.add_blob(manifest)
+        manifest_list = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_LIST_V2,
+            'manifests': [{'mediaType': MANIFEST_V2, 'size': len(manifest), 'digest': manifest_digest,
+                           'platform': {'architecture': 'amd64', 'os': 'linux'}}],
+        }).encode('utf-8')
+        refs = self.repos.setdefault(repository, {})
+        refs[tag] = (MANIFEST_LIST_V2, self.add_blob(manifest_list))
+        refs[manifest_digest] = (MANIFEST_V2, manifest_digest)
+        return sum(m['size'] for m in metas) + len(config)
+
+    def start(self):
+        registry = self
+
+        class Handler(RegistryHandler):
+            pass
+        Handler.registry = registry
+        cert, key = make_certificate(self.data_dir)
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self.server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.port
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    registry = None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=b'', content_type='application/json', headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.stream([body], len(body))
+
+    # Write the body pieces under the bandwidth cap, stopping after `limit` bytes
+    def stream(self, pieces, limit):
+        bandwidth = self.registry.bandwidth
+        start = time.time()
+        sent = 0
+        for piece in pieces:
+            piece = piece[:limit - sent]
+            self.wfile.write(piece)
+            sent += len(piece)
+            if bandwidth:
+                delay = start + sent / bandwidth - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if sent >= limit:
+                break
+        self.registry.count('bytes_sent', sent)
+
+    def authorized(self):
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        with self.registry.lock:
+            return self.registry.tokens.get(token, 0) > time.time()
+
+    def do_GET(self):
+        registry = self.registry
+        registry.count('requests')
+        if registry.latency:
+            time.sleep(registry.latency)
+        path = self.path.split('?', 1)[0]
+        if registry.chance(registry.error_rate):
+            registry.count('errors')
+            return self.send(503, b'{"errors":[{"code":"UNAVAILABLE"}]}')
+        if path == '/token':
+            registry.count('tokens')
+            token = os.urandom(16).hex()
+            with registry.lock:
+                registry.tokens[token] = time.time() + registry.token_ttl
+            return self.send(200, json.dumps({
+                'token': token,
+                'expires_in': registry.token_ttl,
+                'issued_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            }).encode('utf-8'))
+        if not self.authorized():
+            realm = 'https://{}/token'.format(self.headers.get('Host', 'localhost'))
+            return self.send(401, b'{"errors":[{"code":"UNAUTHORIZED"}]}', headers={
+                'WWW-Authenticate': 'Bearer realm="{}",service="fake-registry"'.format(realm)})
+        if path in ('/v2', '/v2/'):
+            return self.send(200, b'{}')
+        if '/manifests/' in path:
+            repository, ref = path[len('/v2/'):].split('/manifests/', 1)
+            registry.count('manifests')
+            entry = registry.repos.get(repository, {}).get(ref)
+            if not entry:
+                return self.send(404, b'{"errors":[{"code":"MANIFEST_UNKNOWN"}]}')
+            media_type, digest = entry
+            return self.send(200, registry.blobs[digest], media_type, {'Docker-Content-Digest': digest})
+        if '/blobs/' in path:
+            registry.count('blobs')
+            blob = registry.blobs.get(path.rsplit('/', 1)[1])
+            if blob is None:
+                return self.send(404, b'{"errors":[{"code":"BLOB_UNKNOWN"}]}')
+            return self.send_blob(blob)
+        self.send(404)
+
+    do_HEAD = do_GET
+
+    def send_blob(self, blob):
+        size = len(blob) if isinstance(blob, bytes) else blob['size']
+        start, stop = 0, size
+        code = 200
+        headers = {'Accept-Ranges': 'bytes', 'Content-Length': None}
+        rng = self.headers.get('Range')
+        if rng and rng.startswith('bytes='):
+            first, last = rng[len('bytes='):].split('-', 1)
+            start = int(first)
+            stop = min(int(last) + 1, size) if last else size
+            if start >= size:
+                return self.send(416, headers={'Content-Range': 'bytes */{}'.format(size)})
+            code = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, size)
+            self.registry.count('ranges')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(stop - start))
+        for name, value in headers.items():
+            if value is not None:
+                self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        limit = stop - start
+        if self.registry.chance(self.registry.drop_rate):
+            # Broken connection: half of the body, then nothing
+            self.registry.count('drops')
+            limit //= 2
+            self.close_connection = True
+        corrupt = self.registry.chance(self.registry.corrupt_rate)
+        if corrupt:
+            self.registry.count('corrupted')
+        if isinstance(blob, bytes):
+            pieces = [blob[start:stop]]
+            return self.stream(self.corrupt(pieces) if corrupt else pieces, limit)
+        with open(blob['path'], 'rb') as f:
+            f.seek(start)
+            pieces = iter(lambda: f.read(BLOCK), b'')
+            self.stream(self.corrupt(pieces) if corrupt else pieces, limit)
+
+    # Misbehaving mirror: the first byte of the body is flipped
+    @staticmethod
+    def corrupt(pieces):
+        first = True
+        for piece in pieces:
+            if first and piece:
+                piece = bytes([piece[0] ^ 0xff]) + piece[1:]
+                first = False
+            yield piece
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local registry serving synthetic images for docker_pull.py')
+    parser.add_argument("--port", type=int, default=5443, help="port to listen on (https)")
+    parser.add_argument("--data-dir", type=str, default=os.path.join(tempfile.gettempdir(), 'docker_pull_bench'),
+                        help="where generated layers are kept between runs")
+    parser.add_argument("--repository", type=str, default="bench/image", help="repository of the image")
+    parser.add_argument("--layers", type=int, default=10, help="number of layers")
+    parser.add_argument("--layer-size", type=int, default=1 << 20, help="uncompressed size of each layer")
+    parser.add_argument("--compressible", type=float, default=0.5, help="share of each layer that compresses well")
+    parser.add_argument("--compression", type=str, choices=sorted(LAYER_TYPES), default="gzip")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes/s per connection, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of blob responses cut halfway")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="share of blob responses with a wrong byte")
+    parser.add_argument("--token-ttl", type=int, default=300, help="token lifetime in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the layer content and injected failures")
+    args = parser.parse_args()
+
+    registry = FakeRegistry(args.data_dir, args.port, args.latency, args.bandwidth, args.error_rate,
+                            args.drop_rate, args.token_ttl, args.seed, args.corrupt_rate)
+    print('[+] Generating {} layers of {} bytes...'.format(args.layers, args.layer_size))
+    total = registry.add_image(args.repository, 'latest', args.layers, args.layer_size, args.compressible,
+                               args.compression, args.seed)
+    port = registry.start()
+    print('[+] Serving localhost:{}/{}:latest ({} blob bytes)'.format(port, args.repository, total))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        registry.stop()
@@ -0,0 +1,335 @@
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import logging
+
+from batching import InvalidRequest
+from metrics import ChatMetrics
+from streaming import SSE_DONE, SSE_HEADERS, finish_event, sse_event
+
+# 异步 (ASGI) 服务模式: 请求直接在事件循环里驱动 AsyncLLMEngine, 不占用线程
+#   并发生成数受 AdmissionController 限制, 超出的请求排队, 队列满返回 429, 等待超时返回 503;
+#   客户端断开时取消该请求 (排队中直接出队, 生成中通知引擎 abort)
+# 需要 uvicorn: uvicorn.run(ChatApp(...), host=..., port=...)
+
+
+class Rejected(Exception):
+    """请求未被接纳, 直接以 status 返回"""
+
+    def __init__(self, status, message, retry_after=1):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """限制同时生成的请求数, 超出的请求按到达顺序排队
+
+    max_in_flight: 同时交给引擎的请求数
+    max_queue: 排队请求数上限, 满了立即返回 429
+    queue_timeout: 排队最长等待秒数, 超时返回 503 (None 表示一直等)
+    """
+
+    def __init__(self, max_in_flight=64, max_queue=256, queue_timeout=30.0):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        # 统计信息
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    async def acquire(self):
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Rejected(429, "Too many requests queued, try again later")
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not (future.done() and not future.cancelled()):
+                self.timed_out += 1
+                raise Rejected(503, f"Request waited more than {self.queue_timeout}s in the queue")
+            # 超时的同时恰好拿到了名额
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # 名额已经转给本请求, 继续交给下一个
+            raise
+        finally:
+            if future in self.waiters:
+                self.waiters.remove(future)
+        self.admitted += 1
+
+    def release(self):
+        # 名额直接转给排在最前面的请求, in_flight 不变
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class ChatApp:
+    """/chat 的 ASGI 应用
+
+    engine: vllm.AsyncLLMEngine 或 AsyncStubEngine
+    prepare(data): 返回 (prompt, SamplingParams), 请求不合法时抛出 InvalidRequest
+    reply(data, output): 非流式请求的响应体
+    finish(data, output): 完整生成结束后调用 (例如记录会话)
+    on_startup: 服务启动时 (lifespan) 依次 await 的协程函数
+    stats(): GET /stats 返回的统计信息 (准入控制的统计之外)
+    metrics: ChatMetrics, GET /metrics 以 Prometheus 格式输出
+    startup: startup.Startup, 就绪前 /chat 和 /ready 返回 503 (engine 可以在就绪时才设置)
+    """
+
+    def __init__(self, engine, prepare, reply, admission=None, on_startup=(), finish=None, stats=None,
+                 metrics=None, startup=None):
+        self.engine = engine
+        self.startup = startup
+        self.prepare = prepare
+        self.reply = reply
+        self.finish = finish
+        self.stats = stats
+        self.admission = admission or AdmissionController()
+        self.metrics = metrics or ChatMetrics()
+        self.metrics.collectors.append(self.admission_samples)
+        self.on_startup = list(on_startup)
+        self.counter = itertools.count()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            route = (scope["method"], scope["path"])
+            ready = self.startup is None or self.startup.is_ready
+            if route == ("POST", "/chat"):
+                if ready:
+                    await self.chat(receive, send)
+                else:
+                    await send_json(send, 503, {"error": "Service is starting", "startup": self.startup_status()},
+                                    headers=[(b"retry-after", b"5")])
+            elif route == ("GET", "/health"):
+                # 进程存活即可, 启动失败时 503
+                failed = self.startup is not None and self.startup.failed
+                await send_json(send, 503 if failed else 200, {"status": "failed" if failed else "ok",
+                                                               "startup": self.startup_status(),
+                                                               **self.admission.stats()})
+            elif route == ("GET", "/ready"):
+                await send_json(send, 200 if ready else 503, {"ready": ready, "startup": self.startup_status()})
+            elif route == ("GET", "/metrics"):
+                body = self.metrics.render().encode("utf-8")
+                await send({"type": "http.response.start", "status": 200, "headers": [
+                    (b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode())]})
+                await send({"type": "http.response.body", "body": body})
+            elif route == ("GET", "/stats"):
+                stats = self.stats() if self.stats is not None else {}
+                await send_json(send, 200, {"admission": self.admission.stats(), "startup": self.startup_status(),
+                                            **stats})
+            else:
+                await send_json(send, 404, {"error": "Not found"})
+
+    def startup_status(self):
+        return self.startup.status() if self.startup is not None else {"state": "ready"}
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    for hook in self.on_startup:
+                        await hook()
+                except Exception as e:
+                    logging.error(f"Startup failed: {str(e)}")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def chat(self, receive, send):
+        """对话处理端点"""
+        try:
+            body = await read_body(receive)
+        except ClientDisconnected:
+            return
+        timing = self.metrics.start()
+        try:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict) or 'messages' not in data:
+                timing.finish(status="invalid")
+                await send_json(send, 400, {"error": "Invalid request format"})
+                return
+            try:
+                prompt, sampling_params = self.prepare(data)
+            except InvalidRequest as e:
+                timing.finish(status="invalid")
+                await send_json(send, e.status, {"error": str(e)})
+                return
+            except Exception as e:
+                logging.error(f"Error processing request: {str(e)}")
+                timing.finish(status="error")
+                await send_json(send, 500, {"error": str(e)})
+                return
+            timing.templated()
+
+            # 生成期间同时监听断开; 客户端先走就取消生成, 释放引擎时间
+            task = asyncio.ensure_future(self.respond(data, prompt, sampling_params, send, timing))
+            disconnect = asyncio.ensure_future(wait_disconnect(receive))
+            try:
+                await asyncio.wait({task, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                disconnect.cancel()
+                task.cancel()
+                await asyncio.gather(task, disconnect, return_exceptions=True)
+        finally:
+            timing.finish(status="cancelled")  # 已经记录过结果时不起作用
+
+    async def respond(self, data, prompt, sampling_params, send, timing):
+        try:
+            timing.queue_start()
+            async with self.admission.slot():
+                timing.queue_end()
+                if data.get("stream"):
+                    await self.stream(data, prompt, sampling_params, send, timing)
+                else:
+                    output = await self.generate(data, prompt, sampling_params)
+                    timing.first_token()
+                    await send_json(send, 200, self.reply(data, output))
+                    timing.finish(output)
+        except Rejected as e:
+            timing.finish(status="rejected")
+            await send_json(send, e.status, {"error": e.message},
+                            headers=[(b"retry-after", str(e.retry_after).encode())])
+        except (asyncio.CancelledError, ClientDisconnected):
+            raise
+        except Exception as e:
+            logging.error(f"Error processing request: {str(e)}")
+            timing.finish(status="error")
+            await send_json(send, 500, {"error": str(e)})
+
+    async def outputs(self, data, prompt, sampling_params, on_output=None):
+        """驱动引擎生成一个请求, 返回最终的 RequestOutput; 被取消时中止引擎里的请求"""
+        request_id = f"chat-{next(self.counter)}"
+        output = None
+        finished = False
+        try:
+            async for output in self.engine.generate(prompt, sampling_params, request_id):
+                if on_output is not None:
+                    await on_output(output)
+            finished = True
+        finally:
+            if not finished:
+                await self.engine.abort(request_id)
+        if output is not None and self.finish is not None:
+            self.finish(data, output)
+        return output
+
+    async def generate(self, data, prompt, sampling_params):
+        return await self.outputs(data, prompt, sampling_params)
+
+    async def stream(self, data, prompt, sampling_params, send, timing):
+        """每个 decode 步发送一个 {"delta": ...} 事件, 格式与 Flask 模式的 sse_stream 相同"""
+        headers = [(b"content-type", b"text/event-stream; charset=utf-8")]
+        headers += [(key.lower().encode(), value.encode()) for key, value in SSE_HEADERS.items()]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+        async def write(event):
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+
+        sent = 0
+
+        async def on_output(output):
+            nonlocal sent
+            text = output.outputs[0].text
+            if len(text) > sent:
+                await write(sse_event({"delta": text[sent:]}))
+                timing.first_token()
+                sent = len(text)
+
+        try:
+            output = await self.outputs(data, prompt, sampling_params, on_output)
+            if output is not None:
+                await write(sse_event(finish_event(output)))
+            timing.finish(output)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 响应头已经发出, 只能用事件报告错误
+            timing.finish(status="error")
+            await write(sse_event({"error": str(e)}))
+        await send({"type": "http.response.body", "body": SSE_DONE.encode("utf-8")})
+
+    def admission_samples(self):
+        stats = self.admission.stats()
+        return [
+            ("chat_admission_in_flight", "gauge", "Requests holding an admission slot.", stats["in_flight"]),
+            ("chat_admission_queued", "gauge", "Requests waiting for an admission slot.", stats["queued"]),
+            ("chat_admission_rejected_total", "counter", "Requests rejected with 429 (queue full).",
+             stats["rejected"]),
+            ("chat_admission_timed_out_total", "counter", "Requests rejected with 503 (queue deadline).",
+             stats["timed_out"]),
+        ]
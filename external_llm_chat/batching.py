@@ -0,0 +1,141 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import current_request
+
+# 请求里允许覆盖的采样参数 (其余字段忽略)
+REQUEST_SAMPLING_KEYS = (
+    "max_tokens", "temperature", "top_p", "top_k", "min_p", "seed", "stop",
+    "presence_penalty", "frequency_penalty", "repetition_penalty",
+)
+
+
+class InvalidRequest(ValueError):
+    """请求内容不合法, 以 status 返回"""
+
+    status = 400
+
+
+def sampling_overrides(data):
+    """从请求体中取出本次请求的采样参数"""
+    return {key: data[key] for key in REQUEST_SAMPLING_KEYS if data.get(key) is not None}
+
+
+class BatchScheduler:
+    """把并发的 /chat 请求攒成一批, 用一次 generate 调用处理
+
+    第一个请求到达后最多等待 batch_wait_ms, 或攒满 max_batch_size 个就立即提交;
+    每个请求带自己的 SamplingParams, 输出按顺序交还给各自的调用方。
+    generate 只在调度线程里调用, 引擎不需要线程安全。
+    传入 metrics (ChatMetrics) 时记录批次大小和每个请求的排队时间。
+    """
+
+    def __init__(self, llm, max_batch_size=64, batch_wait_ms=5.0, metrics=None):
+        self.llm = llm
+        self.metrics = metrics
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        # 统计信息
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.largest_batch = 0
+        self.thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, sampling_params):
+        """提交一个请求, 返回 Future, 结果为该 prompt 的 RequestOutput"""
+        future = Future()
+        timing = current_request.get()
+        if timing is not None:
+            timing.queue_start()
+        self.queue.put((prompt, sampling_params, future, timing))
+        return future
+
+    def generate(self, prompt, sampling_params, timeout=None):
+        """阻塞直到该请求所在的批次生成完毕"""
+        return self.submit(prompt, sampling_params).result(timeout)
+
+    def stream(self, prompt, sampling_params):
+        """同步引擎无法逐 token 输出, 整段回复作为一次增量产出"""
+        output = self.generate(prompt, sampling_params)
+        yield output.outputs[0].text, output
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        """取出一批请求: 阻塞等第一个, 然后在等待窗口内继续收集"""
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # 窗口结束后仍把已经排队的请求一起带上
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)  # 当前批次处理完再退出
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # 调用方已经放弃的请求不再送入引擎
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            for _, _, _, timing in batch:
+                if timing is not None:
+                    timing.queue_end()
+            if self.metrics is not None:
+                self.metrics.batch_size.observe(len(batch))
+            with self.lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            outputs = self.llm.generate(
+                [prompt for prompt, _, _, _ in batch],
+                [params for _, params, _, _ in batch],
+                use_tqdm=False,
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                # 引擎逐个校验 prompt (例如超过 max_model_len), 一个请求出错整批都会失败;
+                # 逐个重新生成, 只有出错的请求收到异常
+                logging.warning(f"Batch of {len(batch)} requests failed, retrying one by one: {str(e)}")
+                for item in batch:
+                    self._run([item])
+                return
+            logging.error(f"Request failed: {str(e)}")
+            batch[0][2].set_exception(e)
+            return
+        for (_, _, future, _), output in zip(batch, outputs):
+            future.set_result(output)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "requests": self.requests,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "queued": self.queue.qsize(),
+            }
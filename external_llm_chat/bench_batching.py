@@ -0,0 +1,80 @@
+import argparse
+import json
+import threading
+import time
+
+from batching import BatchScheduler
+from stub_engine import SamplingParams, StubLLM
+
+# 用 stub 引擎测量 BatchScheduler 的吞吐和延迟 (不需要 GPU):
+# 同样的并发请求分别以逐条 generate (max_batch_size=1) 和动态批处理两种方式跑一遍
+#   python bench_batching.py --concurrency 32 --requests 256 --batch_wait_ms 5
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+def run(args, max_batch_size):
+    llm = StubLLM(args.prefill_ms_per_token, args.decode_ms_per_step, args.batch_scaling)
+    scheduler = BatchScheduler(llm, max_batch_size, args.batch_wait_ms)
+    tokenizer = llm.get_tokenizer()
+    latencies = []
+    tokens = [0]
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+
+    def worker():
+        for i in counter:
+            messages = [{"role": "user", "content": f"question {i} " + "please explain " * (i % 20)}]
+            prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            start = time.perf_counter()
+            output = scheduler.generate(prompt, SamplingParams(max_tokens=args.max_tokens, seed=i))
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                tokens[0] += len(output.outputs[0].token_ids)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    scheduler.stop()
+    return {
+        "max_batch_size": max_batch_size,
+        "wall": round(wall, 3),
+        "requests_per_s": round(args.requests / wall, 2),
+        "tokens_per_s": round(tokens[0] / wall, 1),
+        "p50": round(percentile(latencies, 50), 4),
+        "p95": round(percentile(latencies, 95), 4),
+        "p99": round(percentile(latencies, 99), 4),
+        "generate_calls": llm.calls,
+        "mean_batch_size": round(scheduler.stats()["mean_batch_size"], 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the /chat batch scheduler with the stub engine")
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--max_tokens", type=int, default=64)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--batch_wait_ms", type=float, default=5.0)
+    parser.add_argument("--prefill_ms_per_token", type=float, default=0.05)
+    parser.add_argument("--decode_ms_per_step", type=float, default=10.0)
+    parser.add_argument("--batch_scaling", type=float, default=0.02)
+    parser.add_argument("--json", type=str, default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    results = [run(args, 1), run(args, args.max_batch_size)]
+    print(f"{'batch':>6} {'wall (s)':>9} {'req/s':>8} {'tok/s':>9} {'p50 (s)':>8} {'p95 (s)':>8} "
+          f"{'p99 (s)':>8} {'calls':>6} {'mean batch':>10}")
+    for r in results:
+        print(f"{r['max_batch_size']:>6} {r['wall']:>9.2f} {r['requests_per_s']:>8.1f} {r['tokens_per_s']:>9.1f} "
+              f"{r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f} {r['generate_calls']:>6} {r['mean_batch_size']:>10.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
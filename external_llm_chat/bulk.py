@@ -0,0 +1,160 @@
+import json
+import os
+import sys
+import time
+
+from batching import InvalidRequest
+
+# 离线批量推理: JSONL 每行一个对话, 结果按输入顺序写成 JSONL
+#   输入行: {"messages": [...], "id": ..., 以及 /chat 支持的采样参数}, 没有 messages 时把 prompt_field 字段当作一条 user 消息
+#   输出行: {"index", "id", "response", "finish_reason", "usage"} 或 {"index", "id", "error"}
+# 按 chunk_size 分块提交给调度器, 当前块生成时下一块已经排队, 引擎不会在块之间空闲;
+# 内存里最多同时有两块, 与文件大小无关
+
+
+def to_request(record, prompt_field="prompt"):
+    """输入行转换为 /chat 的请求体 (不支持会话和流式)"""
+    if not isinstance(record, dict):
+        raise InvalidRequest("Each line must be a JSON object")
+    data = {key: value for key, value in record.items() if key not in ("session_id", "new_session", "stream")}
+    if "messages" not in data:
+        if not isinstance(record.get(prompt_field), str):
+            raise InvalidRequest(f"Line has neither messages nor a {prompt_field} string")
+        data["messages"] = [{"role": "user", "content": record[prompt_field]}]
+    return data
+
+
+def submit_chunk(chunk, prepare, scheduler, prompt_field):
+    """提交一块请求, 返回 [(index, id, future 或错误信息)]"""
+    pending = []
+    for index, line in chunk:
+        record_id = None
+        try:
+            # 文件里的行是字节, 在这里解码, 编码不对只影响这一行
+            record = json.loads(line.decode("utf-8") if isinstance(line, bytes) else line)
+            record_id = record.get("id") if isinstance(record, dict) else None
+            prompt, sampling_params = prepare(to_request(record, prompt_field))
+            pending.append((index, record_id, scheduler.submit(prompt, sampling_params)))
+        except (ValueError, InvalidRequest) as e:
+            pending.append((index, record_id, str(e)))
+        except Exception as e:
+            # 模板渲染失败、messages 结构不对等, 只影响这一行
+            pending.append((index, record_id, f"{type(e).__name__}: {str(e)}"))
+    return pending
+
+
+def collect_chunk(pending, totals):
+    """按输入顺序等待一块的结果"""
+    for index, record_id, future in pending:
+        if isinstance(future, str):
+            yield {"index": index, "id": record_id, "error": future}
+            continue
+        try:
+            output = future.result()
+        except Exception as e:
+            yield {"index": index, "id": record_id, "error": str(e)}
+            continue
+        completion = output.outputs[0]
+        usage = {
+            "prompt_tokens": len(output.prompt_token_ids or []),
+            "completion_tokens": len(completion.token_ids),
+        }
+        totals["prompt_tokens"] += usage["prompt_tokens"]
+        totals["completion_tokens"] += usage["completion_tokens"]
+        yield {"index": index, "id": record_id, "response": completion.text,
+               "finish_reason": completion.finish_reason, "usage": usage}
+
+
+def run_bulk(lines, prepare, scheduler, chunk_size=256, prompt_field="prompt", totals=None, on_chunk=None):
+    """逐块处理 (index, 行文本或 UTF-8 字节), 按顺序产出结果; 每块结果全部产出后调用 on_chunk(该块最后的 index)"""
+    totals = totals if totals is not None else {}
+    totals.setdefault("requests", 0)
+    totals.setdefault("prompt_tokens", 0)
+    totals.setdefault("completion_tokens", 0)
+    previous = None
+    chunk = []
+    for index, line in lines:
+        if line.strip():
+            chunk.append((index, line))
+        if len(chunk) >= chunk_size:
+            current = (submit_chunk(chunk, prepare, scheduler, prompt_field), index)
+            chunk = []
+            if previous is not None:
+                yield from finish_chunk(previous, totals, on_chunk)
+            previous = current
+    if chunk:
+        current = (submit_chunk(chunk, prepare, scheduler, prompt_field), chunk[-1][0])
+        if previous is not None:
+            yield from finish_chunk(previous, totals, on_chunk)
+        previous = current
+    if previous is not None:
+        yield from finish_chunk(previous, totals, on_chunk)
+
+
+def finish_chunk(chunk, totals, on_chunk):
+    pending, last_index = chunk
+    for result in collect_chunk(pending, totals):
+        totals["requests"] += 1
+        yield result
+    if on_chunk is not None:
+        on_chunk(last_index)
+
+
+def read_lines(f, start=0):
+    """二进制文件按行读出 (行号, 字节), 同时记录每行结束处的偏移, 用于断点续跑"""
+    offsets = {}
+
+    def lines():
+        offset = f.tell()
+        index = start
+        for line in iter(f.readline, b""):
+            offset += len(line)
+            offsets[index] = offset
+            yield index, line
+            index += 1
+
+    return lines(), offsets
+
+
+def run_file(input_path, output_path, prepare, scheduler, chunk_size=256, prompt_field="prompt"):
+    """JSONL 文件批量推理, 每块写完后更新 <output>.ckpt; 检查点存在时从中断处继续"""
+    checkpoint_path = output_path + ".ckpt"
+    state = {"lines": 0, "input_offset": 0, "output_offset": 0}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        print(f"Resuming {input_path} after line {state['lines']}", file=sys.stderr)
+
+    totals = {}
+    start = time.perf_counter()
+    with open(input_path, "rb") as source, open(output_path, "ab" if state["lines"] else "wb") as sink:
+        # 丢掉检查点之后写了一半的输出
+        sink.truncate(state["output_offset"])
+        sink.seek(state["output_offset"])
+        source.seek(state["input_offset"])
+        lines, offsets = read_lines(source, state["lines"])
+
+        def on_chunk(last_index):
+            sink.flush()
+            os.fsync(sink.fileno())
+            state.update(lines=last_index + 1, input_offset=offsets.pop(last_index), output_offset=sink.tell())
+            for index in [i for i in offsets if i < last_index]:
+                del offsets[index]
+            tmp = checkpoint_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp, checkpoint_path)
+            elapsed = time.perf_counter() - start
+            print(f"{totals['requests']} requests, {totals['completion_tokens']} tokens generated, "
+                  f"{totals['completion_tokens'] / elapsed:.1f} tok/s", file=sys.stderr)
+
+        for result in run_bulk(lines, prepare, scheduler, chunk_size, prompt_field, totals, on_chunk):
+            sink.write((json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    # 全部完成, 不再需要检查点
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    elapsed = time.perf_counter() - start
+    totals["seconds"] = round(elapsed, 3)
+    totals["tokens_per_s"] = round(totals["completion_tokens"] / elapsed, 1) if elapsed > 0 else 0.0
+    return totals
@@ -0,0 +1,458 @@
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import sys
+import threading
+import time
+from flask import Flask, Response, request, jsonify, stream_with_context
+from utils import load_chat_template, sampling_add_cli_args
+from engines import add_engine_cli_args, create_engine
+from batching import BatchScheduler, InvalidRequest, sampling_overrides
+from streaming import SSE_HEADERS, AsyncEngineRunner, on_finish, sse_stream
+from sessions import SessionStore
+from context_budget import ContextBudget
+from response_cache import CachedEngine, CachedScheduler, ResponseCache
+from metrics import ChatMetrics, component_samples
+from asgi import AdmissionController, ChatApp
+from bulk import run_bulk, run_file
+from startup import Startup, warmup_engine, warmup_requests, warmup_scheduler
+
+# /chat 服务的共用部分: run.py 和 example/service.py 只提供各自的响应体和默认采样参数
+#   main(build_reply, sampling_kwargs, started)
+#   build_reply(data, output): 非流式请求的响应体 (可 JSON 序列化)
+#   sampling_kwargs: 默认采样参数, None 时取命令行里的采样参数 (sampling_add_cli_args)
+#   started: 启动计时的起点 (入口脚本在导入 flask / vllm 之前取得的 time.perf_counter())
+
+app = Flask(__name__)  # 创建Flask应用
+
+# 全局变量存储模型实例和配置
+global_engine = None
+global_llm = None
+global_tokenizer = None
+global_scheduler = None
+global_sessions = None
+global_budget = None
+global_cache = None
+global_metrics = None
+global_startup = Startup()
+# /chat/batch 每次提交给引擎的对话数
+global_bulk_chunk_size = 256
+# 默认采样参数, 请求中的同名字段会覆盖
+global_sampling_kwargs = None
+global_sampling_params = None
+global_build_reply = None
+
+
+def initialize_service(args):
+    """初始化模型服务"""
+    global global_engine, global_llm, global_tokenizer, global_scheduler, global_sessions, global_budget
+    global global_cache, global_metrics, global_sampling_kwargs, global_sampling_params
+
+    if global_metrics is None:
+        global_metrics = create_metrics(args)
+
+    # 初始化模型
+    with global_startup.phase("load_model"):
+        # 推理引擎 (--engine vllm / stub)
+        global_engine = create_engine(args)
+        global_cache = create_response_cache(args)
+        if global_sampling_kwargs is None:
+            global_sampling_kwargs = cli_sampling_kwargs(args)
+        global_sampling_params = global_engine.SamplingParams(**global_sampling_kwargs)
+        if args.server == "asgi":
+            # ASGI 模式直接在 uvicorn 的事件循环里驱动引擎, 分词器在启动时获取 (load_tokenizer)
+            global_llm = global_engine.create_async_engine()
+            logging.info("Service initialization completed")
+            return
+        if args.async_engine:
+            # 异步引擎逐 token 输出 (stream 请求), 并自己做连续批处理
+            engine = global_engine.create_async_engine()
+            global_scheduler = AsyncEngineRunner(engine)
+        else:
+            global_llm = global_engine.create_llm()
+            # 并发请求攒批后一起送入引擎
+            max_batch_size = args.max_batch_size or getattr(args, "max_num_seqs", None) or 64
+            global_scheduler = BatchScheduler(global_llm, max_batch_size, args.batch_wait_ms, global_metrics)
+        if global_cache is not None:
+            global_scheduler = CachedScheduler(global_scheduler, global_cache)
+    with global_startup.phase("tokenizer"):
+        global_tokenizer = global_scheduler.get_tokenizer() if args.async_engine else global_llm.get_tokenizer()
+        load_chat_template(global_tokenizer, args.chat_template)
+        global_sessions = create_session_store(args)
+        global_budget = create_context_budget(args, engine if args.async_engine else global_llm)
+
+    logging.info("Service initialization completed")
+
+
+def cli_sampling_kwargs(args):
+    """命令行里该引擎 SamplingParams 接受的参数"""
+    names = inspect.signature(global_engine.SamplingParams).parameters
+    return {name: getattr(args, name) for name in names if hasattr(args, name)}
+
+
+def create_metrics(args):
+    """请求指标; 在加载模型之前创建, 启动期间 /metrics 也可用"""
+    metrics = ChatMetrics(args.log_requests)
+    metrics.collectors.append(lambda: component_samples(global_scheduler, global_sessions, global_cache, global_budget))
+    metrics.collectors.append(global_startup.samples)
+    return metrics
+
+
+def start_service(args):
+    """加载模型并预热, 完成后标记就绪 (--fast_start 时在后台线程里运行)"""
+    try:
+        initialize_service(args)
+        with global_startup.phase("warmup"):
+            # 绕过回复缓存, 预热请求一定进入引擎
+            scheduler = global_scheduler.scheduler if isinstance(global_scheduler, CachedScheduler) else global_scheduler
+            warmup_scheduler(scheduler, prepare_request, create_warmup_requests(args))
+    except Exception as e:
+        global_startup.fail(e)
+        raise
+    global_startup.ready()
+
+
+async def start_asgi(args, asgi_app):
+    """ASGI 模式的启动: 加载模型 (--fast_start 时在线程里, 不阻塞事件循环), 取得分词器后预热"""
+    try:
+        if args.fast_start:
+            await asyncio.to_thread(initialize_service, args)
+        else:
+            initialize_service(args)
+        asgi_app.engine = CachedEngine(global_llm, global_cache) if global_cache is not None else global_llm
+        with global_startup.phase("tokenizer"):
+            await load_tokenizer(args)
+        with global_startup.phase("warmup"):
+            await warmup_engine(global_llm, prepare_request, create_warmup_requests(args))
+    except Exception as e:
+        global_startup.fail(e)
+        raise
+    global_startup.ready()
+
+
+def create_warmup_requests(args):
+    """--warmup_requests 个预热请求, --warmup_file 未指定时使用内置的对话"""
+    return warmup_requests(args.warmup_requests, args.warmup_max_tokens, args.warmup_file, args.bulk_prompt_field)
+
+
+def create_response_cache(args):
+    """确定性请求的回复缓存, --response_cache_mb 0 时关闭"""
+    if args.response_cache_mb <= 0:
+        return None
+    return ResponseCache(args.response_cache_mb << 20, args.response_cache_ttl,
+                         args.response_cache_dir, namespace=global_engine.model)
+
+
+def create_session_store(args):
+    """服务端会话, --session_memory_mb 0 时关闭"""
+    if args.session_memory_mb <= 0:
+        return None
+    return SessionStore(global_tokenizer, args.session_memory_mb << 20, args.session_ttl)
+
+
+def create_context_budget(args, engine):
+    """prompt 的 token 预算, --context_policy off 时关闭"""
+    if args.context_policy == "off":
+        return None
+    max_context = args.max_context or global_engine.max_context(engine)
+    if not max_context:
+        logging.warning("Unknown context length, prompt lengths are not checked (set --max_context)")
+        return None
+    return ContextBudget(global_tokenizer, max_context, args.context_policy)
+
+
+async def load_tokenizer(args):
+    """ASGI 模式: 在服务的事件循环里取得分词器"""
+    global global_tokenizer, global_sessions, global_budget
+    tokenizer = global_llm.get_tokenizer()
+    if inspect.isawaitable(tokenizer):
+        tokenizer = await tokenizer
+    global_tokenizer = tokenizer
+    load_chat_template(global_tokenizer, args.chat_template)
+    global_sessions = create_session_store(args)
+    global_budget = create_context_budget(args, global_llm)
+
+
+def prepare_request(data):
+    """构建提示和本次请求的采样参数"""
+    # 处理对话历史
+    messages = data['messages']
+
+    # 本次请求的采样参数, 没有覆盖时复用默认的
+    sampling_params = global_sampling_params
+    overrides = sampling_overrides(data)
+    if overrides:
+        try:
+            sampling_params = global_engine.SamplingParams(**{**global_sampling_kwargs, **overrides})
+        except (TypeError, ValueError) as e:
+            raise InvalidRequest(f"Invalid sampling parameters: {str(e)}")
+
+    # 构建提示: 会话请求只渲染新增的消息, 以 token id 提交
+    data['_turn'] = None
+    max_tokens = sampling_params.max_tokens
+    if data.get('session_id') is not None:
+        if global_sessions is None:
+            raise InvalidRequest("Sessions are disabled on this server")
+        data['_turn'] = global_sessions.begin(data['session_id'], messages, bool(data.get('new_session')))
+        if global_budget is not None:
+            # prompt 超出上下文窗口时截断会话最早的轮次 (重新建立会话) 或拒绝 (413)
+            data['_turn'], max_tokens = global_budget.fit_turn(global_sessions, data['_turn'], max_tokens)
+        prompt_text = data['_turn'].prompt()
+    elif global_budget is not None:
+        # prompt 超出上下文窗口时截断最早的轮次或拒绝 (413), 见 --context_policy
+        prompt_text, _, max_tokens = global_budget.fit(messages, max_tokens)
+    else:
+        prompt_text = global_tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=True
+        )
+    if max_tokens != sampling_params.max_tokens:
+        # 生成到上下文长度为止
+        sampling_params = global_engine.SamplingParams(
+            **{**global_sampling_kwargs, **overrides, "max_tokens": max_tokens})
+    return prompt_text, sampling_params
+
+
+def finish_request(data, output):
+    """回复生成完毕: 会话请求把这一轮记入会话"""
+    if data.get('_turn') is not None:
+        global_sessions.commit(data['_turn'], output.outputs[0].text)
+
+
+def not_ready():
+    """模型还在加载或预热: 503, 客户端 (或负载均衡) 稍后重试"""
+    return jsonify({"error": "Service is starting", "startup": global_startup.status()}), 503, {"Retry-After": "5"}
+
+
+def collect_stats():
+    """批处理、会话和回复缓存的统计"""
+    stats = {}
+    if hasattr(global_scheduler, "stats"):
+        stats["batching"] = global_scheduler.stats()
+    if global_sessions is not None:
+        stats["sessions"] = global_sessions.stats()
+    if global_cache is not None:
+        stats["response_cache"] = global_cache.stats()
+    if global_budget is not None:
+        stats["context"] = global_budget.stats()
+    return stats
+
+
+@app.route('/health', methods=['GET'])
+def health_endpoint():
+    """存活检查: 进程能响应即可, 启动失败时 503"""
+    status = 503 if global_startup.failed else 200
+    return jsonify({"status": "failed" if global_startup.failed else "ok", "startup": global_startup.status()}), status
+
+
+@app.route('/ready', methods=['GET'])
+def ready_endpoint():
+    """就绪检查: 模型加载并预热完成后 200, 之前 503"""
+    ready = global_startup.is_ready
+    return jsonify({"ready": ready, "startup": global_startup.status()}), 200 if ready else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 格式的指标"""
+    return Response(global_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    """服务统计"""
+    return jsonify({"startup": global_startup.status(), **collect_stats()})
+
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch_endpoint():
+    """批量推理: 请求体为 JSONL, 每行一个对话; 按输入顺序流式返回 JSONL 结果"""
+    if not global_startup.is_ready:
+        return not_ready()
+    chunk_size = request.args.get('chunk_size', global_bulk_chunk_size, type=int)
+    lines = enumerate(line.decode('utf-8', errors='replace') for line in request.stream)
+
+    def generate():
+        totals = {}
+        start = time.perf_counter()
+        for result in run_bulk(lines, prepare_request, global_scheduler, max(1, chunk_size), totals=totals):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        elapsed = time.perf_counter() - start
+        logging.info(f"Batch of {totals['requests']} requests: {totals['completion_tokens']} tokens generated, "
+                     f"{totals['completion_tokens'] / elapsed:.1f} tok/s")
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.route('/chat', methods=['POST'])
+def chat_endpoint():
+    """对话处理端点"""
+    if not global_startup.is_ready:
+        return not_ready()
+
+    # 解析请求数据
+    data = request.get_json()
+    if not data or 'messages' not in data:
+        return jsonify({"error": "Invalid request format"}), 400
+
+    timing = global_metrics.start()
+    try:
+        try:
+            prompt_text, sampling_params = prepare_request(data)
+        except InvalidRequest as e:
+            timing.finish(status="invalid")
+            return jsonify({"error": str(e)}), e.status
+        timing.templated()
+
+        # 流式输出: 每个 decode 步一个 server-sent event
+        if data.get("stream"):
+            chunks = on_finish(global_scheduler.stream(prompt_text, sampling_params),
+                               lambda output: finish_request(data, output))
+            chunks = timing.track(chunks)
+            response = Response(sse_stream(chunks), mimetype="text/event-stream", headers=SSE_HEADERS)
+            # 客户端在第一个分块之前断开时生成器从未启动, track() 的 finally 不会执行
+            response.call_on_close(lambda: timing.finish(status="cancelled"))
+            return response
+
+        # 生成回复 (与其他并发请求合并为一次 generate 调用)
+        output = global_scheduler.generate(prompt_text, sampling_params)
+        timing.first_token()
+        finish_request(data, output)
+        timing.finish(output)
+
+        return jsonify(global_build_reply(data, output))
+
+    except Exception as e:
+        logging.error(f"Error processing request: {str(e)}")
+        timing.finish(status="error")
+        return jsonify({"error": str(e)}), 500
+
+
+def build_parser():
+    """服务的命令行参数"""
+    parser = argparse.ArgumentParser(description='LLM API Service')
+    parser.add_argument("--chat_template", type=str, default=None)
+    parser.add_argument(
+        "--remove_chat_template",
+        action="store_true",
+        help="Disable chat template processing"
+    )
+    parser = add_engine_cli_args(parser)
+    parser = sampling_add_cli_args(parser)
+
+    # 添加服务专用参数
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--max_batch_size", type=int, default=None,
+                        help="max requests per generate call (default: --max-num-seqs)")
+    parser.add_argument("--batch_wait_ms", type=float, default=5.0,
+                        help="how long the first request of a batch waits for others")
+    parser.add_argument("--async_engine", action="store_true",
+                        help="serve with AsyncLLMEngine: token by token streaming and continuous batching")
+    parser.add_argument("--server", choices=["flask", "asgi"], default="flask",
+                        help="asgi: asyncio server (uvicorn) with AsyncLLMEngine and admission control")
+    parser.add_argument("--max_in_flight", type=int, default=None,
+                        help="asgi: max requests generating at once (default: --max-num-seqs)")
+    parser.add_argument("--max_queue", type=int, default=256,
+                        help="asgi: max requests waiting for a slot, beyond that 429")
+    parser.add_argument("--queue_timeout", type=float, default=30.0,
+                        help="asgi: seconds a request may wait for a slot before 503")
+    parser.add_argument("--max_context", type=int, default=None,
+                        help="context length that prompt + max_tokens must fit in (default: the model's)")
+    parser.add_argument("--context_policy", choices=["truncate", "reject", "off"], default="truncate",
+                        help="prompts that do not fit: drop the oldest turns (keeping system messages), or 413")
+    parser.add_argument("--session_memory_mb", type=int, default=256,
+                        help="memory budget of server-side sessions (0 disables sessions)")
+    parser.add_argument("--session_ttl", type=float, default=1800.0,
+                        help="seconds an idle session is kept")
+    parser.add_argument("--response_cache_mb", type=int, default=0,
+                        help="cache replies of greedy (temperature 0) requests, memory budget in MB (0: off)")
+    parser.add_argument("--response_cache_ttl", type=float, default=3600.0,
+                        help="seconds a cached reply stays valid")
+    parser.add_argument("--response_cache_dir", type=str, default=None,
+                        help="also keep cached replies in this directory (survives restarts)")
+    parser.add_argument("--log_requests", action="store_true",
+                        help="log one JSON line with the timings and token counts of every request")
+    parser.add_argument("--fast_start", action="store_true",
+                        help="bind first and load the model in the background; /chat and /ready answer 503 until ready")
+    parser.add_argument("--warmup_requests", type=int, default=8,
+                        help="requests generated as one batch before reporting ready (0: no warmup)")
+    parser.add_argument("--warmup_max_tokens", type=int, default=16,
+                        help="max_tokens of the warmup requests")
+    parser.add_argument("--warmup_file", type=str, default=None,
+                        help="JSONL of representative conversations for the warmup (same format as --bulk_input)")
+    parser.add_argument("--bulk_input", type=str, default=None,
+                        help="run a JSONL file of conversations offline instead of serving, then exit")
+    parser.add_argument("--bulk_output", type=str, default=None,
+                        help="JSONL results in input order (default: <bulk_input>.out.jsonl), resumes from <bulk_output>.ckpt")
+    parser.add_argument("--bulk_chunk_size", type=int, default=256,
+                        help="conversations handed to the engine at once, in bulk mode and /chat/batch")
+    parser.add_argument("--bulk_prompt_field", type=str, default="prompt",
+                        help="bulk lines without messages use this field as a single user message")
+    return parser
+
+
+def main(build_reply, sampling_kwargs=None, started=None):
+    """解析参数, 然后离线批量推理或启动服务"""
+    global global_build_reply, global_sampling_kwargs, global_bulk_chunk_size, global_startup, global_metrics
+
+    # 参数解析
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.bulk_input and args.server == "asgi":
+        parser.error("--bulk_input runs without a server, drop --server asgi")
+    if args.bulk_input and not args.max_batch_size:
+        # 离线模式没有并发请求, 每块一次 generate 调用
+        args.max_batch_size = args.bulk_chunk_size
+    global_build_reply = build_reply
+    global_sampling_kwargs = dict(sampling_kwargs) if sampling_kwargs is not None else None
+    global_bulk_chunk_size = max(1, args.bulk_chunk_size)
+    if started is not None:
+        global_startup = Startup(started)
+    global_startup.record("imports")
+    global_metrics = create_metrics(args)
+
+    # 离线批量推理
+    if args.bulk_input:
+        initialize_service(args)
+        totals = run_file(args.bulk_input, args.bulk_output or args.bulk_input + ".out.jsonl", prepare_request,
+                          global_scheduler, global_bulk_chunk_size, args.bulk_prompt_field)
+        print(f"Done: {totals['requests']} requests, {totals['prompt_tokens']} prompt tokens, "
+              f"{totals['completion_tokens']} tokens generated in {totals['seconds']}s "
+              f"({totals['tokens_per_s']} tok/s)")
+        sys.exit(0)
+
+    # 启动服务
+    if args.server == "asgi":
+        import uvicorn  # 只有 ASGI 模式需要
+
+        max_in_flight = args.max_in_flight or getattr(args, "max_num_seqs", None) or 64
+        admission = AdmissionController(max_in_flight, args.max_queue, args.queue_timeout)
+        asgi_app = None
+
+        async def on_startup():
+            # uvicorn 在启动钩子返回后才绑定端口; --fast_start 时不等模型加载
+            global_startup.task = asyncio.ensure_future(start_asgi(args, asgi_app))
+            if not args.fast_start:
+                await global_startup.task
+
+        # 引擎在 start_asgi 里加载完成后设置
+        asgi_app = ChatApp(None, prepare_request, build_reply, admission, on_startup=[on_startup],
+                           finish=finish_request, stats=collect_stats, metrics=global_metrics, startup=global_startup)
+        uvicorn.run(asgi_app, host=args.host, port=args.port, log_level="debug" if args.debug else "info")
+    else:
+        if args.fast_start:
+            # 先绑定端口, 模型在后台加载, 就绪前 /chat 返回 503
+            threading.Thread(target=start_service, args=(args,), name="startup", daemon=True).start()
+        else:
+            start_service(args)
+        app.run(
+            host=args.host,
+            port=args.port,
+            debug=args.debug,
+            use_reloader=False  # 必须关闭reloader以保证单进程
+        )
@@ -0,0 +1,211 @@
+import collections
+import hashlib
+import json
+import threading
+
+from batching import InvalidRequest
+from sessions import ANCHOR_USER
+
+# 按 token 预算接纳请求: prompt 必须放进模型的上下文窗口, max_tokens 截到剩下的空间
+#   (和 vLLM 一样, 生成到上下文长度为止; 超大的 max_tokens 不会导致截断或拒绝)
+#   每条消息的 token 数按内容缓存, 长对话每轮只需要给新消息分词;
+#   估算值接近上限时再对渲染好的完整 prompt 精确分词 (消息边界上的分词可能相差几个 token)
+#   放不下时按策略处理: truncate 从最早的轮次开始丢弃 (保留开头的 system 消息和最后一条消息), reject 直接返回 413
+#   会话请求同样处理: 截断时用保留下来的历史重新建立会话
+
+DEFAULT_OVERHEAD = 8  # 无法从模板测出时, 每条消息的格式开销
+
+
+class PromptTooLong(InvalidRequest):
+    status = 413
+
+
+class ContextBudget:
+    """检查并截断对话, 使 prompt 不超过 max_context, 并把 max_tokens 截到剩余空间
+
+    max_context: 模型的上下文长度 (max_model_len)
+    policy: "truncate" 或 "reject"
+    max_cached: 缓存 token 数的消息条数上限 (LRU)
+    """
+
+    def __init__(self, tokenizer, max_context, policy="truncate", max_cached=65536):
+        self.tokenizer = tokenizer
+        self.max_context = max_context
+        self.policy = policy
+        self.max_cached = max_cached
+        self.counts = collections.OrderedDict()  # 消息摘要 -> token 数
+        self.overheads = {}  # role -> 模板给一条消息加的 token 数
+        self.lock = threading.Lock()
+        try:
+            base = self.render([ANCHOR_USER], add_generation_prompt=False)
+            self.generation_tokens = self.encode_len(self.render([ANCHOR_USER])[len(base):])
+        except Exception:
+            self.generation_tokens = DEFAULT_OVERHEAD
+        # 统计信息
+        self.checked = 0
+        self.truncated = 0
+        self.dropped_messages = 0
+        self.rejected = 0
+        self.capped = 0
+        self.exact_counts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, messages, add_generation_prompt=True):
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    def encode_len(self, text):
+        # 模板渲染结果里已经带了特殊 token
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def overhead(self, role):
+        """模板给一条 role 消息加的 token 数 (角色标记、分隔符等)"""
+        overhead = self.overheads.get(role)
+        if overhead is None:
+            prefix = [ANCHOR_USER] if role == "assistant" else []
+            try:
+                base = self.render(prefix, add_generation_prompt=False) if prefix else ""
+                text = self.render(prefix + [{"role": role, "content": "hi"}], add_generation_prompt=False)
+                text = text[len(base):] if text.startswith(base) else text
+                overhead = max(0, self.encode_len(text) - self.encode_len("hi"))
+            except Exception:
+                overhead = DEFAULT_OVERHEAD  # 模板不接受单独的这种消息
+            self.overheads[role] = overhead
+        return overhead
+
+    def count(self, message):
+        """一条消息的 token 数 (内容 + 格式开销), 按内容摘要缓存"""
+        role = message.get("role")
+        content = message.get("content")
+        if content is None:
+            content = ""
+        elif not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)  # 结构化内容, 近似
+        key = hashlib.blake2b(f"{role}\0{content}".encode("utf-8"), digest_size=16).digest()
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+                self.hits += 1
+                return count
+        count = self.encode_len(content) + self.overhead(role)
+        with self.lock:
+            self.misses += 1
+            self.counts[key] = count
+            while len(self.counts) > self.max_cached:
+                self.counts.popitem(last=False)
+        return count
+
+    def reject(self, prompt_tokens, hint=""):
+        with self.lock:
+            self.rejected += 1
+        raise PromptTooLong(f"Prompt of {prompt_tokens} tokens does not fit the context window of "
+                            f"{self.max_context} tokens{hint}")
+
+    def cap(self, max_tokens, room):
+        """max_tokens 截到生成可用的 token 数 room (未指定时即为 room)"""
+        if not max_tokens:
+            return room
+        if max_tokens <= room:
+            return max_tokens
+        with self.lock:
+            self.capped += 1
+        return room
+
+    def fit(self, messages, max_tokens):
+        """返回 (prompt 文本, 丢弃的消息数, 截到剩余空间的 max_tokens);
+        截断后仍然放不下或策略为 reject 时抛出 PromptTooLong"""
+        kept, prompt, room = self.trim(messages)
+        return prompt, len(messages) - len(kept), self.cap(max_tokens, room)
+
+    def trim(self, messages):
+        """返回 (保留的消息, prompt 文本, 留给生成的 token 数); 只有 prompt 本身放不下时才截断"""
+        limit = self.max_context - 1  # 至少生成一个 token
+        counts = [self.count(m) for m in messages]
+        total = sum(counts) + self.generation_tokens
+        # 开头的 system 消息始终保留, 从它后面开始丢弃
+        start = 0
+        while start < len(messages) - 1 and messages[start].get("role") == "system":
+            start += 1
+        keep_from = start
+
+        def drop_turn(keep_from, total):
+            """丢掉最早的一轮, 直到下一条 user 消息 (模板通常要求 user / assistant 交替)"""
+            total -= counts[keep_from]
+            keep_from += 1
+            while keep_from < len(messages) - 1 and messages[keep_from].get("role") != "user":
+                total -= counts[keep_from]
+                keep_from += 1
+            return keep_from, total
+
+        with self.lock:
+            self.checked += 1
+        if total > limit:
+            if self.policy != "truncate":
+                self.reject(total)
+            while total > limit and keep_from < len(messages) - 1:
+                keep_from, total = drop_turn(keep_from, total)
+            if total > limit:
+                self.reject(total, " even with only the system prompt and the last message")
+
+        kept = messages[:start] + messages[keep_from:]
+        prompt = self.render(kept)
+        # 估算值可能比实际少几个 token (消息边界), 留出余量
+        slack = len(kept) + DEFAULT_OVERHEAD
+        room = self.max_context - total - slack
+        if room < 1:
+            # 接近上限: 按渲染结果精确计数
+            with self.lock:
+                self.exact_counts += 1
+            exact = self.encode_len(prompt)
+            while exact > limit:
+                if self.policy != "truncate" or keep_from >= len(messages) - 1:
+                    self.reject(exact)
+                keep_from, total = drop_turn(keep_from, total)
+                kept = messages[:start] + messages[keep_from:]
+                prompt = self.render(kept)
+                exact = self.encode_len(prompt)
+            room = self.max_context - exact
+
+        dropped = keep_from - start
+        if dropped:
+            with self.lock:
+                self.truncated += 1
+                self.dropped_messages += dropped
+        return kept, prompt, room
+
+    def fit_turn(self, sessions, turn, max_tokens):
+        """会话请求 (SessionStore.begin 的 Turn): 返回 (Turn, 截到剩余空间的 max_tokens);
+        prompt 放不下时截断会话的完整历史, 返回的是重新建立会话的 Turn"""
+        prompt_tokens = len(turn.prompt_ids)
+        if self.policy == "truncate" and prompt_tokens >= self.max_context:
+            kept, _, _ = self.trim(sessions.history(turn))
+            turn = sessions.begin(turn.session_id, kept, new_session=True)
+            # 会话的 token 按消息分段渲染, 与整段渲染可能相差几个 token
+            prompt_tokens = len(turn.prompt_ids)
+        return turn, self.check_tokens(prompt_tokens, max_tokens, "; start a new session with a shorter history")
+
+    def check_tokens(self, prompt_tokens, max_tokens, hint=""):
+        """已经分好词的 prompt (会话请求) 只检查, 不截断; 返回截到剩余空间的 max_tokens"""
+        with self.lock:
+            self.checked += 1
+        if prompt_tokens >= self.max_context:
+            self.reject(prompt_tokens, hint)
+        return self.cap(max_tokens, self.max_context - prompt_tokens)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "max_context": self.max_context,
+                "policy": self.policy,
+                "checked": self.checked,
+                "truncated": self.truncated,
+                "dropped_messages": self.dropped_messages,
+                "rejected": self.rejected,
+                "capped": self.capped,
+                "exact_counts": self.exact_counts,
+                "cached_messages": len(self.counts),
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+            }
@@ -1,41 +1,242 @@
-from typing import List, Union, Generator, Iterator
+from typing import List, Union, Generator, Iterator, Optional
+from collections import OrderedDict
+from urllib.parse import urljoin
+import asyncio
+import hashlib
+import json
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+
+
+class Backend:
+    # One replica of the chat service: a keep-alive connection pool plus load and health state
+    def __init__(self, url: str, pool_size: int = 32):
+        self.url = url
+        self.ready_url = urljoin(url, "/ready")
+        self.session = requests.Session()
+        self.session.mount(urljoin(url, "/"), HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.outstanding = 0
+        self.latency = 0.0  # EWMA of the time to response headers, 0 until measured
+        self.failures = 0  # consecutive failures
+        self.ejected_until = 0.0
+        self.sessions_enabled = True  # False once it answered that it runs with --session_memory_mb 0
+
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    def record(self, latency: float, alpha: float = 0.3):
+        self.latency = latency if not self.latency else (1 - alpha) * self.latency + alpha * latency
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def record_failure(self, base_delay: float, max_delay: float):
+        # Eject for an exponentially growing period; the prober or the next pick after it lets it back in
+        self.failures += 1
+        self.ejected_until = time.monotonic() + min(max_delay, base_delay * 2 ** (self.failures - 1))
 
 
 class Pipeline:
     def __init__(self):
         self.name = "deepseek(external)"
-        self.external_url = f"http://100.84.87.212:5000/chat"
+        # Replicas of the chat service, add more to scale out
+        self.external_urls = [f"http://100.84.87.212:5000/chat"]
+        # "least_outstanding": fewest requests in flight; "latency": lowest recent time to first byte
+        self.routing = "least_outstanding"
+        self.timeout = (3.05, 120)  # connect, read (between streamed chunks)
+        self.eject_delay = 5.0
+        self.max_eject_delay = 60.0
+        self.probe_interval = 5.0
+        self.backends = [Backend(url) for url in self.external_urls]
+        self.lock = threading.Lock()
+        self.probe_task = None
+        # chat_id -> (number of messages the server session holds, digest of those messages, backend url)
+        self.sessions = OrderedDict()
+        self.max_sessions = 1024
         pass
 
     async def on_startup(self):
-        pass
+        self.probe_task = asyncio.create_task(self.probe_loop())
 
     async def on_shutdown(self):
-        pass
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+            self.probe_task = None
+        for backend in self.backends:
+            backend.session.close()
+
+    async def probe_loop(self):
+        # Probe every backend once at startup, then only the ejected ones
+        first = True
+        while True:
+            for backend in self.backends:
+                if first or backend.ejected():
+                    await asyncio.to_thread(self.probe, backend)
+            first = False
+            await asyncio.sleep(self.probe_interval)
+
+    def probe(self, backend: Backend):
+        # A replica still loading or warming up its model answers 503 and stays ejected; any other
+        # HTTP answer means it is up (older services have no /ready and answer 404)
+        start = time.perf_counter()
+        try:
+            r = backend.session.get(backend.ready_url, timeout=(self.timeout[0], 5))
+            r.close()
+        except requests.RequestException:
+            r = None
+        with self.lock:
+            if r is None or r.status_code == 503:
+                backend.record_failure(self.eject_delay, self.max_eject_delay)
+            else:
+                backend.record(time.perf_counter() - start)
+
+    def pick(self, chat_id: Optional[str], tried: set) -> Optional[Backend]:
+        with self.lock:
+            candidates = [b for b in self.backends if b.url not in tried]
+            if not candidates:
+                return None
+            # When every replica is ejected, still try the one that comes back first
+            healthy = [b for b in candidates if not b.ejected()] or [min(candidates, key=lambda b: b.ejected_until)]
+            known = self.sessions.get(chat_id) if chat_id else None
+            sticky = [b for b in healthy if known and b.url == known[2]]
+            if sticky:
+                # The replica holding the conversation can reuse its prefix cache
+                backend = sticky[0]
+            elif self.routing == "latency":
+                backend = min(healthy, key=lambda b: (b.latency, b.outstanding))
+            else:
+                backend = min(healthy, key=lambda b: (b.outstanding, b.latency))
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend: Backend):
+        with self.lock:
+            backend.outstanding -= 1
+
+    def post(self, backend: Backend, payload: dict):
+        start = time.perf_counter()
+        r = backend.session.post(
+            url=backend.url,
+            json=payload,
+            headers={"Content-Type": "application/json"},
+            stream=True,
+            timeout=self.timeout,
+        )
+        with self.lock:
+            backend.record(time.perf_counter() - start)
+        return r
 
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
-        headers = {
-            "Content-Type": "application/json"
-        }
         payload = {
             "messages":messages,
             "max_tokens": 5000,
             "stream": True,
         }
-        try:
-            r = requests.post(
-                url=self.external_url,
-                json=payload,
-                headers=headers,
-                stream=True,
-            )
+        chat_id = body.get("chat_id") or (body.get("metadata") or {}).get("chat_id")
+        tried = set()
+        error = "no backend available"
+        # Try each replica at most once: unreachable ones are ejected, overloaded ones skipped
+        while True:
+            backend = self.pick(chat_id, tried)
+            if backend is None:
+                return f"Error: {error}"
+            tried.add(backend.url)
+            request = dict(payload)
+            if chat_id and backend.sessions_enabled:
+                # Server-side session: send only the turns this replica has not seen yet
+                request["session_id"] = chat_id
+                known = self.sessions.get(chat_id)
+                if (known and known[2] == backend.url and len(messages) > known[0]
+                        and self.digest(messages[:known[0]]) == known[1]):
+                    request["messages"] = messages[known[0]:]
+                else:
+                    request["new_session"] = True
+            try:
+                r = self.post(backend, request)
+                if r.status_code == 404 and chat_id and not request.get("new_session"):
+                    # Session expired on the server: start over with the full history
+                    r.close()
+                    request.update(messages=messages, new_session=True)
+                    r = self.post(backend, request)
+                if r.status_code == 400 and "session_id" in request and "Sessions are disabled" in r.text:
+                    # Replica without server-side sessions: send the full history from now on
+                    r.close()
+                    backend.sessions_enabled = False
+                    request = dict(payload)
+                    r = self.post(backend, request)
+            except requests.RequestException as e:
+                with self.lock:
+                    backend.record_failure(self.eject_delay, self.max_eject_delay)
+                self.release(backend)
+                error = f"{backend.url}: {e}"
+                continue
+            if r.status_code in (429, 502, 503, 504):
+                # Queue full or replica not ready: another replica may have room
+                r.close()
+                if r.status_code in (502, 504):
+                    with self.lock:
+                        backend.record_failure(self.eject_delay, self.max_eject_delay)
+                self.release(backend)
+                error = f"{backend.url}: HTTP {r.status_code}"
+                continue
+            try:
+                r.raise_for_status()
+            except Exception as e:
+                r.close()
+                self.release(backend)
+                return f"Error: {e}"
 
-            r.raise_for_status()
+            return self.iter_deltas(r, backend, chat_id if "session_id" in request else None, messages)
 
-            return r.iter_lines()
+    @staticmethod
+    def digest(messages: List[dict]) -> str:
+        data = json.dumps([(m.get("role"), m.get("content")) for m in messages], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
-        except Exception as e:
-            return f"Error: {e}"
+    def remember(self, chat_id, messages: List[dict], reply: str, backend: Backend):
+        # The server session on this replica now holds messages + the reply
+        history = messages + [{"role": "assistant", "content": reply}]
+        with self.lock:
+            self.sessions[chat_id] = (len(history), self.digest(history), backend.url)
+            self.sessions.move_to_end(chat_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def iter_deltas(self, r, backend: Backend, chat_id=None, messages=None) -> Iterator[str]:
+        try:
+            # Server-sent events of the chat service: {"delta": ...} per decode step, then [DONE]
+            if not r.headers.get("Content-Type", "").startswith("text/event-stream"):
+                # Service without streaming: the whole reply at once
+                data = r.json()
+                yield data["response"] if isinstance(data, dict) else "".join(data)
+                return
+            r.encoding = "utf-8"
+            reply = []
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    if chat_id:
+                        self.remember(chat_id, messages, "".join(reply), backend)
+                    break
+                event = json.loads(data)
+                if "error" in event:
+                    yield f"Error: {event['error']}"
+                    with self.lock:
+                        self.sessions.pop(chat_id, None)
+                    break
+                if event.get("delta"):
+                    reply.append(event["delta"])
+                    yield event["delta"]
+        except requests.RequestException as e:
+            # Read timeout or dropped connection mid-stream
+            with self.lock:
+                backend.record_failure(self.eject_delay, self.max_eject_delay)
+            yield f"Error: {e}"
+        finally:
+            r.close()
+            self.release(backend)
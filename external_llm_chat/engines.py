@@ -0,0 +1,97 @@
+import dataclasses
+
+from stub_engine import AsyncStubEngine, StubLLM
+from stub_engine import SamplingParams as StubSamplingParams
+
+# 服务背后的推理引擎 (--engine), global_llm 只依赖以下接口:
+#   create_llm(): 同步引擎, generate(prompts, sampling_params, use_tqdm=False) 与 get_tokenizer()
+#   create_async_engine(): 异步引擎, async generate(prompt, sampling_params, request_id)、abort(request_id) 与 get_tokenizer()
+#   SamplingParams: 该引擎的采样参数类型
+#   model: 模型名, 用作回复缓存的命名空间
+#   max_context(engine): 模型的上下文长度 (max_model_len), 用于 prompt 的 token 预算
+# stub 在 CPU 上模拟 prefill / decode 耗时和批处理扩展 (stub_engine.py), 没有 GPU 和模型也能压测服务层
+
+
+class VllmEngine:
+    """vLLM 的 LLM / AsyncLLMEngine, 参数来自 EngineArgs 的命令行参数"""
+
+    def __init__(self, args):
+        import vllm  # 只有 vllm 引擎需要
+
+        self.vllm = vllm
+        self.SamplingParams = vllm.SamplingParams
+        self.model = str(args.model)
+        self.params = {field.name: getattr(args, field.name) for field in dataclasses.fields(vllm.EngineArgs)}
+
+    def create_llm(self):
+        return self.vllm.LLM(**self.params)
+
+    def create_async_engine(self):
+        return self.vllm.AsyncLLMEngine.from_engine_args(self.vllm.AsyncEngineArgs(**self.params))
+
+    def max_context(self, engine):
+        if self.params.get("max_model_len"):
+            return self.params["max_model_len"]
+        # LLM.llm_engine / AsyncLLMEngine.engine 上的模型配置, 版本不同位置不同
+        for owner in (engine, getattr(engine, "llm_engine", None), getattr(engine, "engine", None)):
+            config = getattr(owner, "model_config", None)
+            if config is not None:
+                return config.max_model_len
+        return None
+
+
+class StubEngine:
+    """CPU 上的 stub 引擎, 输出只由 prompt 和 seed 决定"""
+
+    SamplingParams = StubSamplingParams
+    model = "stub"
+
+    def __init__(self, args):
+        self.params = {
+            "prefill_ms_per_token": args.stub_prefill_ms_per_token,
+            "decode_ms_per_step": args.stub_decode_ms_per_step,
+            "batch_scaling": args.stub_batch_scaling,
+            "max_output_tokens": args.stub_max_output_tokens,
+            "max_model_len": args.stub_max_model_len,
+        }
+
+    def create_llm(self):
+        return StubLLM(**self.params)
+
+    def create_async_engine(self):
+        return AsyncStubEngine(self.create_llm())
+
+    def max_context(self, engine):
+        return getattr(engine, "llm", engine).max_model_len
+
+
+ENGINES = {"vllm": VllmEngine, "stub": StubEngine}
+
+
+def add_engine_cli_args(parser):
+    """--engine 以及各引擎的参数; 没有安装 vllm 时只能使用 stub"""
+    try:
+        from vllm import EngineArgs
+    except ImportError:
+        EngineArgs = None
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="vllm" if EngineArgs is not None else "stub",
+                        help="stub: simulated CPU engine for load testing the service without a GPU or model")
+    if EngineArgs is not None:
+        parser = EngineArgs.add_cli_args(parser)
+    parser.add_argument("--stub_prefill_ms_per_token", type=float, default=0.05,
+                        help="stub: prefill time per prompt token")
+    parser.add_argument("--stub_decode_ms_per_step", type=float, default=10.0,
+                        help="stub: time of one decode step with a single sequence")
+    parser.add_argument("--stub_batch_scaling", type=float, default=0.02,
+                        help="stub: extra step time per additional running sequence (fraction)")
+    parser.add_argument("--stub_max_output_tokens", type=int, default=128,
+                        help="stub: replies are 8 to 8 + this many tokens, capped by max_tokens")
+    parser.add_argument("--stub_max_model_len", type=int, default=4096,
+                        help="stub: context length, longer prompts fail like in vLLM")
+    return parser
+
+
+def create_engine(args):
+    if args.engine == "vllm" and not hasattr(args, "model"):
+        raise RuntimeError("vllm is not installed, use --engine stub")
+    return ENGINES[args.engine](args)
@@ -0,0 +1,200 @@
+import argparse
+import collections
+import http.client
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from bench_batching import percentile
+from bulk import to_request
+
+# /chat 的压测工具: 回放 JSONL 流量 (每行一个对话 {"messages": ...}, 或 requests.jsonl 这样以某个字段为问题的记录)
+#   闭环 (--concurrency N): N 个客户端, 每个收到完整回复后立即发送下一个请求
+#   开环 (--rate R): 请求按到达过程 (泊松或均匀) 每秒发出 R 个, 不等前面的请求完成; 延迟从计划发出的时刻算起
+# 报告延迟和首 token 时间 (TTFT) 的 p50/p95/p99、吞吐和错误率
+#   python run.py --engine stub &
+#   python loadgen.py --input ../requests.jsonl --concurrency 32 --requests 500
+#   python loadgen.py --input ../requests.jsonl --rate 20 --requests 1000
+
+
+def load_requests(path, prompt_field, max_tokens):
+    requests = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = to_request(json.loads(line), prompt_field)
+            if max_tokens:
+                data.setdefault("max_tokens", max_tokens)
+            requests.append(data)
+    if not requests:
+        raise SystemExit(f"No requests in {path}")
+    return requests
+
+
+class Client:
+    """POST /chat, 每个线程一条 keep-alive 连接"""
+
+    def __init__(self, url, timeout=300.0, stream=True):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/chat"
+        self.timeout = timeout
+        self.stream = stream
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def chat(self, data, start):
+        """发送一个请求, start 是计时起点 (perf_counter); 返回 {"status", "latency", "ttft", "tokens"}"""
+        body = json.dumps({**data, "stream": self.stream}, ensure_ascii=False).encode("utf-8")
+        conn = self.connection()
+        ttft = tokens = None
+        try:
+            conn.request("POST", self.path, body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            if response.status != 200:
+                response.read()
+                return {"status": str(response.status), "latency": time.perf_counter() - start}
+            if not response.getheader("Content-Type", "").startswith("text/event-stream"):
+                response.read()
+                latency = time.perf_counter() - start
+                return {"status": "ok", "latency": latency, "ttft": latency}
+            status = "incomplete stream"
+            for line in iter(response.readline, b""):
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[len(b"data:"):].strip()
+                if payload == b"[DONE]":
+                    if status == "incomplete stream":
+                        status = "ok"
+                    break
+                event = json.loads(payload)
+                if "error" in event:
+                    status = "stream error"
+                elif event.get("delta") and ttft is None:
+                    ttft = time.perf_counter() - start
+                elif "usage" in event:
+                    tokens = event["usage"]["completion_tokens"]
+            response.read()
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            conn.close()
+            self.local.conn = None
+            return {"status": type(e).__name__, "latency": time.perf_counter() - start}
+        latency = time.perf_counter() - start
+        return {"status": status, "latency": latency, "ttft": ttft if ttft is not None else latency, "tokens": tokens}
+
+
+def closed_loop(client, requests, concurrency):
+    """concurrency 个客户端各自串行发送"""
+    results = []
+    lock = threading.Lock()
+    pending = iter(requests)
+
+    def worker():
+        for data in pending:
+            result = client.chat(data, time.perf_counter())
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def open_loop(client, requests, rate, arrival="poisson", max_connections=512, seed=0):
+    """按到达过程发送, 与响应快慢无关; 连接用满时请求在客户端等待, 这段时间也计入延迟"""
+    rng = random.Random(seed)
+    pool = ThreadPoolExecutor(max_connections)
+    futures = []
+    scheduled = time.perf_counter()
+    for data in requests:
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(pool.submit(client.chat, data, scheduled))
+        scheduled += rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+    results = [future.result() for future in futures]
+    pool.shutdown()
+    return results
+
+
+def summarize(results, wall):
+    ok = [r for r in results if r["status"] == "ok"]
+    errors = collections.Counter(r["status"] for r in results if r["status"] != "ok")
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok]
+    tokens = [r["tokens"] for r in ok if r.get("tokens") is not None]
+    summary = {
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "errors": dict(errors),
+        "wall": round(wall, 3),
+        "requests_per_s": round(len(ok) / wall, 2),
+        # 只有流式请求能拿到 token 数
+        "tokens_per_s": round(sum(tokens) / wall, 1) if tokens else None,
+    }
+    for name, values in (("latency", latencies), ("ttft", ttfts)):
+        for q in (50, 95, 99):
+            summary[f"{name}_p{q}"] = round(percentile(values, q), 4) if values else None
+        summary[f"{name}_mean"] = round(sum(values) / len(values), 4) if values else None
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the /chat service")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:5000/chat")
+    parser.add_argument("--input", type=str, required=True, help="JSONL file of conversations to replay")
+    parser.add_argument("--prompt_field", type=str, default="body",
+                        help="lines without messages send this field as a single user message")
+    parser.add_argument("--requests", type=int, default=None,
+                        help="requests to send, cycling through the input (default: one per line)")
+    parser.add_argument("--concurrency", type=int, default=16, help="closed loop: clients sending back to back")
+    parser.add_argument("--rate", type=float, default=None, help="open loop: requests per second")
+    parser.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson",
+                        help="open loop: spacing of arrivals")
+    parser.add_argument("--max_connections", type=int, default=512, help="open loop: max requests outstanding")
+    parser.add_argument("--max_tokens", type=int, default=128, help="for lines that do not set max_tokens (0: keep)")
+    parser.add_argument("--no_stream", action="store_true",
+                        help="non-streaming requests (TTFT equals latency, no token counts)")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=str, default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    inputs = load_requests(args.input, args.prompt_field, args.max_tokens)
+    requests = list(itertools.islice(itertools.cycle(inputs), args.requests or len(inputs)))
+    client = Client(args.url, args.timeout, stream=not args.no_stream)
+
+    start = time.perf_counter()
+    if args.rate:
+        results = open_loop(client, requests, args.rate, args.arrival, args.max_connections, args.seed)
+    else:
+        results = closed_loop(client, requests, args.concurrency)
+    summary = summarize(results, time.perf_counter() - start)
+
+    mode = f"open loop, {args.rate} req/s ({args.arrival})" if args.rate else f"closed loop, concurrency {args.concurrency}"
+    print(f"{mode}: {summary['requests']} requests in {summary['wall']:.2f}s")
+    print(f"  throughput  {summary['requests_per_s']:.1f} req/s"
+          + (f", {summary['tokens_per_s']:.1f} tok/s" if summary["tokens_per_s"] is not None else ""))
+    print(f"  errors      {summary['error_rate']:.2%} {summary['errors'] or ''}")
+    for name in ("latency", "ttft"):
+        if summary[f"{name}_p50"] is not None:
+            print(f"  {name:<10}  p50 {summary[f'{name}_p50']:.3f}s  p95 {summary[f'{name}_p95']:.3f}s  "
+                  f"p99 {summary[f'{name}_p99']:.3f}s  mean {summary[f'{name}_mean']:.3f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": summary}, f, indent=2)
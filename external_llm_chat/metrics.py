@@ -0,0 +1,272 @@
+import bisect
+import contextvars
+import json
+import logging
+import threading
+import time
+
+# 服务指标, Prometheus 文本格式 (GET /metrics), 不依赖 prometheus_client
+# 每个请求一个 RequestTiming, 记录各阶段的时间点, 结束时一次性写入直方图;
+# --log_requests 时再输出一行 JSON (logger "chat.requests")
+
+# 当前线程 / 协程正在处理的请求, BatchScheduler 用它记录排队时间
+current_request = contextvars.ContextVar("current_request", default=None)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+FAST_SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+REQUEST_LOG = logging.getLogger("chat.requests")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            yield f"{self.name}{{{labels}}} {format_value(value)}" if labels else f"{self.name} {format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}'
+        yield f"{self.name}_sum {format_value(total)}"
+        yield f"{self.name}_count {cumulative}"
+
+
+class ChatMetrics:
+    """/chat 的指标; collectors 里的函数在每次抓取时返回 (name, type, help, value) 列表"""
+
+    def __init__(self, log_requests=False):
+        self.requests = Counter("chat_requests_total", "Chat requests by outcome.", ("status",))
+        self.queue_wait = Histogram("chat_queue_wait_seconds",
+                                    "Time a request waited for a batch or an admission slot.", SECONDS_BUCKETS)
+        self.template = Histogram("chat_template_seconds",
+                                  "Time spent rendering the chat template and sampling parameters.",
+                                  FAST_SECONDS_BUCKETS)
+        self.ttft = Histogram("chat_time_to_first_token_seconds",
+                              "Time until the first generated text was sent (whole reply when not streaming).",
+                              SECONDS_BUCKETS)
+        self.latency = Histogram("chat_request_latency_seconds", "Total request latency.", SECONDS_BUCKETS)
+        self.prompt_tokens = Histogram("chat_prompt_tokens", "Prompt tokens per request.", TOKEN_BUCKETS)
+        self.completion_tokens = Histogram("chat_completion_tokens", "Generated tokens per request.", TOKEN_BUCKETS)
+        self.tokens_per_second = Histogram("chat_generation_tokens_per_second",
+                                           "Generated tokens per second from leaving the queue to the end, per request.",
+                                           RATE_BUCKETS)
+        self.batch_size = Histogram("chat_batch_size", "Requests per generate call.", BATCH_BUCKETS)
+        self.histograms = [self.queue_wait, self.template, self.ttft, self.latency, self.prompt_tokens,
+                           self.completion_tokens, self.tokens_per_second, self.batch_size]
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.collectors = []
+        self.log_requests = log_requests
+        if log_requests:
+            REQUEST_LOG.setLevel(logging.INFO)
+            if not REQUEST_LOG.handlers:
+                REQUEST_LOG.addHandler(logging.StreamHandler())
+
+    def start(self):
+        """开始计时一个请求, 并设为当前请求"""
+        with self.lock:
+            self.in_flight += 1
+        timing = RequestTiming(self)
+        current_request.set(timing)
+        return timing
+
+    def render(self):
+        lines = ["# HELP chat_requests_in_flight Requests being processed.",
+                 "# TYPE chat_requests_in_flight gauge",
+                 f"chat_requests_in_flight {self.in_flight}"]
+        lines += self.requests.render()
+        for histogram in self.histograms:
+            lines += histogram.render()
+        for collector in self.collectors:
+            for name, kind, documentation, value in collector():
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {format_value(value)}"]
+        return "\n".join(lines) + "\n"
+
+
+class RequestTiming:
+    """一个请求各阶段的时间点 (time.perf_counter)"""
+
+    __slots__ = ("metrics", "start", "templated_at", "queued_at", "dequeued_at", "first_token_at", "finished")
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.templated_at = None
+        self.queued_at = None
+        self.dequeued_at = None
+        self.first_token_at = None
+        self.finished = False
+
+    def templated(self):
+        self.templated_at = time.perf_counter()
+
+    def queue_start(self):
+        self.queued_at = time.perf_counter()
+
+    def queue_end(self):
+        if self.queued_at is not None:
+            self.dequeued_at = time.perf_counter()
+
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def track(self, chunks):
+        """透传 (新增文本, RequestOutput), 记录首个 token 的时间, 结束时 finish"""
+        output = None
+        status = "error"
+        try:
+            for delta, output in chunks:
+                if delta:
+                    self.first_token()
+                yield delta, output
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        finally:
+            self.finish(output, status)
+
+    def finish(self, output=None, status="ok"):
+        """记录指标, 重复调用时忽略"""
+        if self.finished:
+            return
+        self.finished = True
+        end = time.perf_counter()
+        metrics = self.metrics
+        with metrics.lock:
+            metrics.in_flight -= 1
+        metrics.requests.inc(status)
+        template = self.templated_at - self.start if self.templated_at is not None else None
+        if template is not None:
+            metrics.template.observe(template)
+        queue_wait = self.dequeued_at - self.queued_at if self.dequeued_at is not None else None
+        if queue_wait is not None:
+            metrics.queue_wait.observe(queue_wait)
+
+        # 延迟和 token 数只统计完整生成的请求
+        ttft = prompt_tokens = completion_tokens = tokens_per_second = None
+        if status == "ok" and output is not None:
+            first_token_at = self.first_token_at or end
+            ttft = first_token_at - self.start
+            prompt_tokens = len(output.prompt_token_ids or [])
+            completion_tokens = len(output.outputs[0].token_ids)
+            generation_time = end - (self.dequeued_at or self.templated_at or self.start)
+            if completion_tokens and generation_time > 0:
+                tokens_per_second = completion_tokens / generation_time
+                metrics.tokens_per_second.observe(tokens_per_second)
+            metrics.latency.observe(end - self.start)
+            metrics.ttft.observe(ttft)
+            metrics.prompt_tokens.observe(prompt_tokens)
+            metrics.completion_tokens.observe(completion_tokens)
+
+        if metrics.log_requests:
+            milliseconds = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+            REQUEST_LOG.info(json.dumps({
+                "status": status,
+                "template_ms": milliseconds(template),
+                "queue_ms": milliseconds(queue_wait),
+                "ttft_ms": milliseconds(ttft),
+                "latency_ms": milliseconds(end - self.start),
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "tokens_per_s": round(tokens_per_second, 2) if tokens_per_second is not None else None,
+            }))
+
+
+def component_samples(scheduler=None, sessions=None, cache=None, budget=None):
+    """批处理队列、会话、回复缓存和 token 预算的指标 (ChatMetrics 的 collector)"""
+    samples = []
+    if hasattr(scheduler, "stats"):
+        samples.append(("chat_batch_queued", "gauge", "Requests waiting for the next batch.",
+                        scheduler.stats()["queued"]))
+    if sessions is not None:
+        stats = sessions.stats()
+        samples += [
+            ("chat_sessions", "gauge", "Server-side sessions held.", stats["sessions"]),
+            ("chat_session_bytes", "gauge", "Memory held by server-side sessions.", stats["bytes"]),
+            ("chat_session_created_total", "counter", "Sessions started.", stats["created"]),
+            ("chat_session_continued_total", "counter", "Turns that reused a session.", stats["continued"]),
+            ("chat_session_evicted_total", "counter", "Sessions evicted by TTL or memory budget.", stats["evicted"]),
+            ("chat_session_full_renders_total", "counter", "Turns rendered from the full history.",
+             stats["full_renders"]),
+        ]
+    if cache is not None:
+        stats = cache.stats()
+        samples += [
+            ("chat_response_cache_hits_total", "counter", "Replies served from the response cache.", stats["hits"]),
+            ("chat_response_cache_disk_hits_total", "counter", "Response cache hits loaded from disk.",
+             stats["disk_hits"]),
+            ("chat_response_cache_misses_total", "counter", "Cacheable requests that were generated.",
+             stats["misses"]),
+            ("chat_response_cache_coalesced_total", "counter", "Requests that waited for an identical request.",
+             stats["coalesced"]),
+            ("chat_response_cache_bypassed_total", "counter", "Requests not cacheable (sampling not greedy).",
+             stats["bypassed"]),
+            ("chat_response_cache_hit_ratio", "gauge", "Share of cacheable requests not generated again.",
+             stats["hit_rate"]),
+            ("chat_response_cache_entries", "gauge", "Replies held in memory.", stats["entries"]),
+            ("chat_response_cache_bytes", "gauge", "Memory held by cached replies.", stats["bytes"]),
+        ]
+    if budget is not None:
+        stats = budget.stats()
+        samples += [
+            ("chat_context_truncated_total", "counter", "Requests whose oldest turns were dropped to fit the context.",
+             stats["truncated"]),
+            ("chat_context_dropped_messages_total", "counter", "Messages dropped to fit the context.",
+             stats["dropped_messages"]),
+            ("chat_context_rejected_total", "counter", "Requests rejected with 413 (prompt too long).",
+             stats["rejected"]),
+            ("chat_context_capped_total", "counter", "Requests whose max_tokens was cut to the space left in the context.",
+             stats["capped"]),
+            ("chat_context_exact_counts_total", "counter", "Prompts tokenized in full because they were near the limit.",
+             stats["exact_counts"]),
+        ]
+    return samples
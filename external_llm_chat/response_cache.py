@@ -0,0 +1,354 @@
+import array
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from batching import REQUEST_SAMPLING_KEYS
+
+# 确定性请求 (贪心采样) 的回复缓存
+#   键: 渲染后的 prompt (文本或 token id) + 归一化的采样参数 (+ 模型名)
+#   内存里按 LRU 限制总大小, 条目超过 ttl 秒失效; 可选落盘, 服务重启后仍可命中
+#   相同的请求同时到达时只生成一次, 其余请求等待它的结果
+# 用 CachedScheduler (Flask: BatchScheduler / AsyncEngineRunner) 或 CachedEngine (ASGI: AsyncLLMEngine) 包装引擎即可
+
+# 参与缓存键的采样参数: 请求可覆盖的字段, 以及其他会改变输出的字段
+CACHE_KEY_FIELDS = REQUEST_SAMPLING_KEYS + (
+    "n", "best_of", "min_tokens", "stop_token_ids", "ignore_eos", "logprobs", "prompt_logprobs",
+    "skip_special_tokens", "spaces_between_special_tokens", "include_stop_str_in_output",
+)
+# 顺序无关的字段
+UNORDERED_FIELDS = ("stop", "stop_token_ids")
+
+
+def is_deterministic(sampling_params):
+    """贪心采样的输出只由 prompt 决定; 带 seed 的随机采样结果与批次组成有关, 不缓存"""
+    if (getattr(sampling_params, "n", 1) or 1) != 1:
+        return False
+    return getattr(sampling_params, "temperature", 1.0) < 1e-5 or getattr(sampling_params, "top_k", -1) == 1
+
+
+def normalize(name, value):
+    if name in UNORDERED_FIELDS:
+        if value is None or isinstance(value, (str, int)):
+            value = [] if value is None else [value]
+        return sorted(set(value), key=str)
+    if isinstance(value, (list, tuple)):
+        return [normalize(None, v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class Abandoned(Exception):
+    """正在生成的请求被放弃 (客户端断开), 等待它的请求自己重新生成"""
+
+
+class CachedCompletion:
+    def __init__(self, text, token_ids, finish_reason):
+        self.index = 0
+        self.text = text
+        self.token_ids = token_ids
+        self.finish_reason = finish_reason
+
+
+class CachedOutput:
+    """缓存里的 RequestOutput: 只保留响应需要的字段"""
+
+    def __init__(self, prompt_token_ids, text, token_ids, finish_reason):
+        self.request_id = None
+        self.prompt = None
+        self.prompt_token_ids = prompt_token_ids
+        self.outputs = [CachedCompletion(text, token_ids, finish_reason)]
+        self.finished = True
+
+    @classmethod
+    def from_output(cls, output):
+        completion = output.outputs[0]
+        return cls(array.array("i", output.prompt_token_ids or []), completion.text,
+                   array.array("i", completion.token_ids), completion.finish_reason)
+
+    @property
+    def nbytes(self):
+        completion = self.outputs[0]
+        return (len(completion.text.encode("utf-8")) + 4 * len(completion.token_ids)
+                + 4 * len(self.prompt_token_ids))
+
+    def to_json(self):
+        completion = self.outputs[0]
+        return {
+            "prompt_token_ids": self.prompt_token_ids.tolist(),
+            "text": completion.text,
+            "token_ids": completion.token_ids.tolist(),
+            "finish_reason": completion.finish_reason,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(array.array("i", data["prompt_token_ids"]), data["text"],
+                   array.array("i", data["token_ids"]), data["finish_reason"])
+
+
+class ResponseCache:
+    """LRU + TTL 的回复缓存, 可选 disk_dir 落盘 (每个条目一个 json 文件)"""
+
+    def __init__(self, max_bytes=64 << 20, ttl=3600.0, disk_dir=None, namespace=""):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.namespace = namespace
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+        self.entries = collections.OrderedDict()  # key -> (写入时间, CachedOutput)
+        self.nbytes = 0
+        self.pending = {}  # key -> Future, 正在生成的请求
+        self.lock = threading.Lock()
+        # 统计信息
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+        self.evicted = 0
+
+    def key(self, prompt, sampling_params):
+        """缓存键, 非确定性的请求返回 None"""
+        if not is_deterministic(sampling_params):
+            with self.lock:
+                self.bypassed += 1
+            return None
+        if isinstance(prompt, dict):
+            prompt = {"prompt_token_ids": list(prompt["prompt_token_ids"])}
+        params = {name: normalize(name, getattr(sampling_params, name))
+                  for name in CACHE_KEY_FIELDS if hasattr(sampling_params, name)}
+        data = json.dumps([self.namespace, prompt, params], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key):
+        """内存和磁盘里查找 (调用方持有锁)"""
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is not None:
+            if now - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.remove(key)
+        if self.disk_dir:
+            try:
+                with open(self.path(key), encoding="utf-8") as f:
+                    data = json.load(f)
+                if now - data["created"] <= self.ttl:
+                    output = CachedOutput.from_json(data)
+                    self.insert(key, data["created"], output)
+                    self.disk_hits += 1
+                    return output
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable cache entry {key}: {str(e)}")
+        return None
+
+    def insert(self, key, created, output):
+        self.remove(key)
+        self.entries[key] = (created, output)
+        self.nbytes += output.nbytes
+        while self.nbytes > self.max_bytes and self.entries:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evicted += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+
+    def acquire(self, key):
+        """返回 (output, None): 命中; (None, future): 相同的请求正在生成, 等待 future;
+        (None, None): 由调用方生成, 之后必须调用 complete() 或 fail()"""
+        with self.lock:
+            output = self.get(key)
+            if output is not None:
+                self.hits += 1
+                return output, None
+            future = self.pending.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future
+            self.pending[key] = Future()
+            self.misses += 1
+            return None, None
+
+    def complete(self, key, output):
+        cached = CachedOutput.from_output(output)
+        created = time.time()
+        with self.lock:
+            self.insert(key, created, cached)
+            future = self.pending.pop(key)
+        future.set_result(cached)
+        if self.disk_dir:
+            # 先写临时文件再改名, 读取方不会看到写了一半的条目
+            tmp = f"{self.path(key)}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"created": created, **cached.to_json()}, f, ensure_ascii=False)
+                os.replace(tmp, self.path(key))
+            except OSError as e:
+                logging.warning(f"Failed to write cache entry {key}: {str(e)}")
+
+    def fail(self, key, error):
+        with self.lock:
+            future = self.pending.pop(key)
+        if isinstance(error, Exception) and not isinstance(error, Abandoned):
+            future.set_exception(error)
+        else:
+            future.set_exception(Abandoned())  # 取消或生成器被关闭
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "bypassed": self.bypassed,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "evicted": self.evicted,
+            }
+
+
+class CachedScheduler:
+    """给 BatchScheduler / AsyncEngineRunner 加上回复缓存, 接口不变"""
+
+    def __init__(self, scheduler, cache):
+        self.scheduler = scheduler
+        self.cache = cache
+
+    def generate(self, prompt, sampling_params):
+        output = None
+        for _, output in self.stream(prompt, sampling_params):
+            pass
+        return output
+
+    def stream(self, prompt, sampling_params):
+        key = self.cache.key(prompt, sampling_params)
+        if key is None:
+            yield from self.scheduler.stream(prompt, sampling_params)
+            return
+        while True:
+            output, future = self.cache.acquire(key)
+            if output is None and future is not None:
+                try:
+                    output = future.result()
+                except Abandoned:
+                    continue
+            if output is not None:
+                # 命中: 整段回复一次产出
+                yield output.outputs[0].text, output
+                return
+            break
+        output = None
+        try:
+            for delta, output in self.scheduler.stream(prompt, sampling_params):
+                yield delta, output
+        except BaseException as e:
+            self.cache.fail(key, e)
+            raise
+        if output is None or not output.finished:
+            self.cache.fail(key, Abandoned())
+        else:
+            self.cache.complete(key, output)
+
+    def submit(self, prompt, sampling_params):
+        """返回 Future, 结果为最终输出 (批量推理用); 命中时已经完成"""
+        key = self.cache.key(prompt, sampling_params)
+        if key is None:
+            return self.scheduler.submit(prompt, sampling_params)
+        result = Future()
+        self.resolve(key, prompt, sampling_params, result)
+        return result
+
+    def resolve(self, key, prompt, sampling_params, result):
+        output, pending = self.cache.acquire(key)
+        if output is not None:
+            result.set_result(output)
+            return
+
+        if pending is not None:
+            def on_pending(future):
+                try:
+                    result.set_result(future.result())
+                except Abandoned:
+                    self.resolve(key, prompt, sampling_params, result)
+                except Exception as e:
+                    result.set_exception(e)
+
+            pending.add_done_callback(on_pending)
+            return
+
+        def on_done(future):
+            try:
+                output = future.result()
+            except BaseException as e:
+                self.cache.fail(key, e)
+                result.set_exception(e)
+                return
+            self.cache.complete(key, output)
+            result.set_result(output)
+
+        self.scheduler.submit(prompt, sampling_params).add_done_callback(on_done)
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+
+class CachedEngine:
+    """给 AsyncLLMEngine 加上回复缓存 (ASGI 模式), 接口不变"""
+
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+
+    async def generate(self, prompt, sampling_params, request_id):
+        key = self.cache.key(prompt, sampling_params)
+        if key is None:
+            async for output in self.engine.generate(prompt, sampling_params, request_id):
+                yield output
+            return
+        while True:
+            output, future = self.cache.acquire(key)
+            if output is None and future is not None:
+                try:
+                    # shield: 本请求被取消时不能连带取消别人的 future
+                    output = await asyncio.shield(asyncio.wrap_future(future))
+                except Abandoned:
+                    continue
+            if output is not None:
+                yield output
+                return
+            break
+        output = None
+        try:
+            async for output in self.engine.generate(prompt, sampling_params, request_id):
+                yield output
+        except BaseException as e:
+            self.cache.fail(key, e)
+            raise
+        if output is None or not output.finished:
+            self.cache.fail(key, Abandoned())
+        else:
+            self.cache.complete(key, output)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
@@ -0,0 +1,180 @@
+import array
+import collections
+import logging
+import threading
+import time
+
+from batching import InvalidRequest
+
+# 服务端会话: 客户端每轮只发送新增的消息, 服务端保存已经渲染并分词的历史
+#   请求 {"session_id": "...", "messages": [新消息]}; 会话不存在 (新建或已淘汰) 时返回 404,
+#   客户端带上 "new_session": true 和完整的 messages 重新建立会话
+# prompt 以 token id 提交, 历史部分逐轮保持不变, 引擎的 prefix cache (--enable-prefix-caching) 可以复用 KV
+
+# 用来增量渲染模板的占位对话, 新消息接在它后面渲染, 再去掉它自己的渲染结果
+ANCHOR_USER = {"role": "user", "content": "hi"}
+ANCHOR_ASSISTANT = {"role": "assistant", "content": "hi"}
+
+
+class UnknownSession(InvalidRequest):
+    status = 404
+
+
+class Session:
+    __slots__ = ("session_id", "messages", "token_ids", "nbytes", "last_used")
+
+    def __init__(self, session_id, messages, token_ids):
+        self.session_id = session_id
+        self.messages = messages
+        self.token_ids = token_ids
+        # token id 每个 4 字节, 消息按字符数估算
+        self.nbytes = token_ids.itemsize * len(token_ids) + sum(len(str(m.get("content", ""))) for m in messages)
+        self.last_used = time.monotonic()
+
+
+class Turn:
+    """一次会话请求: begin() 时生成, 回复完成后交给 commit()"""
+
+    def __init__(self, session_id, version, messages, history_ids, prompt_ids, new_session):
+        self.session_id = session_id
+        self.version = version  # begin 时会话里的消息数, commit 时用来检测并发修改
+        self.messages = messages
+        self.history_ids = history_ids
+        self.prompt_ids = prompt_ids
+        self.new_session = new_session
+
+    def prompt(self):
+        """引擎的输入 (vLLM TokensPrompt)"""
+        return {"prompt_token_ids": self.prompt_ids.tolist()}
+
+
+class SessionStore:
+    """按 session_id 保存对话, 超过 ttl 秒未使用或总大小超过 max_bytes 时按 LRU 淘汰"""
+
+    def __init__(self, tokenizer, max_bytes=256 << 20, ttl=1800.0):
+        self.tokenizer = tokenizer
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sessions = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.generation_prompt = self.render_delta([ANCHOR_USER], [], add_generation_prompt=True) or ""
+        # 统计信息
+        self.created = 0
+        self.continued = 0
+        self.evicted = 0
+        self.full_renders = 0
+
+    def render(self, messages, add_generation_prompt=False):
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    def render_delta(self, anchor, messages, add_generation_prompt=False):
+        """只渲染新增的 messages: 渲染 anchor + messages, 去掉 anchor 单独渲染的前缀
+
+        模板对前缀不稳定 (例如按位置改写历史消息) 时返回 None。
+        """
+        try:
+            base = self.render(anchor)
+            text = self.render(anchor + messages, add_generation_prompt)
+        except Exception:
+            return None  # 模板拒绝这样的角色顺序
+        if not text.startswith(base):
+            return None
+        return text[len(base):]
+
+    def encode(self, text):
+        # 模板渲染结果里已经带了特殊 token
+        return array.array("i", self.tokenizer.encode(text, add_special_tokens=False))
+
+    def append_ids(self, session, messages):
+        """session 的历史 token 加上 messages, 模板不支持增量渲染时整段重新渲染"""
+        if session is not None and messages:
+            anchor = [ANCHOR_USER] if messages[0]["role"] == "assistant" else [ANCHOR_USER, ANCHOR_ASSISTANT]
+            delta = self.render_delta(anchor, messages)
+            if delta is not None:
+                return session.token_ids + self.encode(delta)
+        with self.lock:
+            self.full_renders += 1
+        history = (session.messages if session is not None else []) + messages
+        return self.encode(self.render(history))
+
+    def begin(self, session_id, messages, new_session=False):
+        """为本轮请求构建 prompt token; 会话不存在且不是 new_session 时抛出 UnknownSession"""
+        if not isinstance(session_id, str) or not session_id:
+            raise InvalidRequest("session_id must be a non-empty string")
+        if not isinstance(messages, list) or not all(isinstance(m, dict) and "role" in m for m in messages):
+            raise InvalidRequest("messages must be a list of {role, content} objects")
+        with self.lock:
+            self.expire()
+            session = None if new_session else self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+        if session is None and not new_session:
+            raise UnknownSession(f"Unknown or expired session: {session_id}")
+        history_ids = self.append_ids(session, messages)
+        prompt_ids = history_ids + self.encode(self.generation_prompt)
+        version = len(session.messages) if session is not None else 0
+        return Turn(session_id, version, messages, history_ids, prompt_ids, new_session)
+
+    def history(self, turn):
+        """本轮请求之前会话里的消息加上本轮的新消息"""
+        with self.lock:
+            session = None if turn.new_session else self.sessions.get(turn.session_id)
+            previous = session.messages[:turn.version] if session is not None else []
+        return previous + turn.messages
+
+    def commit(self, turn, reply):
+        """回复生成完毕: 把本轮的消息和回复追加到会话"""
+        assistant = {"role": "assistant", "content": reply}
+        delta = self.render_delta([ANCHOR_USER], [assistant])
+        token_ids = turn.history_ids + self.encode(delta) if delta is not None else None
+        with self.lock:
+            if turn.new_session:
+                previous = None
+            else:
+                previous = self.sessions.get(turn.session_id)
+                if previous is None or len(previous.messages) != turn.version:
+                    # 会话在生成期间被淘汰或被另一个请求更新, 这一轮不再记录
+                    logging.warning(f"Session {turn.session_id} changed during generation, turn not saved")
+                    return
+            messages = (previous.messages if previous is not None else []) + turn.messages + [assistant]
+            if token_ids is None:
+                self.full_renders += 1
+                token_ids = self.encode(self.render(messages))
+            self.put(Session(turn.session_id, messages, token_ids))
+            if turn.new_session:
+                self.created += 1
+            else:
+                self.continued += 1
+
+    def put(self, session):
+        old = self.sessions.pop(session.session_id, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.sessions[session.session_id] = session
+        self.nbytes += session.nbytes
+        self.expire()
+
+    def expire(self):
+        """淘汰过期的会话, 再按 LRU 淘汰到 max_bytes 以内 (调用方持有锁)"""
+        deadline = time.monotonic() - self.ttl
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if session.last_used >= deadline and self.nbytes <= self.max_bytes:
+                break
+            self.sessions.popitem(last=False)
+            self.nbytes -= session.nbytes
+            self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "bytes": self.nbytes,
+                "created": self.created,
+                "continued": self.continued,
+                "evicted": self.evicted,
+                "full_renders": self.full_renders,
+            }
@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import threading
+import time
+
+from bulk import to_request
+
+# 启动过程: 各阶段 (导入、加载模型、分词器、预热) 计时, 预热完成后才算就绪
+#   --fast_start 时先绑定端口, 模型在后台加载; 就绪前 /chat 返回 503, /ready 返回 503, /health 返回 200
+#   GET /health 与 /ready 的响应、/stats 和 /metrics 里都有各阶段的耗时
+# 预热: 一批有代表性的请求整批送入引擎, 首个真实请求不再承担编译 (CUDA graph) 和显存分配的开销
+
+WARMUP_SYSTEM = "You are a helpful assistant."
+WARMUP_TEXT = ("The service batches concurrent chat requests, streams tokens as they are generated "
+               "and keeps long conversations within the context window. ")
+
+
+class Startup:
+    """启动阶段的耗时和就绪状态; started 为计时起点 (time.perf_counter)"""
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.last = self.started
+        self.phases = {}  # 阶段名 -> 秒, 按完成顺序
+        self.current = None
+        self.state = "starting"  # starting / ready / failed
+        self.error = None
+        self.ready_after = None
+        self.task = None  # ASGI 模式在后台运行的启动任务 (保留引用)
+        self.lock = threading.Lock()
+
+    @property
+    def is_ready(self):
+        return self.state == "ready"
+
+    @property
+    def failed(self):
+        return self.state == "failed"
+
+    def record(self, name):
+        """记录一个从上一阶段结束 (或启动) 到现在的阶段, 例如模块导入"""
+        now = time.perf_counter()
+        with self.lock:
+            self.phases[name] = now - self.last
+            self.last = now
+        logging.info(f"Startup phase {name} took {self.phases[name]:.2f}s")
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        self.current = name
+        logging.info(f"Startup phase {name} started")
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + now - start
+                self.last = now
+            logging.info(f"Startup phase {name} took {now - start:.2f}s")
+        self.current = None  # 出错时保留, fail() 报告失败的阶段
+
+    def ready(self):
+        with self.lock:
+            self.state = "ready"
+            self.ready_after = time.perf_counter() - self.started
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        print(f"Ready after {self.ready_after:.2f}s ({phases})", flush=True)
+
+    def fail(self, error):
+        with self.lock:
+            self.state = "failed"
+            self.error = str(error)
+        logging.error(f"Startup failed during {self.current or 'startup'}: {str(error)}")
+
+    def status(self):
+        with self.lock:
+            status = {
+                "state": self.state,
+                "phase": self.current,
+                "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                "elapsed": round(time.perf_counter() - self.started, 3),
+            }
+            if self.ready_after is not None:
+                status["ready_after"] = round(self.ready_after, 3)
+            if self.error is not None:
+                status["error"] = self.error
+            return status
+
+    def samples(self):
+        """ChatMetrics 的 collector"""
+        with self.lock:
+            samples = [("chat_ready", "gauge", "1 once the model is loaded and warmed up.", int(self.is_ready))]
+            if self.ready_after is not None:
+                samples.append(("chat_startup_seconds", "gauge", "Time from process start until ready.",
+                                self.ready_after))
+            for name, seconds in self.phases.items():
+                samples.append((f"chat_startup_{name}_seconds", "gauge", f"Duration of the {name} startup phase.",
+                                seconds))
+            return samples
+
+
+def warmup_requests(count, max_tokens=16, path=None, prompt_field="prompt"):
+    """预热用的请求: 取自 JSONL 文件 (格式同批量推理), 或内置的几种长度的对话 (几十到一千多词)"""
+    if count <= 0:
+        return []
+    if path:
+        with open(path, encoding="utf-8") as f:
+            records = [to_request(json.loads(line), prompt_field) for line in f if line.strip()]
+        if not records:
+            raise ValueError(f"No warmup requests in {path}")
+    else:
+        records = []
+        for repeat in (1, 4, 16, 64):
+            words = WARMUP_TEXT * repeat
+            records.append({"messages": [{"role": "system", "content": WARMUP_SYSTEM},
+                                         {"role": "user", "content": f"Summarize: {words}"}]})
+        records.append({"messages": [{"role": "user", "content": "Hello"},
+                                     {"role": "assistant", "content": "Hi, how can I help?"},
+                                     {"role": "user", "content": WARMUP_TEXT}]})
+    requests = []
+    for record in itertools.islice(itertools.cycle(records), count):
+        requests.append({**record, "max_tokens": max_tokens})
+    return requests
+
+
+def warmup_scheduler(scheduler, prepare, requests):
+    """同步模式: 整批提交给调度器 (一次 generate), 等待全部完成"""
+    futures = [scheduler.submit(*prepare(dict(data))) for data in requests]
+    for future in futures:
+        future.result()
+
+
+async def warmup_engine(engine, prepare, requests):
+    """异步引擎: 并发生成全部预热请求"""
+
+    async def run(request_id, data):
+        prompt, sampling_params = prepare(dict(data))
+        async for _ in engine.generate(prompt, sampling_params, request_id):
+            pass
+
+    await asyncio.gather(*(run(f"warmup-{i}", data) for i, data in enumerate(requests)))
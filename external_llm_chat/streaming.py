@@ -0,0 +1,137 @@
+import asyncio
+import inspect
+import itertools
+import json
+import queue
+import threading
+
+
+class AsyncEngineRunner:
+    """在后台线程的事件循环中驱动异步引擎 (vllm.AsyncLLMEngine 或 stub), 供同步的 Flask 视图使用
+
+    与 BatchScheduler 接口相同: generate() 返回最终输出, stream() 逐步产出新增文本;
+    异步引擎自己做连续批处理, 不需要再攒批。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True)
+        self.thread.start()
+        self.counter = itertools.count()
+
+    def call(self, coro, timeout=None):
+        """在引擎的事件循环里执行协程并等待结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def get_tokenizer(self):
+        tokenizer = self.engine.get_tokenizer()
+        if inspect.isawaitable(tokenizer):
+            tokenizer = self.call(tokenizer)
+        return tokenizer
+
+    def stream(self, prompt, sampling_params):
+        """逐个 decode 步产出 (新增文本, RequestOutput); 调用方提前退出时中止引擎里的请求"""
+        request_id = f"chat-{next(self.counter)}"
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for output in self.engine.generate(prompt, sampling_params, request_id):
+                    items.put(output)
+            except Exception as e:
+                items.put(e)
+                return
+            items.put(None)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        sent = 0
+        try:
+            while True:
+                item = items.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                text = item.outputs[0].text
+                yield text[sent:], item
+                sent = len(text)
+        finally:
+            if not future.done():
+                # 客户端断开: 取消任务并让引擎释放这条序列
+                future.cancel()
+                asyncio.run_coroutine_threadsafe(self.engine.abort(request_id), self.loop)
+
+    def generate(self, prompt, sampling_params):
+        output = None
+        for _, output in self.stream(prompt, sampling_params):
+            pass
+        return output
+
+    def submit(self, prompt, sampling_params):
+        """提交一个请求, 返回 Future, 结果为最终的 RequestOutput (批量推理用); 取消 Future 时中止引擎里的请求"""
+        request_id = f"chat-{next(self.counter)}"
+
+        async def run():
+            output = None
+            try:
+                async for output in self.engine.generate(prompt, sampling_params, request_id):
+                    pass
+            except asyncio.CancelledError:
+                await self.engine.abort(request_id)
+                raise
+            return output
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+
+def on_finish(chunks, callback):
+    """透传 (新增文本, RequestOutput), 完整生成结束后以最终输出调用 callback"""
+    output = None
+    for delta, output in chunks:
+        yield delta, output
+    if output is not None:
+        callback(output)
+
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def sse_event(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def sse_stream(chunks):
+    """把 (新增文本, RequestOutput) 序列编码为 server-sent events
+
+    每段文本一个 {"delta": ...} 事件, 最后是 finish_reason 和 token 用量, 以 [DONE] 结束;
+    生成出错时发送 {"error": ...} 事件 (响应头已经发出, 无法再改状态码)。
+    """
+    output = None
+    try:
+        for delta, output in chunks:
+            if delta:
+                yield sse_event({"delta": delta})
+        if output is not None:
+            yield sse_event(finish_event(output))
+    except Exception as e:
+        yield sse_event({"error": str(e)})
+    yield SSE_DONE
+
+
+def finish_event(output):
+    """流的最后一个事件: 结束原因和 token 用量"""
+    completion = output.outputs[0]
+    return {
+        "finish_reason": completion.finish_reason,
+        "usage": {
+            "prompt_tokens": len(output.prompt_token_ids or []),
+            "completion_tokens": len(completion.token_ids),
+        },
+    }
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # 禁止 nginx 缓冲, 否则事件会被攒到一起
+}
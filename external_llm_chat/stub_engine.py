@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import time
+
+# CPU 上模拟 vLLM 的 LLM, 用于在没有 GPU 和模型的机器上测试服务层 (调度、接口、压测)
+# 输出只由 prompt 和 seed 决定; 耗时按 prefill + 逐步 decode 计算, 批次越大单步越慢但总吞吐越高
+
+VOCAB = (
+    "the model answers your question with a short and deterministic reply generated by "
+    "a stub engine running on the cpu so that latency and throughput can be measured"
+).split()
+
+
+class SamplingParams:
+    """vllm.SamplingParams 的替身 (只保留 stub 引擎用到的字段)"""
+
+    def __init__(self, max_tokens=16, temperature=1.0, top_p=1.0, top_k=-1, min_p=0.0, seed=None,
+                 stop=None, presence_penalty=0.0, frequency_penalty=0.0, repetition_penalty=1.0, **kwargs):
+        if max_tokens is not None and max_tokens < 1:
+            raise ValueError(f"max_tokens must be at least 1, got {max_tokens}.")
+        if temperature < 0:
+            raise ValueError(f"temperature must be non-negative, got {temperature}.")
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.min_p = min_p
+        self.seed = seed
+        self.stop = stop
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        self.repetition_penalty = repetition_penalty
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class CompletionOutput:
+    def __init__(self, text, token_ids, finish_reason):
+        self.index = 0
+        self.text = text
+        self.token_ids = token_ids
+        self.finish_reason = finish_reason
+
+
+class RequestOutput:
+    def __init__(self, request_id, prompt, prompt_token_ids, outputs, finished=True):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.prompt_token_ids = prompt_token_ids
+        self.outputs = outputs
+        self.finished = finished
+
+
+class StubTokenizer:
+    """按空白切词的分词器, 词 id 由词本身的哈希决定"""
+
+    chat_template = None
+
+    def encode(self, text, add_special_tokens=False):
+        return [int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:2], "little") for word in text.split()]
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return " ".join(VOCAB[token_id % len(VOCAB)] for token_id in token_ids)
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True, **kwargs):
+        text = "".join(f"<|{m['role']}|> {m['content']}\n" for m in messages)
+        if add_generation_prompt:
+            text += "<|assistant|> "
+        return self.encode(text) if tokenize else text
+
+
+class StubLLM:
+    """模拟 vllm.LLM.generate 的引擎
+
+    prefill_ms_per_token: 每个 prompt token 的 prefill 耗时
+    decode_ms_per_step: 批次只有一条序列时每个 decode 步的耗时
+    batch_scaling: 每多一条并发序列, 单步耗时增加的比例 (远小于 1 时批处理收益明显)
+    max_model_len: 上下文长度, 与 vLLM 一样拒绝更长的 prompt
+    """
+
+    def __init__(self, prefill_ms_per_token=0.05, decode_ms_per_step=10.0, batch_scaling=0.02,
+                 max_output_tokens=128, seed=0, max_model_len=4096):
+        self.max_model_len = max_model_len
+        self.prefill = prefill_ms_per_token / 1000.0
+        self.decode = decode_ms_per_step / 1000.0
+        self.batch_scaling = batch_scaling
+        self.max_output_tokens = max_output_tokens
+        self.seed = seed
+        self.tokenizer = StubTokenizer()
+        self.calls = 0
+        self.request_counter = 0
+
+    def get_tokenizer(self):
+        return self.tokenizer
+
+    def prompt_ids(self, prompt):
+        """prompt 可以是文本或 {"prompt_token_ids": [...]} (vLLM TokensPrompt)"""
+        if isinstance(prompt, dict):
+            prompt_ids = list(prompt["prompt_token_ids"]) or [0]
+        else:
+            prompt_ids = self.tokenizer.encode(prompt) or [0]
+        if len(prompt_ids) > self.max_model_len:
+            raise ValueError(f"The decoder prompt (length {len(prompt_ids)}) is longer than the maximum model "
+                             f"length of {self.max_model_len}.")
+        return prompt_ids
+
+    def output_tokens(self, prompt, params):
+        """确定性的回复: 长度和内容只由 prompt 与 seed 决定"""
+        seed = getattr(params, "seed", None)
+        if isinstance(prompt, dict):
+            prompt = " ".join(map(str, prompt["prompt_token_ids"]))
+        digest = hashlib.sha256(f"{self.seed}:{seed}:{prompt}".encode("utf-8")).digest()
+        length = 8 + int.from_bytes(digest[:4], "little") % self.max_output_tokens
+        max_tokens = getattr(params, "max_tokens", None) or 16
+        length = min(length, max_tokens)
+        token_ids = []
+        while len(token_ids) < length:
+            digest = hashlib.sha256(digest).digest()
+            token_ids.extend(digest[i] for i in range(min(32, length - len(token_ids))))
+        return token_ids, "length" if length == max_tokens else "stop"
+
+    def step_time(self, active):
+        return self.decode * (1 + self.batch_scaling * (active - 1))
+
+    def batch_time(self, prompt_tokens, output_lengths):
+        """一批请求的模拟耗时: 所有 prompt 的 prefill, 再逐步 decode 直到最长的序列结束"""
+        seconds = self.prefill * sum(prompt_tokens)
+        for step in range(max(output_lengths, default=0)):
+            seconds += self.step_time(sum(1 for n in output_lengths if n > step))
+        return seconds
+
+    def generate(self, prompts, sampling_params=None, use_tqdm=True, **kwargs):
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        if not isinstance(sampling_params, (list, tuple)):
+            sampling_params = [sampling_params or SamplingParams()] * len(prompts)
+        self.calls += 1
+        outputs = []
+        prompt_tokens = []
+        for prompt, params in zip(prompts, sampling_params):
+            prompt_ids = self.prompt_ids(prompt)
+            token_ids, finish_reason = self.output_tokens(prompt, params)
+            prompt_tokens.append(len(prompt_ids))
+            self.request_counter += 1
+            outputs.append(RequestOutput(
+                str(self.request_counter), prompt if isinstance(prompt, str) else None, prompt_ids,
+                [CompletionOutput(self.tokenizer.decode(token_ids), token_ids, finish_reason)],
+            ))
+        time.sleep(self.batch_time(prompt_tokens, [len(o.outputs[0].token_ids) for o in outputs]))
+        return outputs
+
+
+class AsyncStubEngine:
+    """模拟 vllm.AsyncLLMEngine: 每个 decode 步产出一次累计的 RequestOutput
+
+    单步耗时随同时在生成的序列数增长, 与 StubLLM 的批处理模型一致。
+    """
+
+    def __init__(self, llm=None, **kwargs):
+        self.llm = llm or StubLLM(**kwargs)
+        self.active = 0
+        self.running = set()
+        self.aborted = set()
+
+    async def get_tokenizer(self):
+        return self.llm.tokenizer
+
+    async def generate(self, prompt, sampling_params, request_id):
+        tokenizer = self.llm.tokenizer
+        prompt_ids = self.llm.prompt_ids(prompt)
+        token_ids, finish_reason = self.llm.output_tokens(prompt, sampling_params)
+        self.active += 1
+        self.running.add(request_id)
+        try:
+            await asyncio.sleep(self.llm.prefill * len(prompt_ids))
+            for step in range(1, len(token_ids) + 1):
+                await asyncio.sleep(self.llm.step_time(self.active))
+                if request_id in self.aborted:
+                    return
+                finished = step == len(token_ids)
+                completion = CompletionOutput(tokenizer.decode(token_ids[:step]), token_ids[:step],
+                                              finish_reason if finished else None)
+                yield RequestOutput(request_id, prompt if isinstance(prompt, str) else None, prompt_ids,
+                                    [completion], finished)
+        finally:
+            self.active -= 1
+            self.running.discard(request_id)
+            self.aborted.discard(request_id)
+
+    async def abort(self, request_id):
+        if request_id in self.running:
+            self.aborted.add(request_id)
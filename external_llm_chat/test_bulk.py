@@ -0,0 +1,31 @@
+import json
+
+from batching import BatchScheduler
+from bulk import run_file
+from stub_engine import SamplingParams, StubLLM
+
+# python -m pytest -q test_bulk.py
+
+
+def prepare(data):
+    """与 prepare_request 一样返回 (prompt, SamplingParams)"""
+    return " ".join(m["content"] for m in data["messages"]), SamplingParams(max_tokens=4)
+
+
+def test_bad_bytes_only_fail_their_line(tmp_path):
+    source = tmp_path / "in.jsonl"
+    source.write_bytes(b'{"id": 1, "prompt": "hello"}\n'
+                       b'{"id": 2, "prompt": "caf\xe9 \xff"}\n'
+                       b'{"id": 3, "prompt": "bye"}\n')
+    output = tmp_path / "out.jsonl"
+    scheduler = BatchScheduler(StubLLM(decode_ms_per_step=0.0))
+    try:
+        totals = run_file(str(source), str(output), prepare, scheduler, chunk_size=2)
+    finally:
+        scheduler.stop()
+    results = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [r["index"] for r in results] == [0, 1, 2]
+    assert "response" in results[0] and "response" in results[2]
+    assert "utf-8" in results[1]["error"]
+    assert totals["requests"] == 3
+    assert not (tmp_path / "out.jsonl.ckpt").exists()
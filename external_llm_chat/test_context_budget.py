@@ -0,0 +1,78 @@
+import pytest
+
+from context_budget import ContextBudget, PromptTooLong
+from sessions import SessionStore
+from stub_engine import StubTokenizer
+
+# python -m pytest -q test_context_budget.py
+
+
+def chat(store, budget, session_id, messages, max_tokens=16, new_session=False):
+    """一轮会话请求, 像 prepare_request / finish_request 那样检查预算并记录回复"""
+    turn = store.begin(session_id, messages, new_session)
+    turn, max_tokens = budget.fit_turn(store, turn, max_tokens)
+    store.commit(turn, "ok " * 8)
+    return turn, max_tokens
+
+
+def test_fit_drops_oldest_turns():
+    budget = ContextBudget(StubTokenizer(), max_context=64)
+    messages = [{"role": "system", "content": "be brief"}]
+    for i in range(10):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * 5})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * 5})
+    messages.append({"role": "user", "content": "last question"})
+    prompt, dropped, max_tokens = budget.fit(messages, max_tokens=16)
+    assert dropped > 0 and dropped % 2 == 0
+    assert prompt.startswith("<|system|> be brief\n<|user|> question")
+    assert prompt.endswith("<|user|> last question\n<|assistant|> ")
+    # 只截断到 prompt 放得下, max_tokens 截到剩下的空间
+    assert 0 < max_tokens <= 16
+    assert len(StubTokenizer().encode(prompt)) + max_tokens <= 64
+
+
+def test_long_session_is_trimmed():
+    tokenizer = StubTokenizer()
+    store = SessionStore(tokenizer)
+    budget = ContextBudget(tokenizer, max_context=128)
+    chat(store, budget, "s", [{"role": "system", "content": "be brief"},
+                              {"role": "user", "content": "hello"}], new_session=True)
+    # 每轮只发送新消息, 会话很快超过上下文窗口
+    for i in range(30):
+        turn, max_tokens = chat(store, budget, "s", [{"role": "user", "content": f"question {i} " + "word " * 10}])
+        assert len(turn.prompt_ids) < 128 and 0 < max_tokens <= 16
+        assert len(turn.prompt_ids) + max_tokens <= 128
+    history = store.sessions["s"].messages
+    assert history[0] == {"role": "system", "content": "be brief"}
+    assert history[1]["role"] == "user" and history[1]["content"] != "hello"
+    assert history[-2]["content"].startswith("question 29 ")
+    assert budget.stats()["truncated"] > 0
+
+
+def test_long_session_rejected_with_reject_policy():
+    tokenizer = StubTokenizer()
+    store = SessionStore(tokenizer)
+    budget = ContextBudget(tokenizer, max_context=128, policy="reject")
+    chat(store, budget, "s", [{"role": "user", "content": "hello"}], new_session=True)
+    with pytest.raises(PromptTooLong):
+        for i in range(30):
+            chat(store, budget, "s", [{"role": "user", "content": "word " * 10}])
+
+
+def test_large_max_tokens_is_capped_not_rejected():
+    tokenizer = StubTokenizer()
+    budget = ContextBudget(tokenizer, max_context=4096)
+    messages = [{"role": "user", "content": "question " + "word " * 20},
+                {"role": "assistant", "content": "answer"},
+                {"role": "user", "content": "hi"}]
+    # 和 Pipeline 一样 max_tokens 超过上下文长度: 不截断历史, max_tokens 截到剩余空间
+    prompt, dropped, max_tokens = budget.fit(messages, max_tokens=5000)
+    assert dropped == 0
+    assert 0 < max_tokens <= 4096 - len(tokenizer.encode(prompt))
+    assert budget.stats()["rejected"] == 0
+
+    store = SessionStore(tokenizer)
+    turn = store.begin("s", messages, new_session=True)
+    turn, max_tokens = budget.fit_turn(store, turn, 5000)
+    assert max_tokens == 4096 - len(turn.prompt_ids)
+    assert not budget.stats()["truncated"]